@@ -1,16 +1,36 @@
 import base64
+import hashlib
 import io
 import os, sys
 import random
 import uuid
-from flask import Flask, jsonify, request, send_file, Response, stream_with_context
+from functools import wraps
+from flask import (
+    Flask,
+    jsonify,
+    request,
+    send_file,
+    url_for,
+    Response,
+    stream_with_context,
+)
 from flask_cors import CORS
 from dotenv import load_dotenv
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils import save_base64_image, logger_setup, get_mimetype, sample_frames
 from config import *
+from lazy import Lazy, load_module
+from utils import logger_setup, get_mimetype, sample_frames
 from llm import Storyteller
+from ratelimit import is_rate_limit_error
+from breaker import CircuitOpen
+from deadline import deadline_scope, current_deadline, client_disconnected
+from live import LiveSessions, LiveSessionError
+from media import MediaNotFound, decode_data_url, params_key
+from images import ImageStore, InvalidImage
+from drawing import normalize_drawing
+from coalesce import RequestCoalescer
+from respcache import DiskTier
 
 load_dotenv()
 
@@ -30,15 +50,310 @@ LOGGER = os.environ.get("LOGGER", "False").lower() in ("true", "1", "t")
 STORAGE_PATH = "static"
 
 if LOGGER:
-    logger = logger_setup("app", os.path.join(LOG_FOLDER, "app.log"), debug=DEBUG)
+    logger = logger_setup(
+        "app",
+        os.path.join(LOG_FOLDER, "app.log"),
+        debug=DEBUG,
+        max_bytes=LOG_MAX_BYTES,
+        backups=LOG_BACKUPS,
+        queue_size=LOG_QUEUE_SIZE,
+        field_limit=LOG_FIELD_LIMIT,
+        message_limit=LOG_MESSAGE_LIMIT,
+    )
     logger.debug("Logger initialized!")
     # logger.debug(f"Environment variables: {os.environ}")
 else:
     logger = None
 
 
-# Initialize the storyteller
-llm = Storyteller(OPENAI_API_KEY, OPENAI_ORG_ID)
+# Initialize the storyteller on first use
+llm = Lazy(lambda: Storyteller(OPENAI_API_KEY, OPENAI_ORG_ID))
+images = ImageStore(
+    STORAGE_PATH, APP_IMAGE_EXT, APP_IMAGE_MAX_BYTES, APP_IMAGE_VARIANTS
+)
+
+
+coalescer = RequestCoalescer(
+    DiskTier(COALESCE_FOLDER, COALESCE_DISK_MB * 1024 * 1024),
+    COALESCE_TTL,
+    logger=logger,
+)
+
+
+def live_transcribe(audio, background):
+    audio_file = io.BytesIO(audio)
+    audio_file.name = "audio.webm"
+    method = "live_transcribe" if background else "speech_to_text"
+    return llm.speech_to_text(audio_file, method=method).text
+
+
+live = LiveSessions(
+    LIVE_FOLDER,
+    live_transcribe,
+    max_frames=LIVE_MAX_FRAMES,
+    max_audio_bytes=LIVE_MAX_AUDIO_BYTES,
+    segment_chunks=LIVE_SEGMENT_CHUNKS,
+    ttl=LIVE_SESSION_TTL,
+    workers=LIVE_WORKERS,
+    logger=logger,
+)
+
+
+def with_deadline(view):
+    # Run the view under its latency budget (DEADLINE_BUDGETS), every upstream
+    # call it makes is bounded by it. Clients may ask for a shorter budget with
+    # the X-Request-Timeout header (seconds).
+    budget = DEADLINE_BUDGETS.get(view.__name__, DEADLINE_DEFAULT)
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        limit = budget
+        try:
+            limit = min(limit, float(request.headers.get("X-Request-Timeout", limit)))
+        except ValueError:
+            pass
+        probe = client_disconnected(request.environ)
+        with deadline_scope(limit, probe) as deadline:
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code == 500 and (
+                deadline.expired() or deadline.cancelled
+            ):
+                if logger:
+                    logger.warning("Deadline exceeded in %s", view.__name__)
+                return jsonify({"error": "Deadline exceeded"}), 504
+            return response
+
+    return wrapper
+
+
+def coalesced(view):
+    # Duplicate requests (same Idempotency-Key header, or else same endpoint,
+    # query and body) run the view once, in any worker: the others wait for
+    # its response, which is replayed for COALESCE_TTL seconds if it succeeded
+    name = view.__name__
+    budget = DEADLINE_BUDGETS.get(name, DEADLINE_DEFAULT)
+
+    def stored(response, body):
+        if response.status_code != 200:
+            return None
+        if response.is_json:
+            data = response.get_json(silent=True)
+            if not isinstance(data, dict) or data.get("type") == "error":
+                return None
+            if "error" in data:
+                return None
+        headers = [
+            (key, value)
+            for key, value in response.headers.items()
+            if key.lower() not in ("content-length", "set-cookie")
+        ]
+        return {
+            "status": response.status_code,
+            "headers": headers,
+            "body": base64.b64encode(body).decode(),
+        }
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        digest = hashlib.sha256(f"{name}?".encode() + request.query_string)
+        digest.update(request.get_data())
+        fingerprint = digest.hexdigest()
+        idempotency_key = request.headers.get("Idempotency-Key")
+        key = fingerprint
+        if idempotency_key:
+            key = hashlib.sha256(f"{name}:{idempotency_key}".encode()).hexdigest()
+        try:
+            state, entry = coalescer.claim(name, key, budget)
+        except TimeoutError:
+            message = "A duplicate request is still in progress!"
+            return jsonify(type="error", message=message, status=409), 409
+        if state == "replay":
+            if entry["request"] != fingerprint:
+                coalescer.count(name, "conflicts")
+                message = "Idempotency-Key was used for another request!"
+                return jsonify(type="error", message=message, status=422), 422
+            response = Response(
+                base64.b64decode(entry["body"]),
+                status=entry["status"],
+                headers=entry["headers"],
+            )
+            response.headers["Idempotent-Replayed"] = "true"
+            return response
+
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except BaseException:
+            coalescer.finish(key)
+            raise
+
+        def finish(body):
+            entry = stored(response, body)
+            if entry is not None:
+                entry["request"] = fingerprint
+            coalescer.finish(key, entry)
+
+        if not response.is_streamed:
+            finish(response.get_data())
+            return response
+
+        def tee():
+            # Stream to this client, store once the whole body was sent
+            chunks, complete = [], False
+            try:
+                for chunk in response.iter_encoded():
+                    chunks.append(chunk)
+                    yield chunk
+                complete = True
+            finally:
+                response.close()
+                if complete:
+                    finish(b"".join(chunks))
+                else:
+                    coalescer.finish(key)
+
+        return Response(tee(), status=response.status, headers=response.headers)
+
+    return wrapper
+
+
+def get_story_id(data):
+    # Story id can be sent at the top level or inside the call context
+    context = data.get("context")
+    if isinstance(context, dict) and context.get("story_id"):
+        return context.get("story_id")
+    return data.get("story_id")
+
+
+def story_keypoints(story_id, part):
+    # Merge a new part into the story keypoint index, returns the response fields
+    if not story_id:
+        return {}
+    return {"keypoint": llm.update_keypoints(story_id, part)}
+
+
+def action_cards(actions):
+    # ACTION_GEN_COUNT of the generated actions plus the fixed improvise and
+    # ending choices, as shown by the frontend
+    actions = random.sample(actions, min(ACTION_GEN_COUNT, len(actions)))
+    actions.append(
+        {
+            "title": "Improvise",
+            "desc": "Use your improvisation to progress the story!",
+        }
+    )
+    actions.append(
+        {
+            "title": "Ending",
+            "desc": "Bring the story to an end and see what happens!",
+        }
+    )
+    return [
+        {
+            "id": uuid.uuid4(),
+            **a,
+            "active": True,
+            "isImprov": a["title"] == "Improvise",
+        }
+        for a in actions
+    ]
+
+
+def load_drawing(context):
+    # Drawing for generate_character, cropped and downscaled once per image.
+    # Returns the stored image name (None if it could not be stored) and the
+    # normalized drawing as a data URL.
+    normalize = lambda data: normalize_drawing(
+        data, DRAWING_SIZE, DRAWING_QUALITY, DRAWING_CROP
+    )
+    name = context.get("image_id")
+    if name:
+        if not os.path.exists(images.path(name)):
+            raise InvalidImage(f"Image not found: {name}")
+    else:
+        data = decode_data_url(context["image"])
+        try:
+            name, _ = images.save_bytes(data)
+        except InvalidImage:
+            # Format we do not store, normalize it in memory
+            drawing = base64.b64encode(normalize(data)).decode()
+            return None, f"data:image/jpeg;base64,{drawing}"
+
+    path = images.derived(name, f"drawing{DRAWING_SIZE}.jpg", normalize)
+    with open(path, "rb") as f:
+        drawing = base64.b64encode(f.read()).decode()
+    return name, f"data:image/jpeg;base64,{drawing}"
+
+
+def get_audio_id(data):
+    # Audio of an improv take: "audio_id" of the media store, or an inline
+    # data URL (bare or inside {"audio": ...}), which gets stored too
+    if data.get("audio_id"):
+        return data["audio_id"]
+    audio = data.get("audio")
+    if isinstance(audio, dict):
+        audio = audio.get("audio")
+    if not audio:
+        return None
+    media_id, _ = llm.media.put_audio(decode_data_url(audio))
+    return media_id
+
+
+def get_frames(data):
+    # Frames of an improv take from "frames_id" or inline, with their id
+    if data.get("frames_id"):
+        return data["frames_id"], llm.media.frames(data["frames_id"])
+    frames = data.get("frames")
+    if not frames:
+        return None, frames
+    media_id, _ = llm.media.put_frames(frames)
+    return media_id, frames
+
+
+def media_not_found(e):
+    # Unknown or evicted media id (MediaStore entries expire): the client has
+    # to upload the take again
+    return jsonify(type="error", message=str(e), status=404), 404
+
+
+def get_transcript(data):
+    # Transcript text sent by the client, or the one of the take's audio
+    result = data.get("audioResult")
+    if result:
+        return result.get("data").get("text")
+    audio_id = get_audio_id(data)
+    return llm.transcribe_media(audio_id).get("text") if audio_id else None
+
+
+def generate_from_improv(kind, transcript, frames, data):
+    # Generation step shared by the *_improv_all routes and live sessions
+    hints = data.get("hints")
+    story = data.get("story")
+    premise = data.get("premise")
+    story_id = get_story_id(data)
+    keypoint = llm.get_keypoints(story_id, data.get("keypoint"))
+
+    if kind == "improv_all":
+        end = data.get("end", False)
+        result = llm.generate_character_premise_improv(transcript, frames, hints, end)
+    elif kind == "story_improv_all":
+        end = data.get("end", False)
+        result = llm.generate_story_improv(
+            transcript, frames, story, premise, keypoint, hints, end
+        )
+    elif data.get("exercise"):
+        end = data.get("end", True)
+        result = llm.generate_ending_improv(
+            transcript, frames, story, premise, keypoint, hints, end
+        )
+    else:
+        end = data.get("end", True)
+        result = llm.generate_ending_exercise_improv(
+            transcript, frames, story, hints, end
+        )
+    result["id"] = uuid.uuid4()
+    if kind != "improv_all":
+        result.update(story_keypoints(story_id, result))
+    return result
 
 
 @app.route("/", methods=["GET"])
@@ -85,6 +400,18 @@ def index():
                     "methods": ["POST"],
                     "description": "Read text using the API",
                 },
+                "media": {
+                    "methods": ["POST", "GET"],
+                    "description": "Upload improv frames and audio, reference them by id",
+                },
+                "metrics": {
+                    "methods": ["GET"],
+                    "description": "Upstream call latency and token metrics",
+                },
+                "live": {
+                    "methods": ["POST", "PUT", "DELETE"],
+                    "description": "Stream an improv performance while it happens",
+                },
             },
         }
     )
@@ -95,54 +422,111 @@ def index():
 
 @app.route("/api/image", methods=["POST"])
 def image_save():
-    os.makedirs(STORAGE_PATH, exist_ok=True)
-    # Save the base64 image
-    if logger:
-        logger.debug("Request in image_save:", request)
-    data = request.get_json()
-
-    base64_url = data["image"]
-    img_data = base64_url.split(",", 1)[1]
-    img_type = data["type"]
-
-    if not base64_url:
-        if logger:
-            logger.error("No image found in the request!")
-            logger.debug(data)
-        return jsonify(type="error", message="No image found!", status=400)
-
-    if img_type not in APP_IMAGE_EXT:
-        if logger:
-            logger.error("Invalid image type!")
-            logger.debug(data)
-        return jsonify(type="error", message="Invalid image type!", status=400)
-
-    img_fname = f"img_{uuid.uuid4().hex}.{img_type}"
-    img_path = os.path.join(STORAGE_PATH, img_fname)
-    save_base64_image(img_data, img_path)
+    # Save an image, either streamed as raw bytes (Content-Type image/* or
+    # application/octet-stream) or as a base64 data URL in JSON {"image"}.
+    # Images are named by content hash: the same image gets the same name.
+    try:
+        if request.mimetype.startswith("image/") or (
+            request.mimetype == "application/octet-stream"
+        ):
+            img_fname, new = images.save_stream(request.stream)
+        else:
+            data = request.get_json()
+            base64_url = (data or {}).get("image")
+            if not base64_url:
+                if logger:
+                    logger.error("No image found in the request!")
+                    logger.debug(data)
+                return jsonify(type="error", message="No image found!", status=400)
+            img_fname, new = images.save_bytes(decode_data_url(base64_url))
+    except InvalidImage as e:
+        if logger:
+            logger.error("Invalid image: %s", e)
+        return jsonify(type="error", message=str(e), status=400), 400
 
     if logger:
-        logger.info(f"Image saved: {img_path}")
+        logger.info("Image %s: %s", "saved" if new else "already stored", img_fname)
     return jsonify(type="success", message="Image saved!", status=200, name=img_fname)
 
 
 @app.route("/api/image/<img_name>", methods=["GET"])
 def image_get(img_name):
-    # Get the base64 image
-    img_path = os.path.join(STORAGE_PATH, img_name)
-    img_type = img_name.split(".")[-1]
-
+    # Send the image, or a resized variant of it (?variant=thumb|slide, see
+    # APP_IMAGE_VARIANTS). Image names never get new content, so responses
+    # are cacheable forever and revalidate with ETag / Last-Modified.
+    img_path = images.path(img_name)
     if not os.path.exists(img_path):
         if logger:
-            logger.error(f"Image not found: {img_path}")
-        return jsonify(type="error", message="Image not found!", status=404)
+            logger.error("Image not found: %s", img_path)
+        return jsonify(type="error", message="Image not found!", status=404), 404
 
+    variant = request.args.get("variant")
+    if variant:
+        if variant not in APP_IMAGE_VARIANTS:
+            return jsonify(type="error", message="Unknown variant!", status=400), 400
+        try:
+            webp = "image/webp" in request.headers.get("Accept", "")
+            img_path = images.variant(img_name, variant, webp)
+        except InvalidImage as e:
+            if logger:
+                logger.error(str(e))
+            return jsonify(type="error", message=str(e), status=415), 415
+
+    img_type = img_path.rsplit(".", 1)[-1]
+    response = send_file(
+        img_path,
+        mimetype=f"image/{'jpeg' if img_type == 'jpg' else img_type}",
+        conditional=True,
+        etag=True,
+        max_age=APP_IMAGE_MAX_AGE,
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    if variant:
+        response.vary.add("Accept")
     if logger:
-        logger.info(f"Image sent: {img_path}")
-    return send_file(img_path, mimetype=f"image/{img_type}")
+        logger.info("Image sent: %s (%s)", img_path, response.status_code)
+    return response
+
+
+@app.route("/api/media", methods=["POST"])
+def media_upload():
+    # Upload the media of an improv take once, then reference it by id.
+    # Either raw audio bytes (Content-Type audio/*), or JSON with "audio"
+    # (data URL) and/or "frames" (list of data URLs). Ids are content hashes,
+    # uploading the same take again returns the same ids.
+    try:
+        result = {}
+        if request.mimetype.startswith("audio/"):
+            result["audio_id"], _ = llm.media.put_audio(request.get_data())
+        else:
+            data = request.get_json()
+            if not data or not (data.get("audio") or data.get("frames")):
+                return jsonify(type="error", message="No media found!", status=400)
+            if data.get("audio"):
+                result["audio_id"] = get_audio_id(data)
+            if data.get("frames"):
+                result["frames_id"], _ = get_frames(data)
+        if logger:
+            logger.debug("Media stored: %s", result)
+        return jsonify(type="success", message="Media stored!", status=200, data=result)
+    except Exception as e:
+        if logger:
+            logger.error(str(e))
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/media/<media_id>", methods=["GET"])
+def media_get(media_id):
+    # Metadata and derived artifacts of stored media
+    try:
+        return jsonify(type="success", status=200, data=llm.media.meta(media_id))
+    except MediaNotFound as e:
+        return media_not_found(e)
 
 
 @app.route("/api/character", methods=["POST"])
+@with_deadline
 def character_gen():
     try:
         data = request.get_json()
@@ -152,25 +536,33 @@ def character_gen():
             return jsonify(type="error", message="No data found!", status=400)
 
         complexity = data.get("complexity", None)
-        context = data.get("context", None)
-        image = context["image"]
-        if not image:
+        context = data.get("context") or {}
+        image = context.get("image")
+        if not image and not context.get("image_id"):
             if logger:
                 logger.error("No image found in the request!")
                 logger.debug(data)
             return jsonify(type="error", message="No image found!", status=400)
 
-        result = llm.generate_character(image, complexity)
+        name, drawing = load_drawing(context)
+        if not image:
+            image = url_for("image_get", img_name=name, _external=True)
+
+        result = llm.generate_character(drawing, complexity, DRAWING_DETAIL)
         return jsonify(
             type="success",
             message="Character generated!",
             status=200,
             data={
                 "id": uuid.uuid4(),
-                "image": {"src": image, **result["image"]},
+                "image": {"src": image, "name": name, **result["image"]},
                 "character": {**result["character"]},
             },
         )
+    except InvalidImage as e:
+        if logger:
+            logger.error(str(e))
+        return jsonify(type="error", message=str(e), status=400), 400
     except Exception as e:
         if logger:
             logger.error(str(e))
@@ -187,7 +579,7 @@ def session_init():
     try:
         session_id = uuid.uuid4()
         if logger:
-            logger.info(f"Session initialized: {session_id}")
+            logger.info("Session initialized: %s", session_id)
         return jsonify(
             type="success",
             message="Session initialized!",
@@ -206,6 +598,7 @@ def session_get(session_id):
 
 
 @app.route("/api/story/premise", methods=["POST"])
+@with_deadline
 def premise_gen():
     try:
         data = request.get_json()
@@ -228,7 +621,7 @@ def premise_gen():
             PREMISE_GEN_COUNT,
         )
         if logger:
-            logger.debug(f"Story premise generated: {result}")
+            logger.debug("Story premise generated: %s", result)
         return jsonify(
             type="success",
             message="Story premise generated!",
@@ -242,6 +635,7 @@ def premise_gen():
 
 
 @app.route("/api/story/hints", methods=["POST"])
+@with_deadline
 def init_hints_gen():
     try:
         data = request.get_json()
@@ -251,10 +645,10 @@ def init_hints_gen():
             return jsonify(type="error", message="No data found!", status=400)
 
         if logger:
-            logger.debug(f"Data in end_hints_gen: {data}")
+            logger.debug("Data in end_hints_gen: %s", data)
         complexity = data.get("context").get("complexity", None)
         if logger:
-            logger.debug(f"Complexity: {complexity}")
+            logger.debug("Complexity: %s", complexity)
 
         result = llm.generate_init_hints(
             complexity,
@@ -262,7 +656,7 @@ def init_hints_gen():
         )
 
         if logger:
-            logger.debug(f"Initial hints generated: {result}")
+            logger.debug("Initial hints generated: %s", result)
         return jsonify(
             type="success",
             message="Initial hints generated!",
@@ -276,6 +670,7 @@ def init_hints_gen():
 
 
 @app.route("/api/story/part", methods=["POST"])
+@with_deadline
 def storypart_gen():
     try:
         data = request.get_json()
@@ -290,13 +685,14 @@ def storypart_gen():
         result = llm.generate_story_part(context, complexity)
         part_id = uuid.uuid4()
         if logger:
-            logger.debug(f"Story part generated: {result}")
+            logger.debug("Story part generated: %s", result)
         part = result["part"]
+        keypoint = story_keypoints(get_story_id(data), part)
         return jsonify(
             type="success",
             message="Story part generated!",
             status=200,
-            data={"id": part_id, **part},
+            data={"id": part_id, **part, **keypoint},
         )
     except Exception as e:
         if logger:
@@ -305,6 +701,7 @@ def storypart_gen():
 
 
 @app.route("/api/story/init", methods=["POST"])
+@with_deadline
 def story_init():
     try:
         data = request.get_json()
@@ -327,14 +724,15 @@ def story_init():
         result = llm.initialize_story(context, complexity)
         story_id = uuid.uuid4()
         part_id = uuid.uuid4()
+        keypoint = story_keypoints(story_id, result)
         if logger:
-            logger.info(f"Story initialized!")
+            logger.info("Story initialized!")
 
         return jsonify(
             type="success",
             message="Story initialized!",
             status=200,
-            data={"id": story_id, "parts": [{"id": part_id, **result}]},
+            data={"id": story_id, "parts": [{"id": part_id, **result, **keypoint}]},
         )
     except Exception as e:
         if logger:
@@ -343,6 +741,7 @@ def story_init():
 
 
 @app.route("/api/story/end", methods=["POST"])
+@with_deadline
 def story_end():
     try:
         data = request.get_json()
@@ -351,20 +750,22 @@ def story_end():
                 logger.error("No data found in the request!")
             return jsonify(type="error", message="No data found!", status=400)
 
-        print(data)
+        if logger:
+            logger.debug("Data in story_end: %s", data)
         complexity = data.get("complexity", None)
         context = data.get("context", None)
 
         result = llm.terminate_story(context, complexity)
         if logger:
-            logger.info(f"Story ended!")
+            logger.info("Story ended!")
         part = result["part"]
         part_id = uuid.uuid4()
+        keypoint = story_keypoints(get_story_id(data), part)
         return jsonify(
             type="success",
             message="Story ended!",
             status=200,
-            data={"id": part_id, **part},
+            data={"id": part_id, **part, **keypoint},
         )
     except Exception as e:
         if logger:
@@ -373,6 +774,7 @@ def story_end():
 
 
 @app.route("/api/story/actions", methods=["POST"])
+@with_deadline
 def actions_gen():
     try:
         data = request.get_json()
@@ -385,31 +787,9 @@ def actions_gen():
         context = data.get("context", None)
 
         result = llm.generate_actions(context, complexity, ACTION_GEN_COUNT)
-        actions = result["list"]
-        actions = random.sample(actions, ACTION_GEN_COUNT)
-        actions.append(
-            {
-                "title": "Improvise",
-                "desc": "Use your improvisation to progress the story!",
-            }
-        )
-        actions.append(
-            {
-                "title": "Ending",
-                "desc": "Bring the story to an end and see what happens!",
-            }
-        )
-        actions = [
-            {
-                "id": uuid.uuid4(),
-                **a,
-                "active": True,
-                "isImprov": a["title"] == "Improvise",
-            }
-            for a in actions
-        ]
+        actions = action_cards(result["list"])
         if logger:
-            logger.debug(f"Story actions generated: {actions}")
+            logger.debug("Story actions generated: %s", actions)
         return jsonify(
             type="success",
             message="Story actions generated!",
@@ -422,7 +802,50 @@ def actions_gen():
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/api/story/turn", methods=["POST"])
+@with_deadline
+def story_turn():
+    # New story part, its actions and keypoint row from a single completion.
+    # Streamed as JSON lines: "text" deltas of the part while it is generated,
+    # then the "part" (as /api/story/part) and the "actions" (as
+    # /api/story/actions).
+    data = request.get_json()
+    if not data:
+        if logger:
+            logger.error("No data found in the request!")
+        return jsonify(type="error", message="No data found!", status=400)
+
+    complexity = data.get("complexity", None)
+    context = data.get("context", None)
+    story_id = get_story_id(data)
+    # Streamed after the view returned, so the deadline is passed explicitly
+    deadline = current_deadline()
+
+    def events():
+        line = lambda **event: app.json.dumps(event) + "\n"
+        try:
+            for kind, value in llm.generate_turn(
+                context, complexity, ACTION_GEN_COUNT, deadline
+            ):
+                if kind == "text":
+                    yield line(type="text", delta=value)
+            part = value["part"]
+            keypoint = story_keypoints(story_id, part)
+            yield line(type="part", data={"id": uuid.uuid4(), **part, **keypoint})
+            actions = action_cards(value.get("actions") or [])
+            yield line(type="actions", data={"list": actions})
+            if logger:
+                logger.debug("Story turn generated: %s", value)
+        except Exception as e:
+            if logger:
+                logger.error(str(e))
+            yield line(type="error", message=str(e))
+
+    return Response(stream_with_context(events()), mimetype="application/x-ndjson")
+
+
 @app.route("/api/story/motion", methods=["POST"])
+@with_deadline
 def process_motion():
     try:
         data = request.get_json()
@@ -431,7 +854,7 @@ def process_motion():
                 logger.error("No data found in the request!")
             return jsonify(type="error", message="No data found!", status=400)
 
-        frames = data.get("frames", None)
+        frames_id, frames = get_frames(data)
         if not frames:
             if logger:
                 logger.error("No frames found in the request!")
@@ -443,15 +866,21 @@ def process_motion():
                 logger.error("No story found in the request!")
             return jsonify(type="error", message="No story found!", status=400)
 
-        result = llm.process_motion(frames, story)
+        result = llm.media.derive(
+            frames_id,
+            "process_motion-" + params_key(story),
+            lambda: llm.process_motion(frames, story),
+        )
         if logger:
-            logger.debug(f"Motion processed: {result}")
+            logger.debug("Motion processed: %s", result)
         return jsonify(
             type="success",
             message="Motion processed!",
             status=200,
             data={**result},
         )
+    except MediaNotFound as e:
+        return media_not_found(e)
     except Exception as e:
         if logger:
             logger.error(str(e))
@@ -459,6 +888,7 @@ def process_motion():
 
 
 @app.route("/api/story/speech-to-text", methods=["POST"])
+@with_deadline
 def speech_to_text():
     try:
         data = request.get_json()
@@ -467,34 +897,29 @@ def speech_to_text():
                 logger.error("No data found in the request!")
             return jsonify(type="error", message="No data found!", status=400)
         if logger:
-            logger.debug(f"Data received by speech-to-text().")
+            logger.debug("Data received by speech-to-text().")
 
-        audio = data.get("audio")
-        audio_data = base64.b64decode(audio.split(",")[1])
-        audio_file = io.BytesIO(audio_data)
-        audio_file.name = "audio.webm"
-
-        result = llm.speech_to_text(audio_file)
-
-        result_dict = (
-            result.to_dict() if hasattr(result, "to_dict") else result.__dict__
-        )
+        audio_id = get_audio_id(data)
+        result = llm.transcribe_media(audio_id)
 
         if logger:
-            logger.debug(f"Speech to text: {result}")
+            logger.debug("Speech to text: %s", result)
         return jsonify(
             type="success",
             message="Speech to text!",
             status=200,
-            data=result_dict,
+            data={**result, "audio_id": audio_id},
         )
+    except MediaNotFound as e:
+        return media_not_found(e)
     except Exception as e:
         if logger:
-            logger.error(f"Error in stt: {str(e)} {result}")
+            logger.error("Error in stt: %s %s", str(e), result)
         return jsonify({"error": str(e)}), 500
 
 
 @app.route("/api/story/startingimprov", methods=["POST"])
+@with_deadline
 def starting_improv():  # TODO: SIMILAR TO PROCESS MOTION
     try:
         data = request.get_json()
@@ -503,43 +928,51 @@ def starting_improv():  # TODO: SIMILAR TO PROCESS MOTION
                 logger.error("No data found in the request!")
             return jsonify(type="error", message="No data found!", status=400)
         if logger:
-            logger.debug(f"Data received by starting_improv(): {data}")
+            logger.debug("Data received by starting_improv(): %s", data)
             # logger.debug(f"Data received by starting_improv().")
 
-        frames = data.get("frames")
+        frames_id, frames = get_frames(data)
         if not frames:
             if logger:
                 logger.error("No frames found in the request!")
             return jsonify(type="error", message="No frames found!", status=400)
 
-        transcript = data.get("audioResult").get("data").get("text")
+        transcript = get_transcript(data)
         # if not transcript:
         #     if logger:
         #         logger.error(f"No transcript found in the request! {data}")
         #     return jsonify(type="error", message="No transcript found!", status=400)
         if logger:
-            logger.debug(f"Transcript received by starting_improv(): {transcript}")
+            logger.debug("Transcript received by starting_improv(): %s", transcript)
 
         hints = data.get("hints")
         end = data.get("end", False)
 
-        result = llm.process_improv_noctx(end, frames, hints, transcript)
+        result = llm.media.derive(
+            frames_id,
+            "process_improv_noctx-" + params_key(end, hints, transcript),
+            lambda: llm.process_improv_noctx(end, frames, hints, transcript),
+        )
         result["transcript"] = transcript
+        result["frames_id"] = frames_id
         if logger:
-            logger.debug(f"Starting improv result: {result}")
+            logger.debug("Starting improv result: %s", result)
         return jsonify(
             type="success",
             message="Starting improv!",
             status=200,
             data={**result},
         )
+    except MediaNotFound as e:
+        return media_not_found(e)
     except Exception as e:
         if logger:
-            logger.error(f"Error in starting_improv: {str(e)}")
+            logger.error("Error in starting_improv: %s", str(e))
         return jsonify({"error": str(e)}), 500
 
 
 @app.route("/api/story/process_improv", methods=["POST"])
+@with_deadline
 def process_improv():  # TODO: SIMILAR TO starting_improv(frames, transcript) + motionpart_gen(context)
     try:
         data = request.get_json()
@@ -549,21 +982,21 @@ def process_improv():  # TODO: SIMILAR TO starting_improv(frames, transcript) +
             return jsonify(type="error", message="No data found!", status=400)
         if logger:
             # logger.debug(f"Data received by starting_improv(): {data}")
-            logger.debug(f"Data received by starting_improv().")
+            logger.debug("Data received by starting_improv().")
 
-        frames = data.get("frames")
+        frames_id, frames = get_frames(data)
         if not frames:
             if logger:
                 logger.error("No frames found in the request!")
             return jsonify(type="error", message="No frames found!", status=400)
 
-        transcript = data.get("audioResult").get("data").get("text")
+        transcript = get_transcript(data)
         # if not transcript:
         #     if logger:
         #         logger.error(f"No transcript found in the request! {data}")
         #     return jsonify(type="error", message="No transcript found!", status=400)
         if logger:
-            logger.debug(f"Transcript received by starting_improv(): {transcript}")
+            logger.debug("Transcript received by starting_improv(): %s", transcript)
 
         story = data.get("story")
         if not story:
@@ -574,23 +1007,31 @@ def process_improv():  # TODO: SIMILAR TO starting_improv(frames, transcript) +
         hints = data.get("hints")
         end = data.get("end", False)
 
-        result = llm.process_improv_ctx(end, frames, story, hints, transcript)
+        result = llm.media.derive(
+            frames_id,
+            "process_improv_ctx-" + params_key(end, story, hints, transcript),
+            lambda: llm.process_improv_ctx(end, frames, story, hints, transcript),
+        )
         result["transcript"] = transcript
+        result["frames_id"] = frames_id
         if logger:
-            logger.debug(f"Process improv result: {result}")
+            logger.debug("Process improv result: %s", result)
         return jsonify(
             type="success",
             message="Starting improv!",
             status=200,
             data={**result},
         )
+    except MediaNotFound as e:
+        return media_not_found(e)
     except Exception as e:
         if logger:
-            logger.error(f"Error in starting_improv: {str(e)}")
+            logger.error("Error in starting_improv: %s", str(e))
         return jsonify({"error": str(e)}), 500
 
 
 @app.route("/api/story/improvpart", methods=["POST"])
+@with_deadline
 def storypart_from_improv():
     try:
         data = request.get_json()
@@ -599,27 +1040,31 @@ def storypart_from_improv():
                 logger.error("No data found in the request!")
             return jsonify(type="error", message="No data found!", status=400)
         if logger:
-            logger.debug(f"Data received by motionpart_gen(): {data}")
+            logger.debug("Data received by motionpart_gen(): %s", data)
 
         complexity = data.get("complexity", None)
         context = data.get("context", None)
 
         result = None
         retry_count = 0
+        deadline = current_deadline()
         while result is None and retry_count < 3:
+            if retry_count and deadline:
+                deadline.check(DEADLINE_MIN_FALLBACK)
             result = llm.generate_part_improv(context, complexity)
             retry_count += 1
             if result is None and logger:
-                logger.warning(f"Retrying generate_part_improv, attempt {retry_count}")
+                logger.warning("Retrying generate_part_improv, attempt %s", retry_count)
         part_id = uuid.uuid4()
         if logger:
-            logger.debug(f"Story part generated: {result}")
+            logger.debug("Story part generated: %s", result)
         part = result["part"]
+        keypoint = story_keypoints(get_story_id(data), part)
         return jsonify(
             type="success",
             message="Story part generated!",
             status=200,
-            data={"id": part_id, **part},
+            data={"id": part_id, **part, **keypoint},
         )
     except Exception as e:
         if logger:
@@ -628,6 +1073,7 @@ def storypart_from_improv():
 
 
 @app.route("/api/story/improvpremise", methods=["POST"])
+@with_deadline
 def premise_from_improv():
     try:
         data = request.get_json()
@@ -636,7 +1082,7 @@ def premise_from_improv():
                 logger.error("No data found in the request!")
             return jsonify(type="error", message="No data found!", status=400)
         if logger:
-            logger.debug(f"Data received by premise_from_improv(): {data}")
+            logger.debug("Data received by premise_from_improv(): %s", data)
 
         improv = data.get("improv")
         transcript = improv.get("data").get("transcript")
@@ -666,7 +1112,9 @@ def premise_from_improv():
         motion = {"description": desc, "emotion": emot, "keywords": keyw}
         if logger:
             logger.debug(
-                f"Transcript and motion received by premise_from_improv(): {transcript} {motion}"
+                "Transcript and motion received by premise_from_improv(): %s %s",
+                transcript,
+                motion,
             )
 
         hints = data.get("hints")
@@ -680,7 +1128,7 @@ def premise_from_improv():
         result["id"] = uuid.uuid4()
 
         if logger:
-            logger.debug(f"Premise and character generated: {result}")
+            logger.debug("Premise and character generated: %s", result)
         return jsonify(
             type="success",
             message="Story part generated!",
@@ -694,6 +1142,8 @@ def premise_from_improv():
 
 
 @app.route("/api/story/improv_all", methods=["POST"])
+@coalesced
+@with_deadline
 def character_premise_from_improv():
     try:
         data = request.get_json()
@@ -702,40 +1152,25 @@ def character_premise_from_improv():
                 logger.error("No data found in the request!")
             return jsonify(type="error", message="No data found!", status=400)
         if logger:
-            logger.debug(f"Data received by premise_from_improv(): {data}")
+            logger.debug("Data received by premise_from_improv(): %s", data)
 
-        audio = data.get("audio").get("audio")
+        result_dict = llm.transcribe_media(get_audio_id(data))
         if logger:
-            logger.debug(f"Audio received by premise_from_improv(): {audio}")
-
-        audio_data = base64.b64decode(audio.split(",")[1])
-        audio_file = io.BytesIO(audio_data)
-        audio_file.name = "audio.webm"
+            logger.debug("Transcript: %s", result_dict)
 
-        result = llm.speech_to_text(audio_file)
+        _, frames = get_frames(data)
+        result = generate_from_improv("improv_all", result_dict, frames, data)
 
-        result_dict = (
-            result.to_dict() if hasattr(result, "to_dict") else result.__dict__
-        )
         if logger:
-            logger.debug(f"Transcript: {result}")
-
-        frames = data.get("frames")
-        hints = data.get("hints")
-        language = data.get("language", None)
-        end = data.get("end", False)
-
-        result = llm.generate_character_premise_improv(result_dict, frames, hints, end)
-        result["id"] = uuid.uuid4()
-
-        if logger:
-            logger.debug(f"Premise and character generated: {result}")
+            logger.debug("Premise and character generated: %s", result)
         return jsonify(
             type="success",
             message="Story part generated!",
             status=200,
             data={**result},
         )
+    except MediaNotFound as e:
+        return media_not_found(e)
     except Exception as e:
         if logger:
             logger.error(str(e))
@@ -743,6 +1178,8 @@ def character_premise_from_improv():
 
 
 @app.route("/api/story/story_improv_all", methods=["POST"])
+@coalesced
+@with_deadline
 def story_from_improv():
     try:
         data = request.get_json()
@@ -751,45 +1188,25 @@ def story_from_improv():
                 logger.error("No data found in the request!")
             return jsonify(type="error", message="No data found!", status=400)
         if logger:
-            logger.debug(f"Data received by premise_from_improv(): {data}")
+            logger.debug("Data received by premise_from_improv(): %s", data)
 
-        audio = data.get("audio").get("audio")
-        if logger:
-            logger.debug(f"Audio received by premise_from_improv(): {audio}")
-
-        audio_data = base64.b64decode(audio.split(",")[1])
-        audio_file = io.BytesIO(audio_data)
-        audio_file.name = "audio.webm"
-
-        result = llm.speech_to_text(audio_file)
-
-        result_dict = (
-            result.to_dict() if hasattr(result, "to_dict") else result.__dict__
-        )
+        result_dict = llm.transcribe_media(get_audio_id(data))
         if logger:
-            logger.debug(f"Transcript: {result}")
+            logger.debug("Transcript: %s", result_dict)
 
-        frames = data.get("frames")
-        hints = data.get("hints")
-        language = data.get("language", None)
-        end = data.get("end", False)
-        story = data.get("story")
-        premise = data.get("premise")
-        keypoint = data.get("keypoint")
-
-        result = llm.generate_story_improv(
-            result_dict, frames, story, premise, keypoint, hints, end
-        )
-        result["id"] = uuid.uuid4()
+        _, frames = get_frames(data)
+        result = generate_from_improv("story_improv_all", result_dict, frames, data)
 
         if logger:
-            logger.debug(f"Story part generated: {result}")
+            logger.debug("Story part generated: %s", result)
         return jsonify(
             type="success",
             message="Story part generated!",
             status=200,
             data={**result},
         )
+    except MediaNotFound as e:
+        return media_not_found(e)
     except Exception as e:
         if logger:
             logger.error(str(e))
@@ -797,6 +1214,8 @@ def story_from_improv():
 
 
 @app.route("/api/story/end_improv_all", methods=["POST"])
+@coalesced
+@with_deadline
 def end_from_improv():
     try:
         data = request.get_json()
@@ -805,58 +1224,124 @@ def end_from_improv():
                 logger.error("No data found in the request!")
             return jsonify(type="error", message="No data found!", status=400)
         if logger:
-            logger.debug(f"Data received by premise_from_improv(): {data}")
+            logger.debug("Data received by premise_from_improv(): %s", data)
 
-        audio = data.get("audio").get("audio")
+        result_dict = llm.transcribe_media(get_audio_id(data))
         if logger:
-            logger.debug(f"Audio received by premise_from_improv(): {audio}")
+            logger.debug("Transcript: %s", result_dict)
 
-        audio_data = base64.b64decode(audio.split(",")[1])
-        audio_file = io.BytesIO(audio_data)
-        audio_file.name = "audio.webm"
+        _, frames = get_frames(data)
+        result = generate_from_improv("end_improv_all", result_dict, frames, data)
+
+        if logger:
+            logger.debug("Ending generated: %s", result)
+        return jsonify(
+            type="success",
+            message="Ending generated!",
+            status=200,
+            data={**result},
+        )
+    except MediaNotFound as e:
+        return media_not_found(e)
+    except Exception as e:
+        if logger:
+            logger.error(str(e))
+        return jsonify({"error": str(e)}), 500
 
-        result = llm.speech_to_text(audio_file)
 
-        result_dict = (
-            result.to_dict() if hasattr(result, "to_dict") else result.__dict__
+@app.route("/api/live/start", methods=["POST"])
+def live_start():
+    # Open a live improv session. The body holds the kind of the matching
+    # /api/story/<kind> route and the same context fields, without media.
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify(type="error", message="No data found!", status=400)
+        kind = data.pop("kind", None)
+        session = live.start(kind, data)
+        if logger:
+            logger.debug("Live session %s started (%s)", session.id, kind)
+        return jsonify(
+            type="success",
+            message="Live session started!",
+            status=200,
+            data={"id": session.id},
         )
+    except LiveSessionError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
         if logger:
-            logger.debug(f"Transcript: {result}")
+            logger.error(str(e))
+        return jsonify({"error": str(e)}), 500
 
-        frames = data.get("frames")
-        hints = data.get("hints")
-        language = data.get("language", None)
-        end = data.get("end", True)
-        story = data.get("story")
-        premise = data.get("premise")
-        keypoint = data.get("keypoint")
-        exercise = data.get("exercise")
 
-        if exercise:
-            result = llm.generate_ending_improv(
-                result_dict, frames, story, premise, keypoint, hints, end
-            )
-        else:
-            result = llm.generate_ending_exercise_improv(
-                result_dict, frames, story, hints, end
-            )
-        result["id"] = uuid.uuid4()
+@app.route("/api/live/<session_id>/frames", methods=["POST"])
+def live_frames(session_id):
+    # Frames captured since the last call, as data URLs
+    try:
+        data = request.get_json()
+        frames = (data or {}).get("frames") or []
+        count = live.add_frames(session_id, frames)
+        return jsonify(type="success", status=200, data={"frames": count})
+    except LiveSessionError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        if logger:
+            logger.error(str(e))
+        return jsonify({"error": str(e)}), 500
+
 
+@app.route("/api/live/<session_id>/audio/<int:seq>", methods=["POST", "PUT"])
+def live_audio(session_id, seq):
+    # One MediaRecorder chunk, raw bytes in the body, numbered from 0
+    try:
+        chunks = live.add_audio(session_id, seq, request.get_data())
+        return jsonify(type="success", status=200, data={"chunks": chunks})
+    except LiveSessionError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
         if logger:
-            logger.debug(f"Ending generated: {result}")
+            logger.error(str(e))
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/live/<session_id>/finish", methods=["POST"])
+@with_deadline
+def live_finish(session_id):
+    # End of the performance. Optional body: "chunks" (total audio chunks sent,
+    # to detect losses) and context fields that changed since start.
+    try:
+        data = request.get_json(silent=True) or {}
+        meta, transcript, frames = live.finish(session_id, data.pop("chunks", None))
+        if logger:
+            logger.debug("Live session %s transcript: %s", session_id, transcript)
+        context = {**meta["context"], **data}
+        result = generate_from_improv(meta["kind"], transcript, frames, context)
         return jsonify(
             type="success",
-            message="Ending generated!",
+            message="Story part generated!",
             status=200,
             data={**result},
         )
+    except LiveSessionError as e:
+        return jsonify({"error": str(e)}), 404
     except Exception as e:
         if logger:
             logger.error(str(e))
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/api/live/<session_id>", methods=["DELETE"])
+def live_cancel(session_id):
+    try:
+        live.cancel(session_id)
+        return jsonify(type="success", status=200)
+    except LiveSessionError as e:
+        return jsonify({"error": str(e)}), 404
+
+
 @app.route("/api/story/character_image", methods=["POST"])
+@with_deadline
 def gen_character_img():
     try:
         data = request.get_json()
@@ -873,7 +1358,7 @@ def gen_character_img():
 
         result = llm.generate_character_image_improv(character)
         if logger:
-            logger.debug(f"Character image generated: {result}")
+            logger.debug("Character image generated: %s", result)
         return jsonify(
             type="success",
             message="Story image generated!",
@@ -887,6 +1372,8 @@ def gen_character_img():
 
 
 @app.route("/api/story/image", methods=["POST"])
+@coalesced
+@with_deadline
 def storyimage_gen():  # TODO: retry if error?
     try:
         data = request.get_json()
@@ -897,7 +1384,7 @@ def storyimage_gen():  # TODO: retry if error?
 
         result = llm.generate_story_image(data)
         if logger:
-            logger.debug(f"Story image generated: {result}")
+            logger.debug("Story image generated: %s", result)
         return jsonify(
             type="success",
             message="Story image generated!",
@@ -907,10 +1394,20 @@ def storyimage_gen():  # TODO: retry if error?
     except Exception as e:
         if logger:
             logger.error(str(e))
+        if is_rate_limit_error(e):
+            # Retrying would only add to the upstream load
+            return jsonify({"error": str(e)}), 429
+        if isinstance(e, CircuitOpen):
+            return (
+                jsonify({"error": str(e)}),
+                503,
+                {"Retry-After": str(round(e.retry_after))},
+            )
         try:
+            current_deadline().check(DEADLINE_MIN_FALLBACK)
             result = llm.generate_story_image(data)
             if logger:
-                logger.debug(f"Story image generated on retry: {result}")
+                logger.debug("Story image generated on retry: %s", result)
             return jsonify(
                 type="success",
                 message="Story image generated on retry!",
@@ -924,15 +1421,16 @@ def storyimage_gen():  # TODO: retry if error?
 
 
 @app.route("/api/practice/generate_storytoend", methods=["POST"])
+@with_deadline
 def generate_story_to_end():
     try:
         if logger:
-            logger.debug(f"Generating story to end...")
+            logger.debug("Generating story to end...")
         result = llm.generate_story_to_end()
         story_id = uuid.uuid4()
         part_id = uuid.uuid4()
         if logger:
-            logger.info(f"Ending generated!")
+            logger.info("Ending generated!")
 
         return jsonify(
             type="success",
@@ -947,6 +1445,7 @@ def generate_story_to_end():
 
 
 @app.route("/api/story/end_hints", methods=["POST"])
+@with_deadline
 def end_hints_gen():
     try:
         data = request.get_json()
@@ -956,20 +1455,19 @@ def end_hints_gen():
             return jsonify(type="error", message="No data found!", status=400)
 
         if logger:
-            logger.debug(f"Data in end_hints_gen: {data}")
+            logger.debug("Data in end_hints_gen: %s", data)
         complexity = data.get("context").get("complexity", None)
         language = data.get("language", None)
         if logger:
-            logger.debug(f"Complexity: {complexity}, Language: {language}")
+            logger.debug("Complexity: %s, Language: %s", complexity, language)
 
         result = llm.generate_end_hints(
             complexity,
-            language,
             HINTS_GEN_COUNT,
         )
 
         if logger:
-            logger.debug(f"Ending hints generated: {result}")
+            logger.debug("Ending hints generated: %s", result)
         return jsonify(
             type="success",
             message="Initial hints generated!",
@@ -983,6 +1481,7 @@ def end_hints_gen():
 
 
 @app.route("/api/story/end_story_improv", methods=["POST"])
+@with_deadline
 def end_story_improv():
     try:
         data = request.get_json()
@@ -991,7 +1490,7 @@ def end_story_improv():
                 logger.error("No data found in the request!")
             return jsonify(type="error", message="No data found!", status=400)
         if logger:
-            logger.debug(f"Generating ending...")
+            logger.debug("Generating ending...")
 
         improv = data.get("improv")
         if not improv:
@@ -1007,15 +1506,16 @@ def end_story_improv():
 
         result = llm.terminate_story_improv(story, improv)
         if logger:
-            logger.info(f"Ending generated!")
+            logger.info("Ending generated!")
 
         part_id = uuid.uuid4()
         part = result["part"]
+        keypoint = story_keypoints(get_story_id(data), part)
         return jsonify(
             type="success",
             message="Story part generated!",
             status=200,
-            data={"id": part_id, **part},
+            data={"id": part_id, **part, **keypoint},
         )
     except Exception as e:
         if logger:
@@ -1024,6 +1524,7 @@ def end_story_improv():
 
 
 @app.route("/api/practice/generate_questions", methods=["POST"])
+@with_deadline
 def generate_questions():
     try:
         data = request.get_json()
@@ -1032,19 +1533,19 @@ def generate_questions():
                 logger.error("No data found in the request!")
             return jsonify(type="error", message="No data found!", status=400)
         if logger:
-            logger.debug(f"Generating questions...")
+            logger.debug("Generating questions...")
 
         max_q = data.get("maxQ", 20)
 
         result = llm.generate_questions(max_q)
         if logger:
-            logger.info(f"Questions generated: {result}")
+            logger.info("Questions generated: %s", result)
         story_id = uuid.uuid4()
         parts = [
             {"id": uuid.uuid4(), **result["questions"][i]} for i in range(0, max_q)
         ]
         if logger:
-            logger.info(f"Parts: {parts}")
+            logger.info("Parts: %s", parts)
 
         return jsonify(
             type="success",
@@ -1059,6 +1560,8 @@ def generate_questions():
 
 
 @app.route("/api/translate", methods=["GET"])
+@coalesced
+@with_deadline
 def translate_text():
     try:
         text = request.args.get("text")
@@ -1076,7 +1579,7 @@ def translate_text():
             )
 
         if logger:
-            logger.debug(f"Translating text from {src_lang} to {tgt_lang}")
+            logger.debug("Translating text from %s to %s", src_lang, tgt_lang)
         result = llm.translate_text(text, src_lang, tgt_lang)
         return jsonify(
             type="success",
@@ -1091,6 +1594,8 @@ def translate_text():
 
 
 @app.route("/api/translate_keypoints", methods=["GET"])
+@coalesced
+@with_deadline
 def translate_keypoints():
     try:
         keypoints = request.args.get("keypoints")
@@ -1109,7 +1614,7 @@ def translate_keypoints():
 
         if logger:
             logger.debug(
-                f"Translating keypoints from {src_lang} to {tgt_lang}: {keypoints}"
+                "Translating keypoints from %s to %s: %s", src_lang, tgt_lang, keypoints
             )
         result = llm.translate_keypoints(keypoints, src_lang, tgt_lang)
         return jsonify(
@@ -1125,16 +1630,28 @@ def translate_keypoints():
 
 
 @app.route("/api/read", methods=["GET"])
+@coalesced
+@with_deadline
 def read_text():
     try:
         text = request.args.get("text")
         os = request.args.get("os", "undetermined")
         if logger:
-            logger.debug(f"Generating speech for: {text}")
+            logger.debug("Generating speech for: %s", text)
+
+        # Speech is streamed once the view returned, fail before that if the
+        # upstream is known to be down
+        retry = llm.breakers.get(MODEL_TTS, "speech").retry_in()
+        if retry is not None:
+            return (
+                jsonify({"error": "Speech generation is unavailable"}),
+                503,
+                {"Retry-After": str(round(retry))},
+            )
 
         mimetype = get_mimetype(os)
         return Response(
-            stream_with_context(llm.send_tts_request(text, os)),
+            stream_with_context(llm.send_tts_request(text, os, current_deadline())),
             mimetype=mimetype,
         )
     except Exception as e:
@@ -1148,5 +1665,40 @@ def not_found(e):
     return jsonify(type="error", message="Not found!", status=404)
 
 
+@app.route("/api/metrics", methods=["GET"])
+def metrics():
+    # Upstream call stats of this worker, per method and A/B variant
+    return jsonify(
+        type="success",
+        message="Metrics available",
+        status=200,
+        data={
+            "pid": os.getpid(),
+            **llm.metrics.summary(),
+            "caches": {
+                "character": llm.characters.stats(),
+                "responses": llm.responses.stats(),
+                "semantic": llm.similar.stats(),
+            },
+            "coalesced": coalescer.stats(),
+            "breakers": llm.breakers.stats(),
+            "routes": llm.router.stats(),
+            "budgets": llm.budgets.stats(),
+        },
+    )
+
+
+def create_app(preload=False):
+    # WSGI entry point, e.g. gunicorn "app:create_app()". The heavy modules
+    # and the storyteller load on the first request that needs them, which
+    # keeps cold starts short. With preload (gunicorn --preload) they load
+    # now, before the workers fork, so the workers share them copy-on-write.
+    if preload:
+        for name in LAZY_MODULES:
+            load_module(name)
+        llm.load()
+    return app
+
+
 if __name__ == "__main__":
-    app.run(host=HOST, port=int(PORT), debug=DEBUG)
+    create_app().run(host=HOST, port=int(PORT), debug=DEBUG)
@@ -0,0 +1,140 @@
+"""
+Per-call cost of generate_character with and without drawing normalization.
+
+Synthesizes phone photos of a drawing on a sheet of paper, then reports for the
+original and the normalized drawing: payload size, vision input tokens (OpenAI
+image token formula), local normalization time, and generate_character latency
+against the local OpenAI stand-in.
+
+    python bench/character.py --photos 5 --latency fixed:0.2 --out character.json
+"""
+
+import argparse
+import base64
+import json
+import math
+import os
+import platform
+import statistics
+import sys
+import time
+
+import cv2
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.append(BENCH_DIR)
+sys.path.append(BACKEND_DIR)
+from loadtest import git_commit
+from mock_openai import start_mock
+
+
+def vision_tokens(width, height, detail):
+    # https://platform.openai.com/docs/guides/vision (calculating costs)
+    if detail == "low":
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def make_photo(rng, size):
+    # A drawing on a slightly rotated sheet of paper lying on a wooden table
+    w, h = size
+    photo = np.empty((h, w, 3), np.uint8)
+    photo[:] = (40, 80, 120)
+    photo = cv2.add(photo, rng.integers(0, 40, (h, w, 3), dtype=np.uint8))
+    cx, cy = w / 2 + rng.uniform(-w, w) * 0.05, h / 2 + rng.uniform(-h, h) * 0.05
+    pw, ph = w * 0.6, w * 0.6 * 1.41
+    if ph > h * 0.9:
+        pw, ph = h * 0.9 / 1.41, h * 0.9
+    box = cv2.boxPoints(((cx, cy), (pw, ph), rng.uniform(-8, 8))).astype(np.int32)
+    cv2.fillConvexPoly(photo, box, (235, 240, 245))
+    for _ in range(12):
+        center = (int(cx + rng.uniform(-pw, pw) * 0.3), int(cy + rng.uniform(-ph, ph) * 0.3))
+        color = tuple(int(c) for c in rng.integers(0, 200, 3))
+        cv2.circle(photo, center, int(rng.uniform(0.03, 0.12) * pw), color, int(w / 200))
+    _, buffer = cv2.imencode(".jpg", photo, [cv2.IMWRITE_JPEG_QUALITY, 92])
+    return buffer.tobytes()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--photos", type=int, default=5)
+    parser.add_argument(
+        "--size", type=int, nargs=2, default=[4032, 3024], metavar=("W", "H")
+    )
+    parser.add_argument("--latency", default="fixed:0")
+    parser.add_argument("--out", help="Write the JSON results to this file")
+    args = parser.parse_args()
+
+    mock = start_mock(latency=args.latency)
+    os.environ.update(OPENAI_API_KEY="bench", OPENAI_BASE_URL=mock.url, LIMITER="False")
+    from config import DRAWING_SIZE, DRAWING_QUALITY, DRAWING_DETAIL, DRAWING_CROP
+    from drawing import normalize_drawing
+    from llm import Storyteller
+
+    llm = Storyteller("bench", None)
+    rng = np.random.default_rng(0)
+    rows = {"original": [], "normalized": []}
+    for _ in range(args.photos):
+        photo = make_photo(rng, args.size)
+        start = time.perf_counter()
+        drawing = normalize_drawing(photo, DRAWING_SIZE, DRAWING_QUALITY, DRAWING_CROP)
+        normalize_ms = (time.perf_counter() - start) * 1000
+
+        for name, data, detail in (
+            ("original", photo, "auto"),
+            ("normalized", drawing, DRAWING_DETAIL),
+        ):
+            image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+            url = "data:image/jpeg;base64," + base64.b64encode(data).decode()
+            start = time.perf_counter()
+            llm.generate_character(url, None, detail)
+            rows[name].append(
+                {
+                    "payload_kb": len(url) / 1024,
+                    "vision_tokens": vision_tokens(
+                        image.shape[1], image.shape[0], detail
+                    ),
+                    "latency_ms": (time.perf_counter() - start) * 1000,
+                    "normalize_ms": normalize_ms if name == "normalized" else 0.0,
+                    "size": f"{image.shape[1]}x{image.shape[0]}",
+                }
+            )
+    mock.shutdown()
+
+    results = {}
+    for name, items in rows.items():
+        results[name] = {
+            key: statistics.median(item[key] for item in items)
+            for key in ("payload_kb", "vision_tokens", "latency_ms", "normalize_ms")
+        }
+        results[name]["size"] = items[0]["size"]
+        r = results[name]
+        print(
+            f"{name:11s} {r['size']:>10s}  {r['payload_kb']:8.1f} KB  "
+            f"{r['vision_tokens']:5.0f} tokens  {r['latency_ms']:7.1f} ms  "
+            f"(normalize {r['normalize_ms']:.1f} ms)"
+        )
+
+    report = {
+        "meta": {
+            "kind": "character",
+            "commit": git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
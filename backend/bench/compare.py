@@ -0,0 +1,76 @@
+"""
+Compare two benchmark result files (loadtest.py or microbench.py output).
+
+    python bench/compare.py before.json after.json --threshold 0.10
+
+Exits with status 1 when a metric regressed by more than the threshold.
+"""
+
+import argparse
+import json
+import sys
+
+# Metrics where a higher value is better, everything else is lower-is-better
+HIGHER_IS_BETTER = ("throughput", "ops_per_s")
+IGNORED = ("requests", "request_kb", "rounds")
+
+
+def regression(metric, old, new):
+    # Relative change, positive when `new` is worse than `old`
+    if not old:
+        return 0.0
+    change = (new - old) / abs(old)
+    if any(key in metric for key in HIGHER_IS_BETTER):
+        return -change
+    return change
+
+
+def compare(before, after, threshold):
+    rows, regressions = [], []
+    for name, old_metrics in before["results"].items():
+        new_metrics = after["results"].get(name)
+        if new_metrics is None:
+            continue
+        for metric, old in old_metrics.items():
+            new = new_metrics.get(metric)
+            if metric in IGNORED or not isinstance(old, (int, float)):
+                continue
+            if not isinstance(new, (int, float)):
+                continue
+            worse = regression(metric, old, new)
+            rows.append((name, metric, old, new, worse))
+            if worse > threshold:
+                regressions.append((name, metric, old, new, worse))
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=0.10)
+    parser.add_argument("--all", action="store_true", help="Print unchanged metrics")
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    rows, regressions = compare(before, after, args.threshold)
+    print(f"{before['meta'].get('commit')} -> {after['meta'].get('commit')}")
+    for name, metric, old, new, worse in rows:
+        if args.all or abs(worse) > args.threshold:
+            flag = "REGRESSION" if worse > args.threshold else "improved"
+            print(
+                f"{name:24s} {metric:22s} {old:12.3f} -> {new:12.3f}  {-worse:+7.1%}  {flag}"
+            )
+    if regressions:
+        print(
+            f"{len(regressions)} metric(s) regressed by more than {args.threshold:.0%}"
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
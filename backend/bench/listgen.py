@@ -0,0 +1,108 @@
+"""
+Wall-clock time of the list generators with LIST_GEN_MODE "single" (one
+completion writes all N items) and "samples" (N single-item samples in one
+call, merged and de-duplicated).
+
+Against the local OpenAI stand-in, decoding time is modelled by --item-time
+seconds per list item of a completion, samples being decoded in parallel as
+upstream. Use --base-url to run it against a real endpoint instead.
+
+    python bench/listgen.py --repeat 5 --latency fixed:0.3 --item-time 0.4
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.append(BENCH_DIR)
+sys.path.append(BACKEND_DIR)
+from loadtest import CHARACTER, STORY, git_commit
+from mock_openai import start_mock
+
+MODES = ("single", "samples")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--latency", default="fixed:0.3")
+    parser.add_argument("--item-time", type=float, default=0.4)
+    parser.add_argument("--base-url", help="Real OpenAI-compatible endpoint")
+    parser.add_argument("--out", help="Write the JSON results to this file")
+    args = parser.parse_args()
+
+    mock = None
+    if args.base_url:
+        os.environ["OPENAI_BASE_URL"] = args.base_url
+    else:
+        mock = start_mock(latency=args.latency, item_time=args.item_time)
+        os.environ.update(OPENAI_API_KEY="bench", OPENAI_BASE_URL=mock.url)
+    os.environ["LIMITER"] = "False"
+    import llm as llm_module
+    from config import ACTION_GEN_COUNT, HINTS_GEN_COUNT, PREMISE_GEN_COUNT
+
+    llm = llm_module.Storyteller("bench", None)
+    llm.similar.policies.clear()  # Measure the generators, not the cache
+    part = {"text": STORY, "keymoment": "A kitchen.", "who": ["Johnny"]}
+    cases = {
+        "generate_premise": lambda: llm.generate_premise(
+            CHARACTER, None, PREMISE_GEN_COUNT
+        ),
+        "generate_actions": lambda: llm.generate_actions(
+            {"part": part, "character": CHARACTER}, None, ACTION_GEN_COUNT
+        ),
+        "generate_init_hints": lambda: llm.generate_init_hints(None, HINTS_GEN_COUNT),
+        "generate_end_hints": lambda: llm.generate_end_hints(None, HINTS_GEN_COUNT),
+    }
+
+    results = {}
+    for mode in MODES:
+        llm_module.LIST_GEN_MODE = mode
+        results[mode] = {}
+        for name, case in cases.items():
+            latencies, counts = [], []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                result = case()
+                latencies.append((time.perf_counter() - start) * 1000)
+                counts.append(len((result or {}).get("list") or []))
+            results[mode][name] = {
+                "latency_ms": statistics.median(latencies),
+                "items": statistics.median(counts),
+            }
+            r = results[mode][name]
+            print(
+                f"{mode:8s} {name:20s} {r['latency_ms']:8.1f} ms  {r['items']:3.0f} items",
+                flush=True,
+            )
+        for name, stats in llm.metrics.summary()["calls"].items():
+            results[mode][name]["completion_tokens_mean"] = stats[
+                "completion_tokens_mean"
+            ]
+        llm.metrics.calls.clear()
+    if mock:
+        mock.shutdown()
+
+    report = {
+        "meta": {
+            "kind": "listgen",
+            "commit": git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
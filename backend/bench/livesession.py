@@ -0,0 +1,100 @@
+"""
+Live improv session transcription: streams a synthetic webm recording in
+chunks through LiveSessions with a stub transcriber, then checks that the
+finished transcript holds every word once and in order, and reports how
+long finish() took (only the tail is left to transcribe).
+
+Every chunk is one webm cluster holding one word, chunk 0 also carries the
+EBML header, as MediaRecorder writes them. The stub decodes the clusters of
+the audio it is given and fails unless it starts with the header.
+
+    python bench/livesession.py --chunks 40 --segment 5 --latency 0.2
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.append(BENCH_DIR)
+sys.path.append(BACKEND_DIR)
+from live import LiveSessions, WEBM_CLUSTER
+from loadtest import git_commit
+
+HEADER = b"\x1a\x45\xdf\xa3 webm header, segment info and tracks "
+
+
+def transcriber(latency):
+    def transcribe(audio, background):
+        if not audio.startswith(HEADER):
+            raise ValueError("Not decodable without the webm header")
+        time.sleep(latency)
+        clusters = audio[len(HEADER) :].split(WEBM_CLUSTER)
+        return " ".join(c.decode() for c in clusters if c)
+
+    return transcribe
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--chunks", type=int, default=40)
+    parser.add_argument("--segment", type=int, default=5, help="Chunks per segment")
+    parser.add_argument("--latency", type=float, default=0.2, help="Per transcription")
+    parser.add_argument("--interval", type=float, default=0.05, help="Between chunks")
+    parser.add_argument("--out", help="Write the JSON results to this file")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix="improvmate-live-")
+    live = LiveSessions(folder, transcriber(args.latency), segment_chunks=args.segment)
+    words = [f"word{i}" for i in range(args.chunks)]
+    try:
+        session = live.start("improv_all", {})
+        for seq, word in enumerate(words):
+            chunk = WEBM_CLUSTER + word.encode()
+            live.add_audio(session.id, seq, HEADER + chunk if seq == 0 else chunk)
+            time.sleep(args.interval)
+        segments = len(session.segments()["segments"])
+        start = time.perf_counter()
+        _, transcript, _ = live.finish(session.id, args.chunks)
+        finish_ms = (time.perf_counter() - start) * 1000
+    finally:
+        live.executor.shutdown()
+        shutil.rmtree(folder, ignore_errors=True)
+
+    text = transcript["text"].split()
+    ok = text == words
+    print(
+        f"{segments} segments before finish, finish {finish_ms:.1f} ms, "
+        f"transcript {'ok' if ok else 'WRONG: ' + ' '.join(text)}",
+        flush=True,
+    )
+
+    report = {
+        "meta": {
+            "kind": "live",
+            "commit": git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "args": vars(args),
+        },
+        "results": {
+            "segments_before_finish": segments,
+            "finish_ms": finish_ms,
+            "transcript_ok": ok,
+            "repeated_words": len(text) - len(set(text)),
+        },
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,561 @@
+"""
+Load test for the backend routes against the local OpenAI stand-in.
+
+Starts the mock OpenAI server, starts the backend (Flask dev server or
+gunicorn with the selected worker class or gunicorn.conf.py profile) pointed
+at it, then drives every route in app.py with realistic payloads. Reports throughput, p50/p95/p99 latency,
+server CPU seconds and peak RSS per endpoint as JSON.
+
+    python bench/loadtest.py --server gthread --requests 50 --concurrency 8 --out results.json
+    python bench/loadtest.py --profile gevent --requests 50 --concurrency 32
+    python bench/loadtest.py --profile gthread --outage gpt-4o:error=1.0,delay=1
+    python bench/compare.py before.json after.json
+"""
+
+import argparse
+import base64
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.append(BENCH_DIR)
+from mock_openai import parse_outage, start_mock
+
+COMPLEXITY = "3rd grade to 6th grade level of language and concepts."
+STORY = (
+    "Once upon a time there was a cat named Johnny who loved to eat tuna. "
+    "One day when Johnny was playing with his toys, he heard a noise coming from the kitchen. "
+) * 4
+CHARACTER = {
+    "fullname": "Johnny the cat",
+    "shortname": "Johnny",
+    "backstory": "Johnny the cat loves tuna and is always looking for food.",
+    "likes": ["tuna"],
+    "dislikes": ["dogs"],
+    "fears": ["being hungry"],
+    "personality": ["friendly"],
+}
+IMPROV = {
+    "data": {
+        "title": "Retreating Step",
+        "action": "Retreating",
+        "description": "The performer takes a slow, hesitant step backward.",
+        "emotion": "Fearful",
+        "keywords": ["step back", "hesitation"],
+        "transcript": "Where is it? I heard something.",
+    }
+}
+HINTS = {"who": "A clown", "where": "A circus", "what": "The lights went out."}
+
+
+def make_frames(n, width, height, quality=80):
+    # Noisy gradient frames, JPEG encoded like the webcam capture in the frontend
+    frames = []
+    base = np.tile(np.linspace(0, 255, width, dtype=np.uint8), (height, 1))
+    for i in range(n):
+        noise = np.random.randint(0, 40, (height, width, 3), dtype=np.uint8)
+        img = np.dstack([base, np.roll(base, i * 8, axis=1), base[::-1]]) // 2 + noise
+        _, buffer = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        frames.append("data:image/jpeg;base64," + base64.b64encode(buffer).decode())
+    return frames
+
+
+def make_audio(size_kb):
+    # EBML header followed by random bytes, close enough to a webm recording
+    data = bytes.fromhex("1a45dfa3") + os.urandom(size_kb * 1024)
+    return "data:audio/webm;base64," + base64.b64encode(data).decode()
+
+
+def make_image(size_px):
+    img = np.random.randint(0, 255, (size_px, size_px, 3), dtype=np.uint8)
+    _, buffer = cv2.imencode(".png", img)
+    return "data:image/png;base64," + base64.b64encode(buffer).decode()
+
+
+def build_routes(args):
+    frames = make_frames(args.frames, *args.frame_size)
+    audio = make_audio(args.audio_kb)
+    image = make_image(args.image_px)
+    keypoint = [1, "Johnny", "kitchen", "tuna"]
+    part = {"text": STORY, "keymoment": "A kitchen.", "who": ["Johnny"]}
+    improv_all = {
+        "audio": {"audio": audio, "language": "en"},
+        "frames": frames,
+        "hints": HINTS,
+        "end": False,
+    }
+    story_improv = {
+        **improv_all,
+        "story": STORY,
+        "premise": "Johnny needs to find out who stole his tuna.",
+        "keypoint": keypoint,
+    }
+    query = urllib.parse.urlencode
+    # name: (method, path, json body)
+    return {
+        "image_save": ("POST", "/api/image", {"image": image, "type": "png"}),
+        "character": (
+            "POST",
+            "/api/character",
+            {"complexity": COMPLEXITY, "context": {"image": image}},
+        ),
+        "story_premise": (
+            "POST",
+            "/api/story/premise",
+            {"complexity": COMPLEXITY, "context": CHARACTER},
+        ),
+        "story_hints": ("POST", "/api/story/hints", {"context": {"complexity": 1}}),
+        "story_init": (
+            "POST",
+            "/api/story/init",
+            {"complexity": COMPLEXITY, "context": {"desc": "A kitchen.", **CHARACTER}},
+        ),
+        "story_part": (
+            "POST",
+            "/api/story/part",
+            {
+                "complexity": COMPLEXITY,
+                "context": {
+                    "story": STORY,
+                    "premise": "Find the tuna.",
+                    "action": {"title": "Investigate", "desc": "Go to the kitchen."},
+                },
+            },
+        ),
+        "story_turn": (
+            "POST",
+            "/api/story/turn",
+            {
+                "complexity": COMPLEXITY,
+                "context": {
+                    "story": STORY,
+                    "premise": "Find the tuna.",
+                    "action": {"title": "Investigate", "desc": "Go to the kitchen."},
+                },
+            },
+        ),
+        "story_end": (
+            "POST",
+            "/api/story/end",
+            {"complexity": COMPLEXITY, "context": {"story": STORY}},
+        ),
+        "story_actions": (
+            "POST",
+            "/api/story/actions",
+            {
+                "complexity": COMPLEXITY,
+                "context": {"part": part, "character": CHARACTER},
+            },
+        ),
+        "story_motion": (
+            "POST",
+            "/api/story/motion",
+            {"frames": frames, "story": STORY},
+        ),
+        "speech_to_text": ("POST", "/api/story/speech-to-text", {"audio": audio}),
+        "startingimprov": (
+            "POST",
+            "/api/story/startingimprov",
+            {
+                "frames": frames,
+                "audioResult": {"data": {"text": IMPROV["data"]["transcript"]}},
+                "hints": HINTS,
+                "end": False,
+            },
+        ),
+        "process_improv": (
+            "POST",
+            "/api/story/process_improv",
+            {
+                "frames": frames,
+                "audioResult": {"data": {"text": IMPROV["data"]["transcript"]}},
+                "story": STORY,
+                "hints": HINTS,
+                "end": False,
+            },
+        ),
+        "improvpart": (
+            "POST",
+            "/api/story/improvpart",
+            {
+                "complexity": COMPLEXITY,
+                "context": {
+                    "premise": "Find the tuna.",
+                    "story": STORY,
+                    "keypoint": keypoint,
+                    "improv": IMPROV,
+                },
+            },
+        ),
+        "improvpremise": (
+            "POST",
+            "/api/story/improvpremise",
+            {"improv": IMPROV, "hints": HINTS, "end": False},
+        ),
+        "improv_all": ("POST", "/api/story/improv_all", improv_all),
+        "story_improv_all": ("POST", "/api/story/story_improv_all", story_improv),
+        "end_improv_all": (
+            "POST",
+            "/api/story/end_improv_all",
+            {**story_improv, "end": True, "exercise": True},
+        ),
+        "character_image": (
+            "POST",
+            "/api/story/character_image",
+            {"character": CHARACTER},
+        ),
+        "story_image": (
+            "POST",
+            "/api/story/image",
+            {"content": "A kitchen at night.", "style": "Crayon drawing."},
+        ),
+        "generate_storytoend": ("POST", "/api/practice/generate_storytoend", {}),
+        "end_hints": (
+            "POST",
+            "/api/story/end_hints",
+            {"context": {"complexity": 1}, "language": "en"},
+        ),
+        "end_story_improv": (
+            "POST",
+            "/api/story/end_story_improv",
+            {"improv": IMPROV, "story": STORY},
+        ),
+        "generate_questions": (
+            "POST",
+            "/api/practice/generate_questions",
+            {"maxQ": 20},
+        ),
+        "translate": (
+            "GET",
+            "/api/translate?"
+            + query({"text": STORY, "src_lang": "en", "tgt_lang": "it"}),
+            None,
+        ),
+        "translate_keypoints": (
+            "GET",
+            "/api/translate_keypoints?"
+            + query(
+                {
+                    "keypoints": json.dumps({"head": ["Who"], "body": [keypoint]}),
+                    "src_lang": "en",
+                    "tgt_lang": "it",
+                }
+            ),
+            None,
+        ),
+        "read": ("GET", "/api/read?" + query({"text": STORY, "os": "android"}), None),
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, mock_url, port):
+    env = {
+        **os.environ,
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_ORG_ID": "bench",
+        "OPENAI_BASE_URL": mock_url,
+        "FLASK_PORT": str(port),
+        "FLASK_HOST": "127.0.0.1",
+        "FLASK_DEBUG": "False",
+        "LOGGER": "True" if args.logger else "False",
+        "LIMITER": "True" if args.limiter else "False",
+    }
+    if args.profile:
+        # Sized by gunicorn.conf.py
+        env["GUNICORN_PROFILE"] = args.profile
+        cmd = [sys.executable, "-m", "gunicorn", "-b", f"127.0.0.1:{port}"]
+        cmd += ["app:create_app()"]
+    elif args.server == "dev":
+        cmd = [sys.executable, "app.py"]
+    else:
+        cmd = [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "-b",
+            f"127.0.0.1:{port}",
+            "-w",
+            str(args.workers),
+            "-k",
+            args.server,
+            "--timeout",
+            "300",
+        ]
+        # Otherwise gunicorn.conf.py's threads would turn sync into gthread
+        cmd += ["--threads", str(args.threads if args.server == "gthread" else 1)]
+        cmd += ["app:app"]
+    proc = subprocess.Popen(
+        cmd,
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=None if args.verbose else subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(600):
+        if proc.poll() is not None:
+            raise RuntimeError(f"Server exited with code {proc.returncode}")
+        try:
+            urllib.request.urlopen(url + "/", timeout=1).read()
+            return proc, url
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("Server did not start")
+
+
+def process_tree(pid):
+    # pid and all its descendants (gunicorn master + workers)
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, stack = [], [pid]
+    while stack:
+        p = stack.pop()
+        tree.append(p)
+        stack.extend(children.get(p, []))
+    return tree
+
+
+def cpu_seconds(pids):
+    ticks = os.sysconf("SC_CLK_TCK")
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += int(fields[11]) + int(fields[12])
+        except (OSError, IndexError, ValueError):
+            pass
+    return total / ticks
+
+
+def rss_bytes(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                total += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+
+class Sampler(threading.Thread):
+    # Samples the RSS of the server process tree while an endpoint is driven
+    def __init__(self, pid, interval=0.05):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, rss_bytes(process_tree(self.pid)))
+            time.sleep(self.interval)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def call(url, method, path, body, timeout, unique=True):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url + path, data=data, method=method)
+    if data is not None:
+        req.add_header("Content-Type", "application/json")
+    if unique:
+        # Otherwise the server coalesces the identical requests
+        req.add_header("Idempotency-Key", uuid.uuid4().hex)
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as res:
+            res.read()
+            status = res.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except OSError:
+        status = 0
+    return time.perf_counter() - start, status
+
+
+def run_endpoint(url, pid, route, args):
+    method, path, body = route
+    # Warm up the route once (imports, first connections)
+    call(url, method, path, body, args.timeout)
+    pids = process_tree(pid)
+    sampler = Sampler(pid)
+    sampler.start()
+    cpu_start = cpu_seconds(pids)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(
+            pool.map(
+                lambda _: call(
+                    url, method, path, body, args.timeout, not args.duplicates
+                ),
+                range(args.requests),
+            )
+        )
+    elapsed = time.perf_counter() - start
+    cpu = cpu_seconds(process_tree(pid)) - cpu_start
+    sampler.running = False
+    sampler.join()
+
+    latencies = [lat for lat, status in results if 200 <= status < 300]
+    errors = len(results) - len(latencies)
+    request_bytes = len(json.dumps(body)) if body is not None else 0
+    return {
+        "requests": len(results),
+        "errors": errors,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0,
+        "latency_p50_ms": (percentile(latencies, 0.50) or 0) * 1000,
+        "latency_p95_ms": (percentile(latencies, 0.95) or 0) * 1000,
+        "latency_p99_ms": (percentile(latencies, 0.99) or 0) * 1000,
+        "cpu_s": cpu,
+        "cpu_ms_per_request": cpu * 1000 / len(results),
+        "peak_rss_mb": sampler.peak / 2**20,
+        "request_kb": request_bytes / 1024,
+    }
+
+
+def git_commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=BACKEND_DIR,
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--server", choices=["dev", "sync", "gthread", "gevent"], default="sync"
+    )
+    parser.add_argument(
+        "--profile",
+        choices=["gthread", "gevent", "sync"],
+        help="Serve with this gunicorn.conf.py profile instead of --server/--workers",
+    )
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=20, help="Per endpoint")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--endpoints", nargs="*", help="Subset of endpoints to run")
+    parser.add_argument("--frames", type=int, default=10)
+    parser.add_argument(
+        "--frame-size", type=int, nargs=2, default=[640, 480], metavar=("W", "H")
+    )
+    parser.add_argument("--audio-kb", type=int, default=256)
+    parser.add_argument("--image-px", type=int, default=1024)
+    parser.add_argument("--latency", default="lognormal:0.3,0.3")
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument(
+        "--outage",
+        action="append",
+        default=[],
+        help="Upstream outage of a model, model:error=RATE,delay=SECONDS",
+    )
+    parser.add_argument(
+        "--limiter", action="store_true", help="Keep the rate limiter on"
+    )
+    parser.add_argument("--logger", action="store_true", help="Enable the app loggers")
+    parser.add_argument(
+        "--duplicates",
+        action="store_true",
+        help="Send identical requests (a retry storm) instead of distinct ones",
+    )
+    parser.add_argument("--out", help="Write the JSON results to this file")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    routes = build_routes(args)
+    names = args.endpoints or list(routes)
+    mock = start_mock(
+        latency=args.latency,
+        rate_429=args.rate_429,
+        outages=dict(parse_outage(spec) for spec in args.outage),
+    )
+    proc, url = start_server(args, mock.url, free_port())
+    results = {}
+    try:
+        for name in names:
+            calls = sum(mock.counts.values())
+            results[name] = run_endpoint(url, proc.pid, routes[name], args)
+            results[name]["upstream_calls"] = sum(mock.counts.values()) - calls
+            r = results[name]
+            print(
+                f"{name:22s} {r['throughput_rps']:7.1f} rps  "
+                f"p50 {r['latency_p50_ms']:7.0f} ms  p95 {r['latency_p95_ms']:7.0f} ms  "
+                f"p99 {r['latency_p99_ms']:7.0f} ms  cpu {r['cpu_ms_per_request']:6.1f} ms/req  "
+                f"rss {r['peak_rss_mb']:6.0f} MB  upstream {r['upstream_calls']:4d}  "
+                f"errors {r['errors']}",
+                flush=True,
+            )
+    finally:
+        proc.terminate()
+        proc.wait()
+        mock.shutdown()
+
+    report = {
+        "meta": {
+            "kind": "loadtest",
+            "commit": git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "args": vars(args),
+            "upstream_calls": mock.counts,
+        },
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+"""
+Microbenchmarks for the CPU-bound hot paths of the backend.
+
+Every `bench_*` function receives the shared fixtures and returns the callable
+to time. Each case reports ops/sec and time per op, and tracemalloc's peak and
+net allocated bytes per op, in the same JSON layout as loadtest.py.
+
+    python bench/microbench.py --out before.json
+    python bench/microbench.py --baseline before.json --threshold 0.15
+"""
+
+import argparse
+import base64
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.append(BENCH_DIR)
+sys.path.append(BACKEND_DIR)
+from compare import compare
+from loadtest import git_commit
+
+
+class Fixtures:
+    # Deterministic inputs shared by all cases, built once
+    def __init__(self, args):
+        rng = np.random.default_rng(0)
+        self.tmp = tempfile.mkdtemp(prefix="improvmate-bench-")
+
+        audio = b"\x1a\x45\xdf\xa3" + rng.bytes(args.audio_kb * 1024)
+        self.audio_url = "data:audio/webm;base64," + base64.b64encode(audio).decode()
+
+        frame = rng.integers(0, 255, (480, 640, 3), dtype=np.uint8)
+        _, buffer = cv2.imencode(".jpg", frame)
+        self.frame_url = "data:image/jpeg;base64," + base64.b64encode(buffer).decode()
+        self.frames = [self.frame_url] * args.frames
+
+        drawing = rng.integers(
+            0, 255, (args.image_px, args.image_px, 3), dtype=np.uint8
+        )
+        _, buffer = cv2.imencode(".png", drawing)
+        self.image_b64 = base64.b64encode(buffer).decode()
+
+        self.body = json.dumps(
+            {
+                "audio": {"audio": self.audio_url, "language": "en"},
+                "frames": self.frames,
+                "story": "Once upon a time. " * 200,
+            }
+        ).encode()
+
+        self.video_path = os.path.join(self.tmp, "clip.mp4")
+        writer = cv2.VideoWriter(
+            self.video_path, cv2.VideoWriter_fourcc(*"mp4v"), 30, (320, 240)
+        )
+        for i in range(args.video_frames):
+            writer.write(np.roll(frame[:240, :320], i * 4, axis=1))
+        writer.release()
+
+        # 10 s performance: a bright blob crossing a noisy 640x480 scene,
+        # as 300 ms frontend frames and as a 30 fps video
+        self.motion_frames, self.motion_video = [], os.path.join(self.tmp, "10s.mp4")
+        writer = cv2.VideoWriter(
+            self.motion_video, cv2.VideoWriter_fourcc(*"mp4v"), 30, (640, 480)
+        )
+        scene = rng.integers(0, 64, (480, 640, 3), dtype=np.uint8)
+        for i in range(300):
+            image = scene.copy()
+            cv2.circle(image, (40 + i * 2, 240 + (i % 60) - 30), 40, (255,) * 3, -1)
+            writer.write(image)
+            if i % 9 == 0:
+                _, buffer = cv2.imencode(".jpg", image)
+                self.motion_frames.append(
+                    "data:image/jpeg;base64," + base64.b64encode(buffer).decode()
+                )
+        writer.release()
+
+        self.completion = {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "created": 0,
+            "model": "gpt-4o",
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {
+                        "role": "assistant",
+                        "content": json.dumps({"text": "Once upon a time. " * 100}),
+                    },
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        }
+
+
+def bench_b64decode_audio(fx):
+    return lambda: base64.b64decode(fx.audio_url.split(",")[1])
+
+
+def bench_b64decode_frames(fx):
+    return lambda: [base64.b64decode(frame.split(",", 1)[1]) for frame in fx.frames]
+
+
+def bench_request_get_json(fx):
+    from flask import Flask, request
+
+    app = Flask(__name__)
+
+    def run():
+        with app.test_request_context(
+            "/", method="POST", data=fx.body, content_type="application/json"
+        ):
+            return request.get_json()
+
+    return run
+
+
+def bench_save_base64_image(fx):
+    from utils import save_base64_image
+
+    path = os.path.join(fx.tmp, "img.png")
+    return lambda: save_base64_image(fx.image_b64, path)
+
+
+def bench_image_store_save(fx):
+    # Replacement of save_base64_image in /api/image, repeated uploads dedupe
+    from images import ImageStore
+
+    store = ImageStore(os.path.join(fx.tmp, "images"))
+    return lambda: store.save_bytes(base64.b64decode(fx.image_b64))
+
+
+def bench_normalize_drawing(fx):
+    from character import make_photo
+    from drawing import normalize_drawing
+
+    photo = make_photo(np.random.default_rng(0), (4032, 3024))
+    return lambda: normalize_drawing(photo)
+
+
+def bench_sample_frames(fx):
+    from utils import sample_frames
+
+    return lambda: sample_frames(fx.video_path, n_frames=10)
+
+
+def bench_motion_frames(fx):
+    # Must stay far below the 10 s of performance it analyzes
+    from motion import analyze_motion
+
+    return lambda: analyze_motion(fx.motion_frames)
+
+
+def bench_motion_video(fx):
+    from motion import analyze_motion, read_video
+
+    def run():
+        frames, interval = read_video(fx.motion_video)
+        return analyze_motion(frames, interval=interval)
+
+    return run
+
+
+def bench_pack_frames(fx):
+    # Tiling, labels and encoding of 16 already decoded frames
+    from mosaic import pack_frames
+
+    frames = [
+        cv2.imdecode(
+            np.frombuffer(base64.b64decode(f.split(",", 1)[1]), np.uint8),
+            cv2.IMREAD_COLOR,
+        )
+        for f in (fx.motion_frames * 2)[:16]
+    ]
+    return lambda: pack_frames(frames, grid=(4, 4), tile=(256, 192))
+
+
+def bench_pack_frames_decode(fx):
+    from mosaic import pack_frames
+
+    frames = (fx.motion_frames * 2)[:16]
+    return lambda: pack_frames(frames, grid=(4, 4), tile=(256, 192))
+
+
+def bench_semantic_lookup(fx):
+    # Near-duplicate lookup in a 100k entry index, must stay sub-millisecond
+    from semcache import SemanticCache
+
+    rng = np.random.default_rng(1)
+    words = [f"w{i}" for i in range(5000)]
+    path = os.path.join(fx.tmp, "semantic.jsonl")
+    cache = SemanticCache(path, {"bench": {"threshold": 0.85}})
+    with open(path, "w") as f:
+        for i in range(100000):
+            text = " ".join(rng.choice(words, 40))
+            sig = cache.hasher.signature(text)
+            f.write(
+                json.dumps(
+                    {
+                        "key": str(i),
+                        "method": "bench",
+                        "ns": "",
+                        "sig": sig.tobytes().hex(),
+                        "value": i,
+                        "time": 0,
+                    }
+                )
+                + "\n"
+            )
+    query = text.replace("w", "x", 2)
+    return lambda: cache.lookup("bench", query)
+
+
+def bench_model_dump_json(fx):
+    from openai.types.chat import ChatCompletion
+
+    response = ChatCompletion.model_validate(fx.completion)
+    return lambda: json.loads(response.model_dump_json())["choices"][0]["message"][
+        "content"
+    ]
+
+
+def measure(fn, min_time, min_rounds):
+    fn()  # Warm up
+    times = []
+    start = time.perf_counter()
+    while len(times) < min_rounds or time.perf_counter() - start < min_time:
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    result = fn()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    median = statistics.median(times)
+    return {
+        "rounds": len(times),
+        "ops_per_s": 1 / median if median else 0,
+        "median_ms": median * 1000,
+        "min_ms": min(times) * 1000,
+        "peak_alloc_kb": (peak - before) / 1024,
+        "retained_kb": (current - before) / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("-k", help="Only run cases whose name contains this")
+    parser.add_argument("--min-time", type=float, default=1.0)
+    parser.add_argument("--min-rounds", type=int, default=5)
+    parser.add_argument("--audio-kb", type=int, default=512)
+    parser.add_argument("--frames", type=int, default=10)
+    parser.add_argument("--image-px", type=int, default=1024)
+    parser.add_argument("--video-frames", type=int, default=150)
+    parser.add_argument("--out", help="Write the JSON results to this file")
+    parser.add_argument("--baseline", help="Fail on regressions against this file")
+    parser.add_argument("--threshold", type=float, default=0.15)
+    args = parser.parse_args()
+
+    fx = Fixtures(args)
+    cases = {
+        name[len("bench_") :]: fn
+        for name, fn in sorted(globals().items())
+        if name.startswith("bench_") and (not args.k or args.k in name)
+    }
+    results = {}
+    try:
+        for name, case in cases.items():
+            results[name] = measure(case(fx), args.min_time, args.min_rounds)
+            r = results[name]
+            print(
+                f"{name:22s} {r['ops_per_s']:10.1f} ops/s  {r['median_ms']:9.3f} ms  "
+                f"peak {r['peak_alloc_kb']:10.1f} KB  retained {r['retained_kb']:9.1f} KB",
+                flush=True,
+            )
+    finally:
+        shutil.rmtree(fx.tmp, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "kind": "microbench",
+            "commit": git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        _, regressions = compare(baseline, report, args.threshold)
+        # Retained memory is noisy for cases that return their result
+        regressions = [r for r in regressions if r[1] != "retained_kb"]
+        for name, metric, old, new, worse in regressions:
+            print(f"REGRESSION {name} {metric}: {old:.3f} -> {new:.3f} ({worse:+.1%})")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
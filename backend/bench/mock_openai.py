@@ -0,0 +1,362 @@
+"""
+Local stand-in for the OpenAI API used by the benchmarks.
+
+Serves the endpoints the Storyteller uses (chat completions with and without
+streaming, image generation, speech and transcription) with a configurable
+latency distribution, 429 injection and per model outages (5xx errors and
+delays). Every chat completion answers the same JSON object, which contains the
+keys of all Storyteller prompts.
+
+    python bench/mock_openai.py --port 8999 --latency lognormal:0.8,0.4 --rate-429 0.02
+    python bench/mock_openai.py --outage gpt-4o:error=0.9,delay=10
+
+Point the backend at it with OPENAI_BASE_URL=http://127.0.0.1:8999/v1.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PART = {
+    "text": "Johnny followed the noise into the kitchen and found the fridge wide open.",
+    "keymoment": "An open fridge glowing in a dark kitchen, a can of tuna on the floor.",
+    "sentiment": "shocking",
+    "who": ["Johnny"],
+    "where": "kitchen",
+    "objects": ["fridge", "tuna"],
+}
+CHARACTER = {
+    "fullname": "Johnny the cat",
+    "shortname": "Johnny",
+    "likes": ["tuna", "playing"],
+    "dislikes": ["dogs", "water"],
+    "fears": ["being hungry"],
+    "personality": ["friendly", "gluttonous", "playful"],
+    "backstory": "Johnny the cat loves tuna and is always looking for food.",
+}
+COMPLETION = {
+    **PART,
+    "part": PART,
+    "list": [
+        {
+            "title": f"Option {i}",
+            "desc": "Johnny decides to investigate the noise.",
+            "who": "The Pope",
+            "where": "A haunted house",
+            "what": "He found a secret passage in the basement.",
+            "happy": "He uncovers a hidden treasure.",
+            "sad": "He finds an old letter.",
+            "absurd": "The basement leads to a disco.",
+            "catastrophic": "The passage collapses.",
+        }
+        for i in range(6)
+    ],
+    "actions": [
+        {"title": f"Action {i}", "desc": "Johnny decides to follow the trail."}
+        for i in range(4)
+    ],
+    "image": {
+        "items": [{"name": "cat", "importance": 0.9}],
+        "content": "A cat looking at a food bowl.",
+        "style": "Simple crayon drawing with bright colors.",
+        "colors": [{"color": "black", "usage": "the cat is black"}],
+    },
+    "character": CHARACTER,
+    "premise": {"title": "Rescue Mission", "desc": "Johnny must find the tuna."},
+    "title": "Retreating Step",
+    "description": "The performer takes a slow, hesitant step backward.",
+    "desc": "The performer takes a slow, hesitant step backward.",
+    "emotion": "Fearful",
+    "action": "Retreating",
+    "keywords": ["step back", "hesitation"],
+    "original": "Hello",
+    "translation": "Ciao",
+    "old_prompt": "A cat.",
+    "new_prompt": "Childlike drawing with vivid colors of a cat looking at a food bowl.",
+    "head": ["Story Part", "Who", "Where", "Objects"],
+    "body": [[1, "Johnny", "kitchen", "tuna"]],
+    "questions": [{"text": f"3 things to do on day {i}..."} for i in range(50)],
+    "analytics": [],
+}
+# Vocabulary of the distinct list items of list prompts
+WORDS = (
+    "cat dog dragon knight princess robot wizard ghost pirate turtle clown owl "
+    "castle forest kitchen desert island cave tower river market moon ship "
+    "finds loses builds steals hides chases rescues opens breaks sings eats "
+    "treasure letter map key cake lantern crown mirror door song storm party"
+).split()
+
+# 1x1 transparent PNG
+PNG = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082"
+)
+
+
+def parse_latency(spec):
+    # "fixed:0.5", "uniform:0.2,1.0", "normal:0.8,0.2" or "lognormal:median,sigma"
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v] or [0.0]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda: max(random.gauss(values[0], values[1]), 0.0)
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def parse_outage(spec):
+    # "model:error=0.9,delay=10" -> ("model", {"error": 0.9, "delay": 10.0})
+    model, _, args = spec.rpartition(":")
+    params = dict(arg.split("=") for arg in args.split(",") if arg)
+    return model, {key: float(value) for key, value in params.items()}
+
+
+class MockOpenAI(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        latency="fixed:0",
+        rate_429=0.0,
+        stream_chunks=20,
+        item_time=0.0,
+        outages=None,
+    ):
+        super().__init__(address, MockHandler)
+        self.latency = parse_latency(latency)
+        self.rate_429 = rate_429
+        # Model -> {"error": share of 503s, "delay": extra seconds}, may be
+        # changed while serving to start or end an outage
+        self.outages = outages or {}
+        self.stream_chunks = stream_chunks
+        self.item_time = item_time
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def __send(self, status, body, content_type="application/json", headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+    def do_GET(self):
+        if self.path.endswith(".png"):
+            return self.__send(200, PNG, "image/png")
+        self.__send(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length) if length else b""
+        server = self.server
+        endpoint = self.path.split("/v1/")[-1]
+        server.count(endpoint)
+
+        if random.random() < server.rate_429:
+            server.count("429")
+            time.sleep(0.01)
+            return self.__send(
+                429,
+                {"error": {"message": "Rate limit reached", "type": "requests"}},
+                headers={"Retry-After": "1"},
+            )
+
+        try:
+            body = json.loads(raw or b"{}")
+        except ValueError:
+            body = {}  # Multipart upload (transcriptions)
+        outage = server.outages.get(body.get("model"))
+        if outage:
+            time.sleep(outage.get("delay", 0.0))
+            if random.random() < outage.get("error", 0.0):
+                server.count("outage")
+                return self.__send(
+                    503,
+                    {
+                        "error": {
+                            "message": "The server is overloaded",
+                            "type": "server_error",
+                        }
+                    },
+                )
+
+        time.sleep(server.latency())
+        if endpoint == "chat/completions":
+            if body.get("stream"):
+                return self.__stream_chat(body, len(raw))
+            return self.__send(200, self.__chat(body, len(raw)))
+        if endpoint == "images/generations":
+            host, port = server.server_address[:2]
+            return self.__send(
+                200,
+                {
+                    "created": int(time.time()),
+                    "data": [{"url": f"http://{host}:{port}/img.png"}],
+                },
+            )
+        if endpoint == "audio/transcriptions":
+            return self.__send(200, {"text": "Where is it? I heard something."})
+        if endpoint == "audio/speech":
+            self.send_response(200)
+            self.send_header("Content-Type", "audio/ogg")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for _ in range(8):
+                self.__chunk(os.urandom(4096))
+            self.wfile.write(b"0\r\n\r\n")
+            return
+        self.__send(404, {"error": {"message": f"Unknown endpoint {endpoint}"}})
+
+    def __chat(self, body, size):
+        # List prompts ("Generate N ...") get N list items per choice, each
+        # choice different, and item_time seconds of decoding per item. The
+        # n choices are decoded in parallel, as upstream.
+        n = int(body.get("n") or 1)
+        prompt = json.dumps(body.get("messages", []))
+        asked = re.search(r"[Gg]enerate (\d+) ", prompt)
+        contents = []
+        for i in range(n):
+            completion = COMPLETION
+            if asked:
+                k = int(asked.group(1))
+                items = [
+                    {key: " ".join(random.sample(WORDS, 8)) for key in item}
+                    for item in (COMPLETION["list"] * k)[:k]
+                ]
+                completion = {**COMPLETION, "list": items}
+            contents.append(json.dumps(completion))
+        if asked:
+            time.sleep(self.server.item_time * int(asked.group(1)))
+        # Completions longer than max_tokens (~4 chars per token) are cut
+        limit = body.get("max_tokens") or float("inf")
+        sizes = [min(len(content) // 4, limit) for content in contents]
+        contents = [
+            content[: tokens * 4] if tokens == limit else content
+            for content, tokens in zip(contents, sizes)
+        ]
+        prompt_tokens = size // 4
+        completion_tokens = sum(sizes)
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [
+                {
+                    "index": i,
+                    "message": {"role": "assistant", "content": contents[i]},
+                    "finish_reason": "length" if sizes[i] == limit else "stop",
+                }
+                for i in range(n)
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def __stream_chat(self, body, size):
+        content = json.dumps(COMPLETION)
+        step = max(len(content) // self.server.stream_chunks, 1)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        cid = f"chatcmpl-{uuid.uuid4().hex}"
+        for i in range(0, len(content), step):
+            chunk = {
+                "id": cid,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get("model", "mock"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": content[i : i + step]},
+                        "finish_reason": None,
+                    }
+                ],
+            }
+            self.__chunk(b"data: " + json.dumps(chunk).encode() + b"\n\n")
+            time.sleep(0.005)
+        done = {
+            "id": cid,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        }
+        self.__chunk(b"data: " + json.dumps(done).encode() + b"\n\n")
+        self.__chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def start_mock(host="127.0.0.1", port=0, **kwargs):
+    # Start the mock server in a background thread, returns the server
+    server = MockOpenAI((host, port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8999)
+    parser.add_argument("--latency", default="lognormal:0.8,0.4")
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--stream-chunks", type=int, default=20)
+    parser.add_argument("--item-time", type=float, default=0.0)
+    parser.add_argument(
+        "--outage",
+        action="append",
+        default=[],
+        help="model:error=RATE,delay=SECONDS, may be repeated",
+    )
+    args = parser.parse_args()
+
+    server = MockOpenAI(
+        (args.host, args.port),
+        latency=args.latency,
+        rate_429=args.rate_429,
+        stream_chunks=args.stream_chunks,
+        item_time=args.item_time,
+        outages=dict(parse_outage(spec) for spec in args.outage),
+    )
+    print(f"Mock OpenAI API on {server.url}")
+    server.serve_forever()
@@ -0,0 +1,203 @@
+"""
+Cold start of the backend: import time per module, time until gunicorn
+serves its first request, latency of the first LLM-backed request and
+memory (PSS) of the master and workers, for the lazy app factory and for
+gunicorn --preload. LLM calls go to the local OpenAI stand-in.
+
+    python bench/startup.py --workers 2 --repeat 3
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.append(BENCH_DIR)
+from loadtest import free_port, git_commit, process_tree
+from mock_openai import start_mock
+
+MODES = {
+    "lazy": ["app:create_app()"],
+    "preload": ["--preload", "app:create_app(preload=True)"],
+}
+
+
+def import_times(env, top):
+    # Cumulative import time of the modules imported by app.py itself
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=BACKEND_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    # Modules are listed after their own imports, indented by depth
+    modules, pending = {}, {}
+    for line in out.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 0:
+            if name.strip() == "app":
+                modules = {"app": int(cumulative) / 1000, **pending}
+            pending = {}
+        elif depth == 1:
+            pending[name.strip()] = int(cumulative) / 1000
+    ranked = sorted(modules.items(), key=lambda item: -item[1])
+    return dict(ranked[:top])
+
+
+def pss_mb(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/smaps_rollup") as f:
+                for line in f:
+                    if line.startswith("Pss:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total / 1024
+
+
+def post(url, body):
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(body).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=60) as response:
+        return response.read()
+
+
+def cold_start(mode, args, env):
+    # Fresh working directory, so caches and stores start empty
+    workdir = tempfile.mkdtemp(prefix="startup-")
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    cmd = [
+        sys.executable,
+        "-m",
+        "gunicorn",
+        "-b",
+        f"127.0.0.1:{port}",
+        "-w",
+        str(args.workers),
+        "-k",
+        "gthread",
+        "--threads",
+        "4",
+        "--pythonpath",
+        BACKEND_DIR,
+        *MODES[mode],
+    ]
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        cmd,
+        cwd=workdir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=None if args.verbose else subprocess.DEVNULL,
+    )
+    try:
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError(f"gunicorn exited with code {proc.returncode}")
+            try:
+                urllib.request.urlopen(url + "/", timeout=1).read()
+                break
+            except OSError:
+                time.sleep(0.01)
+        ready = time.perf_counter() - start
+
+        hints = {"context": {"complexity": None}}
+        begin = time.perf_counter()
+        post(url + "/api/story/hints", hints)
+        first_llm = time.perf_counter() - begin
+
+        # Reach every worker before measuring memory
+        with ThreadPoolExecutor(args.workers * 4) as pool:
+            list(
+                pool.map(
+                    lambda _: post(url + "/api/story/hints", hints),
+                    range(args.workers * 8),
+                )
+            )
+        memory = pss_mb(process_tree(proc.pid))
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {"ready_s": ready, "first_llm_s": first_llm, "pss_mb": memory}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--latency", default="fixed:0.05")
+    parser.add_argument("--top", type=int, default=15, help="Modules to report")
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--out", help="Write the JSON results to this file")
+    args = parser.parse_args()
+
+    mock = start_mock(latency=args.latency)
+    env = {
+        **os.environ,
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": mock.url,
+        "LIMITER": "False",
+        "LOGGER": "False",
+    }
+
+    modules = import_times(env, args.top)
+    print("import time (cumulative ms)")
+    for name, ms in modules.items():
+        print(f"  {name:30s} {ms:8.1f}")
+
+    results = {}
+    for mode in MODES:
+        runs = [cold_start(mode, args, env) for _ in range(args.repeat)]
+        results[mode] = {
+            key: statistics.median(run[key] for run in runs) for key in runs[0]
+        }
+        r = results[mode]
+        print(
+            f"{mode:8s} ready {r['ready_s']:6.2f} s  first LLM request "
+            f"{r['first_llm_s']:6.2f} s  PSS {r['pss_mb']:7.1f} MB",
+            flush=True,
+        )
+    mock.shutdown()
+
+    report = {
+        "meta": {
+            "kind": "startup",
+            "commit": git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "args": vars(args),
+        },
+        "import_ms": modules,
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+import threading
+import time
+from collections import deque
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitOpen(Exception):
+    # Raised instead of calling an upstream whose breaker is open
+    def __init__(self, message, retry_after=0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def counts_as_failure(error):
+    # Upstream health, not request problems: connection errors, timeouts,
+    # 429 and 5xx count, other 4xx (bad request, auth...) do not. `error` is
+    # an exception or the HTTP status of a failed response.
+    status = error if isinstance(error, int) else getattr(error, "status_code", None)
+    return status is None or status == 429 or status >= 500
+
+
+class CircuitBreaker:
+    # Health of one upstream (model and endpoint) from the outcomes of the
+    # last `window` seconds. Opens when at least `min_calls` were made and
+    # the failure or slow-call rate reaches its threshold, then fails fast.
+    # After `cooldown` seconds it is probed: with `probe` (a cheap upstream
+    # call) in a background thread, otherwise by letting one real call
+    # through (half open). A failed probe doubles the cooldown, up to
+    # `max_cooldown`; a successful one closes the breaker. Errors of the
+    # `ignore` types (raised locally, not by the upstream) are not counted.
+    def __init__(
+        self,
+        name,
+        window=60,
+        min_calls=5,
+        error_rate=0.5,
+        slow_call=30,
+        slow_rate=0.8,
+        cooldown=15,
+        max_cooldown=300,
+        probe=None,
+        ignore=(),
+    ):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.probe = probe
+        self.ignore = ignore
+        self.lock = threading.Lock()
+        self.calls = deque()  # (time, failed, slow)
+        self.state = CLOSED
+        self.cooldown = cooldown
+        self.retry_at = 0.0
+        self.trial = None  # Start time of the half-open trial call in flight
+        self.opened = 0
+        self.rejected = 0
+        self.changed = time.time()
+
+    def __set(self, state):
+        self.state = state
+        self.changed = time.time()
+
+    def __trim(self, now):
+        while self.calls and self.calls[0][0] < now - self.window:
+            self.calls.popleft()
+
+    def __open(self, now):
+        self.__set(OPEN)
+        self.opened += 1
+        self.retry_at = now + self.cooldown
+        self.calls.clear()
+        if self.probe:
+            threading.Thread(
+                target=self.__probe_later, name=f"probe-{self.name}", daemon=True
+            ).start()
+
+    def __probe_later(self):
+        while True:
+            time.sleep(max(self.retry_at - time.time(), 0))
+            try:
+                self.probe()
+                healthy = True
+            except self.ignore:
+                healthy = None  # No answer from the upstream, probe again
+            except Exception as e:
+                healthy = not counts_as_failure(e)
+            with self.lock:
+                if self.state != OPEN:
+                    return
+                if healthy:
+                    self.__set(CLOSED)
+                    self.cooldown = self.base_cooldown
+                    return
+                if healthy is False:
+                    self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+                self.retry_at = time.time() + self.cooldown
+
+    def __admits(self, now):
+        # Whether a call would be let through now
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            return not self.probe and now >= self.retry_at
+        # A trial whose outcome never came (abandoned stream) is replaced
+        return self.trial is None or now - self.trial > self.slow_call
+
+    def retry_in(self):
+        # Seconds until calls are let through again, None if they are now
+        with self.lock:
+            now = time.time()
+            if self.__admits(now):
+                return None
+            return max(self.retry_at - now, 1)
+
+    def allow(self):
+        # Let a call go upstream, raises CircuitOpen if the breaker is open
+        with self.lock:
+            if self.state == CLOSED:
+                return
+            now = time.time()
+            if not self.__admits(now):
+                self.rejected += 1
+                retry = max(self.retry_at - now, 1)
+                raise CircuitOpen(
+                    f"Circuit breaker for {self.name} is {self.state}, "
+                    f"retry in {retry:.0f}s",
+                    retry,
+                )
+            self.__set(HALF_OPEN)
+            self.trial = now
+
+    def record(self, latency, error=None):
+        # Outcome of a call let through by allow(), error None on success
+        with self.lock:
+            now = time.time()
+            if isinstance(error, self.ignore):
+                self.trial = None
+                return
+            failed = error is not None and counts_as_failure(error)
+            if self.state == HALF_OPEN and self.trial is not None:
+                self.trial = None
+                if failed:
+                    self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+                    self.__open(now)
+                else:
+                    self.__set(CLOSED)
+                    self.cooldown = self.base_cooldown
+                return
+            if self.state != CLOSED:
+                return
+            self.calls.append((now, failed, latency >= self.slow_call))
+            self.__trim(now)
+            total = len(self.calls)
+            if total < self.min_calls:
+                return
+            failures = sum(1 for _, failed, _ in self.calls if failed)
+            slow = sum(1 for _, _, slow in self.calls if slow)
+            if failures / total >= self.error_rate or slow / total >= self.slow_rate:
+                self.__open(now)
+
+    def stats(self):
+        with self.lock:
+            now = time.time()
+            self.__trim(now)
+            total = len(self.calls)
+            return {
+                "state": self.state,
+                "since": round(now - self.changed, 1),
+                "calls": total,
+                "error_rate": (
+                    sum(1 for _, failed, _ in self.calls if failed) / total
+                    if total
+                    else None
+                ),
+                "slow_rate": (
+                    sum(1 for _, _, slow in self.calls if slow) / total
+                    if total
+                    else None
+                ),
+                "opened": self.opened,
+                "rejected": self.rejected,
+                "retry_in": (
+                    round(max(self.retry_at - now, 0), 1)
+                    if self.state != CLOSED
+                    else None
+                ),
+            }
+
+
+class Breakers:
+    # One CircuitBreaker per (model, endpoint), created on first use with
+    # the shared settings; `probes` maps an endpoint to a function of the
+    # model that makes a cheap upstream call
+    def __init__(self, probes=None, **settings):
+        self.probes = probes or {}
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.breakers = {}
+
+    def get(self, model, endpoint):
+        key = f"{model}:{endpoint}"
+        with self.lock:
+            breaker = self.breakers.get(key)
+            if breaker is None:
+                probe = self.probes.get(endpoint)
+                breaker = CircuitBreaker(
+                    key,
+                    probe=(lambda: probe(model)) if probe else None,
+                    **self.settings,
+                )
+                self.breakers[key] = breaker
+            return breaker
+
+    def stats(self):
+        with self.lock:
+            breakers = dict(self.breakers)
+        return {key: breaker.stats() for key, breaker in breakers.items()}
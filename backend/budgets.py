@@ -0,0 +1,147 @@
+import json
+import math
+import os
+import threading
+import uuid
+from collections import deque
+
+try:
+    import fcntl
+except ImportError:  # Windows, compactions are not serialized across workers
+    fcntl = None
+
+
+class TokenBudgets:
+    # Output token budget (max_tokens) per Storyteller method. It starts at
+    # `initial` (sized from the method's output schema) and, once the method
+    # has `min_samples` complete responses, follows the `quantile` of their
+    # last `window` completion sizes plus `headroom`, within [floor, limit].
+    # Like SemanticCache, sizes are appended to a JSON lines file that every
+    # worker follows, so budgets are shared and survive restarts. When the
+    # file passes `max_bytes` it is rewritten with the kept sizes only (sizes
+    # appended meanwhile by other workers may be lost, which is harmless).
+    def __init__(
+        self,
+        path,
+        initial,
+        default=4096,
+        limit=4096,
+        floor=64,
+        quantile=0.99,
+        headroom=0.25,
+        window=500,
+        min_samples=20,
+        max_bytes=1024 * 1024,
+    ):
+        self.path = path
+        self.initial = initial
+        self.default = default
+        self.limit = limit
+        self.floor = floor
+        self.quantile = quantile
+        self.headroom = headroom
+        self.window = window
+        self.min_samples = min_samples
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.sizes = {}  # Method -> recent completion sizes
+        self.counts = {}  # Method -> {event: count} of this worker
+        self.inode = None
+        self.offset = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self.lock:
+            self.__follow()
+
+    def __follow(self):
+        # Load the sizes appended since the last read, all of them again if
+        # the file was compacted (replaced) in the meantime
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != self.inode:
+                self.inode, self.offset, self.sizes = stat.st_ino, 0, {}
+            if stat.st_size <= self.offset:
+                return
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # Partially written, read it next time
+                self.offset += len(line)
+                try:
+                    entry = json.loads(line)
+                    self.__add(entry["method"], int(entry["tokens"]))
+                except (ValueError, KeyError, TypeError):
+                    continue
+
+    def __add(self, method, tokens):
+        sizes = self.sizes.get(method)
+        if sizes is None:
+            sizes = self.sizes[method] = deque(maxlen=self.window)
+        sizes.append(tokens)
+
+    def __compact(self):
+        with open(f"{self.path}.lock", "a") as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            self.__follow()
+            if self.offset <= self.max_bytes:
+                return  # Another worker compacted it
+            tmp = f"{self.path}.{uuid.uuid4().hex}"
+            with open(tmp, "w") as f:
+                for method, sizes in self.sizes.items():
+                    for tokens in sizes:
+                        f.write(json.dumps({"method": method, "tokens": tokens}) + "\n")
+            os.replace(tmp, self.path)
+            self.__follow()
+
+    def __count(self, method, event):
+        counts = self.counts.setdefault(method, {})
+        counts[event] = counts.get(event, 0) + 1
+
+    def __budget(self, method):
+        sizes = self.sizes.get(method)
+        if not sizes or len(sizes) < self.min_samples:
+            budget = self.initial.get(method, self.default)
+        else:
+            ordered = sorted(sizes)
+            index = min(int(len(ordered) * self.quantile), len(ordered) - 1)
+            budget = math.ceil(ordered[index] * (1 + self.headroom))
+        return min(max(budget, self.floor), self.limit)
+
+    def budget(self, method):
+        with self.lock:
+            self.__follow()
+            return self.__budget(method)
+
+    def observe(self, method, tokens):
+        # Completion size of a complete (not truncated) response
+        if not method:
+            return
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps({"method": method, "tokens": round(tokens)}) + "\n")
+            self.__follow()
+            if self.offset > self.max_bytes:
+                self.__compact()
+
+    def truncated(self, method, retried):
+        with self.lock:
+            self.__count(method or "unknown", "retried" if retried else "truncated")
+
+    def stats(self):
+        with self.lock:
+            self.__follow()
+            stats = {}
+            for method in sorted(set(self.sizes) | set(self.counts)):
+                ordered = sorted(self.sizes.get(method, ()))
+                stats[method] = {
+                    "budget": self.__budget(method),
+                    "samples": len(ordered),
+                    "p50": ordered[len(ordered) // 2] if ordered else None,
+                    "max": ordered[-1] if ordered else None,
+                    **self.counts.get(method, {}),
+                }
+            return stats
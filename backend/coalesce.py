@@ -0,0 +1,172 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows, file locks then only hold within the process
+    fcntl = None
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    # Concurrent calls with the same key run once: the first caller does the
+    # work, the others wait for it and share its result (or its exception)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn, timeout=None):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.calls[key] = call
+
+        if not leader:
+            if not call.done.wait(timeout):
+                raise TimeoutError(f"Timed out waiting for {key}")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+
+_file_locks = {}  # Path -> [in-process lock, users]
+_file_locks_guard = threading.Lock()
+
+
+@contextmanager
+def file_lock(path, timeout=None, poll=0.05):
+    # Exclusive lock on `path` across the threads (or greenlets) of this
+    # process and the other workers. Callers first queue on an in-process
+    # lock, then poll a non-blocking flock: a blocking flock would stall the
+    # whole worker under gevent, the holder included. Yields the open lock
+    # file, or None when the lock was not had within `timeout` seconds.
+    with _file_locks_guard:
+        entry = _file_locks.setdefault(path, [threading.Lock(), 0])
+        entry[1] += 1
+    expires = None if timeout is None else time.monotonic() + max(timeout, 0)
+    acquired = entry[0].acquire(timeout=-1 if timeout is None else max(timeout, 0))
+    f = None
+    try:
+        if acquired:
+            f = open(path, "a")
+            while fcntl is not None:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if expires is not None and time.monotonic() >= expires:
+                        f.close()
+                        f = None
+                        break
+                    time.sleep(poll)
+        yield f
+    finally:
+        if f is not None:
+            f.close()
+        if acquired:
+            entry[0].release()
+        with _file_locks_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del _file_locks[path]
+
+
+class RequestCoalescer:
+    # Single flight across the threads and gunicorn workers of a server. The
+    # first caller of a key claims it with an exclusive marker file and
+    # computes; duplicates poll until its result is stored (in `store`, a
+    # respcache.DiskTier) and replay it for `ttl` seconds. A result that was
+    # not stored (an error) lets the next duplicate claim the key and retry.
+    # Claim markers live in their own subfolder, out of reach of the
+    # store's sweeps.
+    def __init__(self, store, ttl, poll=0.05, logger=None):
+        self.store = store
+        self.ttl = ttl
+        self.poll = poll
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.pending = os.path.join(store.folder, "pending")
+        os.makedirs(self.pending, exist_ok=True)
+
+    def __marker(self, key):
+        return os.path.join(self.pending, f"{key}.pending")
+
+    def __try_claim(self, key, stale):
+        path = self.__marker(key)
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            pass
+        try:
+            if time.time() - os.stat(path).st_mtime > stale:
+                os.remove(path)  # Left behind by a worker that died
+        except FileNotFoundError:
+            pass
+        return False
+
+    def count(self, name, event):
+        with self.lock:
+            counts = self.counts.setdefault(name, {})
+            counts[event] = counts.get(event, 0) + 1
+
+    def claim(self, name, key, timeout):
+        # ("replay", value) with the stored result, or ("lead", None) when the
+        # caller must compute it and then call finish(). Raises TimeoutError
+        # if another caller is still computing after `timeout` seconds.
+        expires = time.time() + timeout
+        waited = False
+        while True:
+            value = self.store.get(key)
+            if value is not None:
+                self.count(name, "waited" if waited else "replayed")
+                return "replay", value
+            if self.__try_claim(key, timeout):
+                self.count(name, "led")
+                return "lead", None
+            if time.time() > expires:
+                self.count(name, "timeouts")
+                raise TimeoutError(f"{name} {key} is still in progress")
+            waited = True
+            time.sleep(self.poll)
+
+    def finish(self, key, value=None):
+        # Release a claimed key, storing its result unless it is None. A
+        # result that cannot be stored is only not replayed.
+        try:
+            if value is not None:
+                self.store.put(key, value, self.ttl)
+        except OSError as e:
+            if self.logger:
+                self.logger.warning("Could not store the result of %s: %s", key, e)
+        finally:
+            try:
+                os.remove(self.__marker(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {name: dict(counts) for name, counts in self.counts.items()}
@@ -6,18 +6,274 @@ MODEL_GPT3 = "gpt-3.5-turbo"
 MODEL_IMAGE_GEN = "dall-e-2"
 MODEL_TTS = "tts-1"
 MODEL_STT = "whisper-1"
+# Model tried next when a call fails or the model's circuit breaker is open,
+# for the methods without a route
+MODEL_FALLBACKS = {
+    MODEL_GPT4: MODEL_GPT4MINI,
+    MODEL_VISION: MODEL_GPT4MINI,
+}
+# USD per million (prompt, completion) tokens, list prices for cost ceilings
+MODEL_PRICES = {
+    MODEL_GPT4: (2.50, 10.00),
+    MODEL_GPT4MINI: (0.15, 0.60),
+    MODEL_GPT3: (0.50, 1.50),
+}
+
+# Model routes per Storyteller method: preferred model first, then the
+# acceptable alternates, a latency SLO (p95 seconds) and a cost ceiling (USD
+# per call). Other methods use MODEL_GPT4 (hq) or MODEL_GPT4MINI (lq) and
+# MODEL_FALLBACKS. ROUTES_FILE (JSON, same shape) overrides routes, and is
+# reloaded by every worker when it changes.
+ROUTES = {
+    "translate_text": {
+        "models": [MODEL_GPT4MINI, MODEL_GPT3],
+        "slo": 3,
+        "max_cost": 0.002,
+    },
+    "translate_keypoints": {
+        "models": [MODEL_GPT4MINI, MODEL_GPT3],
+        "slo": 3,
+        "max_cost": 0.002,
+    },
+    "improve_prompt": {
+        "models": [MODEL_GPT4MINI, MODEL_GPT3],
+        "slo": 5,
+        "max_cost": 0.002,
+    },
+    "generate_init_hints": {
+        "models": [MODEL_GPT4, MODEL_GPT4MINI],
+        "slo": 8,
+        "max_cost": 0.02,
+    },
+    "generate_end_hints": {
+        "models": [MODEL_GPT4, MODEL_GPT4MINI],
+        "slo": 8,
+        "max_cost": 0.02,
+    },
+}
+ROUTES_FILE = "routes.json"
+ROUTES_RELOAD = 5  # Seconds between checks of ROUTES_FILE
+ROUTER_WINDOW = 300  # Seconds of calls the latency and error stats cover
+ROUTER_MIN_CALLS = 5  # Calls needed before the stats of a model count
+ROUTER_MAX_ERROR_RATE = 0.2  # Models failing more often are tried last
+
+# Output token budgets (max_tokens) per Storyteller method. A method starts at
+# its BUDGET_INITIAL (sized from its output schema, BUDGET_LIMIT if unlisted),
+# then follows the BUDGET_QUANTILE of its recent completion sizes plus
+# BUDGET_HEADROOM. A completion cut at the budget is sent again with twice it.
+BUDGET_INITIAL = {
+    "translate_text": 1024,  # Original and translation of a story part
+    "translate_keypoints": 512,
+    "improve_prompt": 512,  # Old and new prompt
+    "analyze_story_parts": 512,
+    "resolve_keypoints": 256,
+    "process_motion": 512,  # One motion description
+    "generate_story_part": 1024,
+    "generate_actions": 1024,  # Lists of short title and description items
+    "generate_premise": 1024,
+    "generate_init_hints": 1024,
+    "generate_end_hints": 1024,
+}
+BUDGET_FILE = "cache/budgets.jsonl"
+BUDGET_LIMIT = 4096  # Largest budget, also used by streamed completions
+BUDGET_FLOOR = 64
+BUDGET_QUANTILE = 0.99
+BUDGET_HEADROOM = 0.25
+BUDGET_WINDOW = 500  # Recent completion sizes kept per method
+BUDGET_MIN_SAMPLES = 20  # Sizes needed before the budget is learned
 # NOTE: If using dall-e-3, change the resolution to "1024x1024"
 IMAGE_GEN_RESOLUTION = "512x512"
 
 # App settings
 APP_IMAGE_EXT = ["jpg", "jpeg", "png"]
+APP_IMAGE_MAX_BYTES = 10 * 1024 * 1024
+APP_IMAGE_VARIANTS = {
+    # ?variant=<name> of /api/image/<img_name>, longest side in pixels
+    "thumb": {"size": 256, "format": "webp", "quality": 80},
+    "slide": {"size": 1024, "format": "jpg", "quality": 85},
+}
+APP_IMAGE_MAX_AGE = 365 * 24 * 3600  # Image names never get new content
+
+# Drawings sent to generate_character: cropped to the paper and downscaled
+DRAWING_SIZE = 512  # Longest side, the size "low" detail works at
+DRAWING_QUALITY = 85
+DRAWING_DETAIL = "low"
+DRAWING_CROP = True
+
+# Perceptual-hash cache of characters generated from drawings
+CHARACTER_CACHE_FILE = "cache/characters.jsonl"
+CHARACTER_CACHE_DISTANCE = 6  # Max Hamming distance (of 64 bits) to count as a hit
+CHARACTER_CACHE_AUDIT = 0.05  # Share of hits regenerated to check for false matches
+CHARACTER_CACHE_TTL = 7 * 24 * 3600
+CHARACTER_CACHE_MAX_ENTRIES = 5000  # Most recently stored entries kept on compaction
+CHARACTER_CACHE_MAX_MB = 20  # File size that triggers a compaction
+
+# Exact-match cache of upstream responses, per Storyteller method
+RESPONSE_CACHE = {
+    "improve_prompt": {"ttl": 24 * 3600, "maxsize": 512},
+    "translate_text": {"ttl": 7 * 24 * 3600, "maxsize": 2048},
+    "translate_keypoints": {"ttl": 7 * 24 * 3600, "maxsize": 1024},
+    "generate_character": {"ttl": 7 * 24 * 3600, "maxsize": 256},
+}
+RESPONSE_CACHE_FOLDER = "cache/responses"  # Shared disk tier, None to disable
+RESPONSE_CACHE_DISK_MB = 100
+
+# Near-identical inputs share results (MinHash similarity >= threshold). Each
+# entry keeps up to `variants` results served in turn, and a `refresh` share
+# of the hits generates a new one so outputs stay varied.
+SEMANTIC_CACHE = {
+    "generate_premise": {
+        "threshold": 0.95,  # Same name, and all but a word or two of the rest
+        "variants": 4,
+        "refresh": 0.25,
+        "ttl": 7 * 24 * 3600,
+    },
+    "generate_actions": {
+        "threshold": 0.95,
+        "variants": 2,
+        "refresh": 0.2,
+        "ttl": 24 * 3600,
+    },
+    "generate_init_hints": {
+        "threshold": 1.0,
+        "variants": 8,
+        "refresh": 0.3,
+        "ttl": 24 * 3600,
+    },
+}
+SEMANTIC_CACHE_FILE = "cache/semantic.jsonl"
+SEMANTIC_CACHE_MAX_ENTRIES = 5000  # Most recently stored entries kept on compaction
+SEMANTIC_CACHE_MAX_MB = 20  # File size that triggers a compaction
+
+# Image prompt built locally from a story part's image_prompt (or keymoment)
+IMAGE_PROMPT_TEMPLATE = (
+    "{scene}. In the style of: {style}. Detailed illustration, vivid colors, "
+    "no text or lettering."
+)
 FLASK_DEBUG = True
 PREMISE_GEN_COUNT = 3
 HINTS_GEN_COUNT = 3
 ACTION_GEN_COUNT = 2
+# List generators (premises, actions, hints): "single" asks one completion to
+# write all the items, "samples" asks for one item per sample, all sampled in
+# parallel in one call (LIST_GEN_EXTRA spare samples), merged and de-duplicated
+LIST_GEN_MODE = "samples"
+LIST_GEN_EXTRA = 1
+LIST_DEDUPE_SIMILARITY = 0.7  # Items at least this similar count as duplicates
 
 # LLM settings
 LLM_DEBUG = True
 
+# Keypoint settings
+KEYPOINT_FOLDER = "cache/keypoints"  # Story indexes shared by all workers
+KEYPOINT_STORE_SIZE = 1024  # Stories kept in memory per worker
+KEYPOINT_TTL = 7 * 24 * 3600  # Seconds since the last part before a story is evicted
+KEYPOINT_LLM_RESOLVE = True  # Ask the LLM only when entity aliases are ambiguous
+
+# Rate limiter settings
+LIMITER_BACKEND = "file"  # "file" is shared by all gunicorn workers, "local" per process
+LIMITER_FOLDER = "limiter"
+LIMITER_MAX_CONCURRENCY = 32  # In-flight upstream requests across workers
+LIMITER_BACKGROUND_RESERVE = 0.2  # Capacity fraction kept for interactive calls
+LIMITER_QUEUE_TIMEOUT = 30  # Seconds a request may wait for capacity
+LIMITER_MODELS = {
+    MODEL_GPT4: {"rpm": 500, "tpm": 30000},
+    MODEL_GPT4MINI: {"rpm": 500, "tpm": 200000},
+    MODEL_GPT3: {"rpm": 500, "tpm": 200000},
+    MODEL_IMAGE_GEN: {"rpm": 50, "tpm": 10**9},
+    MODEL_TTS: {"rpm": 50, "tpm": 10**9},
+    MODEL_STT: {"rpm": 50, "tpm": 10**9},
+}
+LIMITER_PRIORITY = {
+    # Storyteller methods that may wait behind interactive requests
+    "generate_story_image": "background",
+    "generate_character_image_improv": "background",
+    "resolve_keypoints": "background",
+    "live_transcribe": "background",
+    "audit_character": "background",
+    "breaker_probe": "background",
+}
+
+# Circuit breakers, per model and endpoint (chat, vision, images, speech)
+BREAKER_WINDOW = 60  # Seconds of calls the rates are computed over
+BREAKER_MIN_CALLS = 5  # Calls in the window before the breaker may open
+BREAKER_ERROR_RATE = 0.5  # Share of failed calls (5xx, 429, timeouts) that opens it
+BREAKER_SLOW_CALL = 30  # Seconds from which a call counts as slow
+BREAKER_SLOW_RATE = 0.8  # Share of slow calls that opens it
+BREAKER_COOLDOWN = 15  # Seconds open before a probe, doubled after each failed one
+BREAKER_MAX_COOLDOWN = 300
+BREAKER_PROBE_TIMEOUT = 10
+
+# Duplicate requests to the expensive endpoints run once (coalesced() in app.py)
+COALESCE_TTL = 120  # Seconds a successful response is replayed to retries
+COALESCE_FOLDER = "cache/requests"
+COALESCE_DISK_MB = 200
+
+# Gunicorn serving profile, see gunicorn.conf.py (GUNICORN_PROFILE overrides it)
+SERVE_PROFILE = "gthread"  # "gthread", "gevent" or "sync"
+SERVE_IO_WAIT = 0.9  # Share of a request spent waiting on upstream APIs
+SERVE_MAX_WORKERS = 16  # Processes cap (memory), mostly for the sync profile
+SERVE_GEVENT_CONNECTIONS = 200  # Concurrent requests per gevent worker
+SERVE_TIMEOUT_MARGIN = 30  # Seconds added to the longest deadline budget
+
+# Deadline settings (seconds), keyed by Flask endpoint name
+DEADLINE_DEFAULT = 60
+DEADLINE_BUDGETS = {
+    "translate_text": 20,
+    "translate_keypoints": 20,
+    "read_text": 30,
+    "storyimage_gen": 90,
+    "gen_character_img": 90,
+    "character_premise_from_improv": 120,
+    "story_from_improv": 120,
+    "end_from_improv": 120,
+    "live_finish": 120,
+    "story_turn": 90,
+}
+DEADLINE_MIN_FALLBACK = 5  # Budget needed to start a fallback tier or retry
+
+# Motion analysis of improv frames
+MOTION_MODE = "peaks"  # "frames" (all frames), "peaks" or "text" (timeline only)
+MOTION_PEAK_FRAMES = 4
+MOTION_FRAME_INTERVAL = 0.3  # Seconds between frames captured by the frontend
+
+# Frame mosaics for the vision model
+MOSAIC_RATIO = 1.0  # Share of improv calls sending mosaics, lower it for an A/B test
+MOSAIC_GRID = (2, 2)  # Columns, rows
+MOSAIC_TILE = (256, 192)  # Pixels per frame
+MOSAIC_DETAIL = "low"
+
+# Upstream call metrics (GET /api/metrics)
+METRICS_WINDOW = 1000  # Recent calls kept per worker
+
+# Media store of improv takes (frames, audio and what is derived from them)
+MEDIA_FOLDER = "media"
+MEDIA_TTL = 3600  # Seconds since last use before a take is evicted
+
+# Live improv sessions
+LIVE_FOLDER = "live"
+LIVE_MAX_FRAMES = 60  # Frame buffer size, halved in rate when full
+LIVE_MAX_AUDIO_BYTES = 25 * 1024 * 1024  # Whisper upload limit
+LIVE_SEGMENT_CHUNKS = 5  # Audio chunks per speculative transcription
+LIVE_SESSION_TTL = 900  # Seconds of inactivity before a session is dropped
+LIVE_WORKERS = 4
+
 # General settings
 LOG_FOLDER = "logs"
+LOG_MAX_BYTES = 20 * 1024 * 1024  # Rotate the log files at this size
+LOG_BACKUPS = 5
+LOG_QUEUE_SIZE = 10000  # Records waiting to be written, newer ones are dropped
+LOG_FIELD_LIMIT = 1000  # Longer string arguments are truncated
+LOG_MESSAGE_LIMIT = 10000  # Longer rendered messages are truncated
+
+# Heavy libraries imported on first use, or before the workers fork with
+# create_app(preload=True)
+LAZY_MODULES = (
+    "openai",
+    "cv2",
+    "numpy",
+    "PIL.Image",
+    "PIL.ImageOps",
+    "langcodes",
+    "requests",
+)
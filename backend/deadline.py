@@ -0,0 +1,94 @@
+import contextvars
+import select
+import socket
+import time
+from contextlib import contextmanager
+
+
+class DeadlineExceeded(Exception):
+    # Raised when a request ran out of budget or its client went away
+    pass
+
+
+class Deadline:
+    # Latency budget of one HTTP request, shared by every upstream call it makes
+    def __init__(self, budget, probe=None):
+        self.expires = time.time() + budget
+        self.probe = probe  # Returns True when the client disconnected
+        self.cancelled = False
+
+    def remaining(self):
+        return max(self.expires - time.time(), 0.0)
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def is_cancelled(self):
+        if not self.cancelled and self.probe is not None:
+            try:
+                self.cancelled = self.probe()
+            except Exception:
+                self.probe = None
+        return self.cancelled
+
+    def check(self, need=0.0):
+        # Raise if the request cannot afford `need` more seconds of work
+        if self.is_cancelled():
+            raise DeadlineExceeded("Client disconnected")
+        if self.remaining() <= need:
+            raise DeadlineExceeded(f"Deadline exceeded ({self.remaining():.1f}s left)")
+
+    def timeout(self, cap=None):
+        # Timeout to give an upstream call, never longer than the budget left
+        remaining = self.remaining()
+        return min(remaining, cap) if cap else remaining
+
+
+def within(chunks, deadline):
+    # Items of the iterable `chunks` (a response body being read), raising
+    # once the deadline passed. Socket timeouts only bound each read, this
+    # bounds the whole transfer.
+    for chunk in chunks:
+        if deadline:
+            deadline.check()
+        yield chunk
+
+
+_current = contextvars.ContextVar("deadline", default=None)
+
+
+def current_deadline():
+    return _current.get()
+
+
+@contextmanager
+def deadline_scope(budget, probe=None):
+    deadline = Deadline(budget, probe)
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+
+
+def client_disconnected(environ):
+    # Peek at the client socket (gunicorn and the werkzeug dev server expose it);
+    # a readable socket with no data means the client closed the connection
+    sock = environ.get("gunicorn.socket") or environ.get("werkzeug.socket")
+    if sock is None:
+        return None
+    if sock.fileno() < 0:
+        return lambda: True
+
+    def probe():
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        try:
+            return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+
+    return probe
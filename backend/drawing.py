@@ -0,0 +1,84 @@
+from io import BytesIO
+
+from lazy import lazy_module
+
+cv2 = lazy_module("cv2")
+np = lazy_module("numpy")
+Image = lazy_module("PIL.Image")
+ImageOps = lazy_module("PIL.ImageOps")
+
+
+def _order_corners(quad):
+    # Top-left, top-right, bottom-right, bottom-left
+    quad = quad.reshape(4, 2).astype(np.float32)
+    s, d = quad.sum(axis=1), np.diff(quad, axis=1).ravel()
+    return np.array(
+        [quad[s.argmin()], quad[d.argmin()], quad[s.argmax()], quad[d.argmax()]]
+    )
+
+
+def crop_paper(image, min_area=0.2):
+    # Find the sheet of paper (largest bright quadrilateral) and warp it to a
+    # flat rectangle. Returns the image unchanged if there is no clear sheet.
+    h, w = image.shape[:2]
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    gray = cv2.GaussianBlur(gray, (5, 5), 0)
+    _, mask = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, np.ones((9, 9), np.uint8))
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return image
+    paper = max(contours, key=cv2.contourArea)
+    area = cv2.contourArea(paper)
+    if area < min_area * h * w or area > 0.98 * h * w:
+        return image  # No sheet, or the photo is already only the sheet
+
+    quad = cv2.approxPolyDP(paper, 0.02 * cv2.arcLength(paper, True), True)
+    if len(quad) != 4:
+        x, y, bw, bh = cv2.boundingRect(paper)
+        return image[y : y + bh, x : x + bw]
+    src = _order_corners(quad)
+    width = int(max(np.linalg.norm(src[0] - src[1]), np.linalg.norm(src[3] - src[2])))
+    height = int(max(np.linalg.norm(src[0] - src[3]), np.linalg.norm(src[1] - src[2])))
+    dst = np.array(
+        [[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]],
+        np.float32,
+    )
+    matrix = cv2.getPerspectiveTransform(src, dst)
+    return cv2.warpPerspective(image, matrix, (width, height))
+
+
+def normalize_drawing(data, size=512, quality=85, crop=True):
+    """
+    Prepare a photo of a drawing for the vision model: decode it once (JPEGs
+    at the smallest DCT scale still covering `size`), apply the EXIF
+    orientation, crop to the sheet of paper, downscale so the longest side is
+    at most `size` pixels and re-encode it as a compact JPEG. Returns the
+    JPEG bytes.
+    """
+    image = Image.open(BytesIO(data))
+    image.draft("RGB", (size, size))
+    image = ImageOps.exif_transpose(image)
+    if image.mode != "RGB":
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        image = image.convert("RGBA")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    pixels = np.asarray(image)
+
+    if crop:
+        pixels = crop_paper(pixels)
+    h, w = pixels.shape[:2]
+    scale = size / max(h, w)
+    if scale < 1:
+        pixels = cv2.resize(
+            pixels,
+            (max(int(w * scale), 1), max(int(h * scale), 1)),
+            interpolation=cv2.INTER_AREA,
+        )
+    _, buffer = cv2.imencode(
+        ".jpg",
+        cv2.cvtColor(pixels, cv2.COLOR_RGB2BGR),
+        [cv2.IMWRITE_JPEG_QUALITY, quality],
+    )
+    return buffer.tobytes()
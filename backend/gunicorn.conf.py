@@ -0,0 +1,52 @@
+# Gunicorn settings, read from the working directory by `gunicorn app:...`.
+# GUNICORN_PROFILE (default SERVE_PROFILE) picks the worker model, sized from
+# the CPU count and the share of a request spent waiting on upstream APIs.
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from config import (
+    DEADLINE_BUDGETS,
+    DEADLINE_DEFAULT,
+    SERVE_GEVENT_CONNECTIONS,
+    SERVE_IO_WAIT,
+    SERVE_MAX_WORKERS,
+    SERVE_PROFILE,
+    SERVE_TIMEOUT_MARGIN,
+)
+
+profile = os.environ.get("GUNICORN_PROFILE", SERVE_PROFILE)
+if profile == "gevent":
+    # Patch before the app is imported (--preload), so that its locks, sleeps
+    # and sockets yield to other greenlets
+    from gevent import monkey
+
+    monkey.patch_all()
+
+cpus = os.cpu_count() or 1
+# Requests in flight that keep one core busy
+per_core = round(1 / (1 - SERVE_IO_WAIT))
+
+if profile == "gthread":
+    # One process per core (GIL), threads cover the upstream wait
+    worker_class = "gthread"
+    workers = max(cpus, 2)
+    threads = per_core
+elif profile == "gevent":
+    worker_class = "gevent"
+    workers = max(cpus, 2)
+    worker_connections = SERVE_GEVENT_CONNECTIONS
+elif profile == "sync":
+    # One request per process, memory bounds the count
+    worker_class = "sync"
+    workers = min(max(cpus * per_core, 2), SERVE_MAX_WORKERS)
+else:
+    raise ValueError(f"Unknown GUNICORN_PROFILE: {profile}")
+workers = int(os.environ.get("WEB_CONCURRENCY", workers))
+
+bind = f":{os.environ.get('PORT', 8080)}"
+# Longest request budget plus a margin: sync workers are killed past it, and
+# restarts wait as long for in-flight LLM calls to finish
+timeout = max(DEADLINE_DEFAULT, *DEADLINE_BUDGETS.values()) + SERVE_TIMEOUT_MARGIN
+graceful_timeout = timeout
+keepalive = 5
@@ -0,0 +1,141 @@
+import hashlib
+import os
+import uuid
+from io import BytesIO
+
+from coalesce import SingleFlight
+from lazy import lazy_module
+
+cv2 = lazy_module("cv2")
+np = lazy_module("numpy")
+
+CHUNK_SIZE = 64 * 1024
+
+# Magic bytes of the formats we accept, checked instead of decoding the image
+SIGNATURES = {
+    "png": (b"\x89PNG\r\n\x1a\n", b"IHDR", 12),
+    "jpg": (b"\xff\xd8\xff", None, None),
+}
+
+
+class InvalidImage(Exception):
+    # Upload is not an accepted image format or is too large
+    pass
+
+
+def sniff_image(header):
+    # Image extension from the first bytes of the file, or None
+    for ext, (magic, chunk, offset) in SIGNATURES.items():
+        if header.startswith(magic) and (
+            chunk is None or header[offset : offset + len(chunk)] == chunk
+        ):
+            return ext
+    return None
+
+
+class ImageStore:
+    # Images stored under the hash of their content, so the same drawing is
+    # kept once and uploading it again returns the existing name
+    def __init__(
+        self, folder, extensions=("jpg", "jpeg", "png"), max_bytes=None, variants=None
+    ):
+        self.folder = os.path.abspath(folder)
+        self.extensions = extensions
+        self.max_bytes = max_bytes
+        self.variants = variants or {}
+        self.flight = SingleFlight()
+        os.makedirs(self.folder, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.folder, os.path.basename(name))
+
+    def save_stream(self, stream):
+        # Stream the upload to a temporary file while hashing it, then move it
+        # in place atomically. Returns the image name and whether it was new.
+        header = stream.read(16)
+        ext = sniff_image(header)
+        if ext is None or ext not in self.extensions:
+            raise InvalidImage("Unsupported image format")
+
+        digest = hashlib.sha256(header)
+        size = len(header)
+        tmp = os.path.join(self.folder, f".upload-{uuid.uuid4().hex}")
+        try:
+            with open(tmp, "wb") as f:
+                f.write(header)
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if self.max_bytes and size > self.max_bytes:
+                        raise InvalidImage("Image too large")
+                    digest.update(chunk)
+                    f.write(chunk)
+
+            name = f"img_{digest.hexdigest()[:32]}.{ext}"
+            if os.path.exists(self.path(name)):
+                return name, False
+            os.replace(tmp, self.path(name))
+            return name, True
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def save_bytes(self, data):
+        return self.save_stream(BytesIO(data))
+
+    def derived(self, name, suffix, fn):
+        # Path of a file made from the image by fn(bytes) -> bytes, stored next
+        # to the original as <stem>.<suffix> on first request. Concurrent first
+        # requests share a single run of fn.
+        stem = os.path.basename(name).rsplit(".", 1)[0]
+        path = self.path(f"{stem}.{suffix}")
+        if os.path.exists(path):
+            return path
+        return self.flight.do(path, lambda: self.__derive(name, path, fn))
+
+    def __derive(self, name, path, fn):
+        if os.path.exists(path):
+            return path
+        with open(self.path(name), "rb") as f:
+            data = fn(f.read())
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return path
+
+    def variant(self, name, variant, webp=True):
+        # Resized copy of the image (see APP_IMAGE_VARIANTS)
+        spec = self.variants[variant]
+        ext = spec["format"]
+        if ext == "webp" and not webp:
+            ext = "jpg"  # Client does not accept WebP
+        return self.derived(
+            name, f"{variant}.{ext}", lambda data: self.__render(data, spec, ext, name)
+        )
+
+    def __render(self, data, spec, ext, name):
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+        if image is None:
+            raise InvalidImage(f"Cannot decode {name}")
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        elif image.shape[2] == 4 and ext != "webp":
+            # JPEG has no alpha: lay transparent drawings on white paper
+            alpha = image[:, :, 3:4].astype(np.float32) / 255
+            image = (image[:, :, :3] * alpha + 255 * (1 - alpha)).astype(np.uint8)
+        h, w = image.shape[:2]
+        scale = spec["size"] / max(h, w)
+        if scale < 1:
+            image = cv2.resize(
+                image,
+                (max(int(w * scale), 1), max(int(h * scale), 1)),
+                interpolation=cv2.INTER_AREA,
+            )
+        flag = cv2.IMWRITE_WEBP_QUALITY if ext == "webp" else cv2.IMWRITE_JPEG_QUALITY
+        ok, buffer = cv2.imencode(f".{ext}", image, [flag, spec.get("quality", 85)])
+        if not ok:
+            raise InvalidImage(f"Cannot encode {name} as {ext}")
+        return buffer.tobytes()
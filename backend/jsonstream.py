@@ -0,0 +1,47 @@
+import json
+import re
+
+HIGH_SURROGATES = ("d8", "d9", "da", "db")
+
+
+class StreamedField:
+    # Decodes the string value of the first `field` key of a JSON object
+    # while the object is still being streamed: feed() the chunks as they
+    # arrive and it returns the characters of the value decoded so far.
+    # Escape sequences split across chunks are held back until complete.
+    def __init__(self, field):
+        self.pattern = re.compile(r'"%s"\s*:\s*"' % re.escape(field))
+        self.buffer = ""
+        self.pos = None  # Next undecoded character of the value
+        self.done = False
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        if self.done:
+            return ""
+        if self.pos is None:
+            match = self.pattern.search(self.buffer)
+            if match is None:
+                return ""
+            self.pos = match.end()
+
+        out = []
+        buffer, pos = self.buffer, self.pos
+        while pos < len(buffer):
+            char = buffer[pos]
+            if char == '"':
+                self.done = True
+                break
+            if char == "\\":
+                size = 6 if buffer[pos + 1 : pos + 2] == "u" else 2
+                if size == 6 and buffer[pos + 2 : pos + 4].lower() in HIGH_SURROGATES:
+                    size = 12  # High surrogate, decoded with the low one
+                if pos + size > len(buffer):
+                    break  # Rest of the escape is in the next chunk
+                out.append(json.loads(f'"{buffer[pos : pos + size]}"'))
+                pos += size
+                continue
+            out.append(char)
+            pos += 1
+        self.pos = pos
+        return "".join(out)
@@ -0,0 +1,315 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from cachetools import LRUCache
+
+from coalesce import file_lock
+
+KEYPOINT_FIELDS = ("who", "where", "objects")
+KEYPOINT_HEAD = ["Story Part", "Who", "Where", "Objects"]
+
+_ARTICLES = ("the", "a", "an")
+_PUNCT = re.compile(r"[^\w\s'-]")
+
+
+def normalize_entity(name):
+    # Lowercase, drop punctuation and leading articles, collapse whitespace
+    key = _PUNCT.sub(" ", str(name).lower())
+    tokens = key.split()
+    while tokens and tokens[0] in _ARTICLES:
+        tokens = tokens[1:]
+    return " ".join(tokens)
+
+
+def split_entities(value):
+    # Generators return either a list or a comma separated string
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        items = value
+    else:
+        items = str(value).split(",")
+    return [str(item).strip() for item in items if str(item).strip()]
+
+
+def _heads(name):
+    # Words naming what an entity is: its head noun ("red ball" -> "ball",
+    # "bowl of tuna" -> "bowl") and, in "johnny the cat", the name before it
+    tokens = name.split()
+    if "of" in tokens[1:]:
+        tokens = tokens[: tokens.index("of", 1)]
+    heads = {tokens[-1]}
+    for i in range(1, len(tokens) - 1):
+        if tokens[i] in _ARTICLES:
+            heads.add(" ".join(tokens[:i]))
+            break
+    return heads
+
+
+def _shares_head(a, b):
+    # "red ball" and "blue ball" may be the same ball, "red ball" and
+    # "red car" are not the same thing
+    return bool(_heads(a) & _heads(b))
+
+
+def _is_related(a, b):
+    return a == b or _is_alias(a, b) or _is_alias(b, a)
+
+
+def _is_alias(short, long):
+    # "johnny" is an alias of "johnny the cat", but "the" alone is not
+    short_tokens = [t for t in short.split() if t not in _ARTICLES]
+    long_tokens = long.split()
+    if not short_tokens or len(short_tokens) >= len(long_tokens):
+        return False
+    return all(t in long_tokens for t in short_tokens)
+
+
+class KeypointIndex:
+    # Incremental who/where/objects index for a single story.
+    # Every entity is stored once per field and parts refer to it by id, so the
+    # table is kept as one column of id-tuples per field (columnar layout).
+    def __init__(self):
+        self.entities = {f: [] for f in KEYPOINT_FIELDS}
+        self.aliases = {f: {} for f in KEYPOINT_FIELDS}
+        self.columns = {f: [] for f in KEYPOINT_FIELDS}
+        self.ambiguous = {f: set() for f in KEYPOINT_FIELDS}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.columns["who"])
+
+    def state(self):
+        # JSON-serializable copy of the index, see from_state()
+        with self.lock:
+            return {
+                "entities": self.entities,
+                "aliases": self.aliases,
+                "columns": self.columns,
+                "ambiguous": {f: sorted(ids) for f, ids in self.ambiguous.items()},
+            }
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls()
+        for f in KEYPOINT_FIELDS:
+            index.entities[f] = list(state["entities"][f])
+            index.aliases[f] = dict(state["aliases"][f])
+            index.columns[f] = [tuple(ids) for ids in state["columns"][f]]
+            index.ambiguous[f] = set(state["ambiguous"][f])
+        return index
+
+    def __resolve(self, field, name):
+        key = normalize_entity(name)
+        if not key:
+            return None
+        aliases = self.aliases[field]
+        if key in aliases:
+            return aliases[key]
+
+        # "johnny" -> "johnny the cat" is a safe match, "johnny the cat" is a
+        # safe upgrade of "johnny", but "johnny the dog" has to be disambiguated
+        groups = {}
+        for alias, eid in aliases.items():
+            groups.setdefault(eid, []).append(alias)
+        candidates, conflicts = set(), set()
+        for eid, known in groups.items():
+            related = [_is_related(key, alias) for alias in known]
+            if all(related):
+                candidates.add(eid)
+            elif any(related) or any(_shares_head(key, alias) for alias in known):
+                conflicts.add(eid)
+
+        if len(candidates) == 1 and not conflicts:
+            eid = candidates.pop()
+            aliases[key] = eid
+            # Keep the most descriptive name for display
+            if len(name) > len(self.entities[field][eid]):
+                self.entities[field][eid] = name
+            return eid
+
+        eid = len(self.entities[field])
+        self.entities[field].append(name)
+        aliases[key] = eid
+        if candidates or conflicts:
+            # Several known entities match, let the LLM decide later
+            self.ambiguous[field].add(eid)
+        return eid
+
+    def add_part(self, part):
+        # Merge the who/where/objects of a new story part, returns its row
+        with self.lock:
+            for field in KEYPOINT_FIELDS:
+                ids = []
+                for name in split_entities(part.get(field)):
+                    eid = self.__resolve(field, name)
+                    if eid is not None and eid not in ids:
+                        ids.append(eid)
+                self.columns[field].append(tuple(ids))
+            return self.__row(len(self) - 1)
+
+    def __names(self, field, ids):
+        return [self.entities[field][eid] for eid in ids]
+
+    def __row(self, i):
+        return [
+            i + 1,
+            ", ".join(self.__names("who", self.columns["who"][i])),
+            ", ".join(self.__names("where", self.columns["where"][i])),
+            ", ".join(self.__names("objects", self.columns["objects"][i])),
+        ]
+
+    def row(self, i=-1):
+        with self.lock:
+            if not len(self):
+                return None
+            return self.__row(i % len(self))
+
+    def table(self):
+        # Same layout as the frontend keypoints table
+        with self.lock:
+            return {
+                "head": KEYPOINT_HEAD,
+                "body": [self.__row(i) for i in range(len(self))],
+            }
+
+    def summary(self):
+        # Characters and objects seen so far (most recent first), current location
+        with self.lock:
+            result = {}
+            for field in ("who", "objects"):
+                seen = []
+                for ids in reversed(self.columns[field]):
+                    seen.extend(eid for eid in ids if eid not in seen)
+                result[field] = self.__names(field, seen)
+            where = next((ids for ids in reversed(self.columns["where"]) if ids), ())
+            result["where"] = ", ".join(self.__names("where", where))
+            return result
+
+    def is_ambiguous(self):
+        with self.lock:
+            return any(self.ambiguous[f] for f in KEYPOINT_FIELDS)
+
+    def ambiguities(self):
+        # Ambiguous entities with the known entities they could refer to
+        with self.lock:
+            result = {}
+            for field in KEYPOINT_FIELDS:
+                for eid in self.ambiguous[field]:
+                    name = self.entities[field][eid]
+                    key = normalize_entity(name)
+                    known = [
+                        other
+                        for i, other in enumerate(self.entities[field])
+                        if i != eid
+                        and (
+                            _is_related(key, normalize_entity(other))
+                            or _shares_head(key, normalize_entity(other))
+                        )
+                    ]
+                    result.setdefault(field, {})[name] = known
+            return result
+
+    def merge(self, field, name, target):
+        # Merge entity `name` into `target` (both display names)
+        with self.lock:
+            aliases = self.aliases[field]
+            src = aliases.get(normalize_entity(name))
+            dst = aliases.get(normalize_entity(target))
+            if src is None or dst is None or src == dst:
+                self.ambiguous[field].discard(src)
+                return
+            for alias, eid in aliases.items():
+                if eid == src:
+                    aliases[alias] = dst
+            self.columns[field] = [
+                tuple(dict.fromkeys(dst if eid == src else eid for eid in ids))
+                for ids in self.columns[field]
+            ]
+            self.ambiguous[field].discard(src)
+
+    def settle(self):
+        # Accept the remaining ambiguous entities as distinct
+        with self.lock:
+            for field in KEYPOINT_FIELDS:
+                self.ambiguous[field].clear()
+
+
+class KeypointStore:
+    # Per-story keypoint indexes stored as <folder>/<story hash>.json, so the
+    # requests of a story extend the same index whichever worker serves
+    # them. Up to `maxsize` indexes are kept in memory and reloaded when
+    # their file changed. Stories not updated for `ttl` seconds are evicted.
+    def __init__(self, folder, maxsize, ttl=7 * 24 * 3600, sweep_interval=600):
+        self.folder = folder
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.swept = 0
+        self.indexes = LRUCache(maxsize=maxsize)  # Path -> (file version, index)
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def __path(self, story_id):
+        name = hashlib.sha256(str(story_id).encode()).hexdigest()[:32]
+        return os.path.join(self.folder, f"{name}.json")
+
+    def __sweep(self):
+        now = time.time()
+        with self.lock:
+            if now - self.swept < self.sweep_interval:
+                return
+            self.swept = now
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            try:
+                if now - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def __load(self, path, cached=True):
+        # Index stored at `path`, from memory while its file is unchanged
+        try:
+            f = open(path)
+        except FileNotFoundError:
+            return None
+        with f:
+            stat = os.fstat(f.fileno())
+            version = (stat.st_ino, stat.st_mtime_ns)
+            with self.lock:
+                entry = self.indexes.get(path)
+            if cached and entry is not None and entry[0] == version:
+                return entry[1]
+            try:
+                index = KeypointIndex.from_state(json.load(f))
+            except (ValueError, KeyError, TypeError):
+                return None
+        with self.lock:
+            self.indexes[path] = (version, index)
+        return index
+
+    def get(self, story_id):
+        # Index of the story (read only), None if unknown
+        if not story_id:
+            return None
+        return self.__load(self.__path(story_id))
+
+    @contextmanager
+    def update(self, story_id):
+        # Index of the story to modify, created if unknown and stored when
+        # the block exits without error. Updates of a story are serialized.
+        path = self.__path(story_id)
+        self.__sweep()
+        with file_lock(f"{path}.lock"):
+            index = self.__load(path, cached=False) or KeypointIndex()
+            yield index
+            tmp = f"{path}.{uuid.uuid4().hex}"
+            with open(tmp, "w") as f:
+                json.dump(index.state(), f)
+            os.replace(tmp, path)
@@ -0,0 +1,46 @@
+import importlib
+import sys
+import threading
+import types
+
+
+class LazyModule(types.ModuleType):
+    # Stands for module `name` until an attribute is first accessed, then
+    # imports it (under the import lock) and takes over its namespace so
+    # later accesses are plain lookups
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+def lazy_module(name):
+    # The module if already imported, a LazyModule otherwise. A missing
+    # package raises ImportError where it is first used.
+    return sys.modules.get(name) or LazyModule(name)
+
+
+def load_module(name):
+    # Import a module now, e.g. before the gunicorn workers fork
+    return importlib.import_module(name)
+
+
+class Lazy:
+    # Proxy of the object built by factory() on first attribute access
+    def __init__(self, factory):
+        self.__dict__["_factory"] = factory
+        self.__dict__["_object"] = None
+        self.__dict__["_lock"] = threading.Lock()
+
+    def load(self):
+        if self._object is None:
+            with self._lock:
+                if self._object is None:
+                    self.__dict__["_object"] = self._factory()
+        return self._object
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.load(), name, value)
@@ -0,0 +1,282 @@
+import base64
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from coalesce import file_lock
+from deadline import current_deadline, DeadlineExceeded
+
+LIVE_KINDS = ("improv_all", "story_improv_all", "end_improv_all")
+WEBM_CLUSTER = b"\x1f\x43\xb6\x75"  # EBML ID of a Cluster element
+
+
+class LiveSessionError(Exception):
+    # Unknown, expired or already finished live session
+    pass
+
+
+class LiveSession:
+    # One performance streamed in chunks while it happens. State lives on disk
+    # so that every gunicorn worker can take the next chunk:
+    #
+    #   <folder>/<id>/meta.json       kind and context sent at start
+    #   <folder>/<id>/frames/*.jpg    bounded frame buffer
+    #   <folder>/<id>/audio/*.webm    audio chunks in MediaRecorder order
+    #   <folder>/<id>/header.webm     webm header, the start of chunk 0
+    #   <folder>/<id>/segments.json   transcripts of the chunks seen so far
+    def __init__(self, folder, session_id):
+        self.id = session_id
+        self.path = os.path.join(folder, session_id)
+        self.frames_path = os.path.join(self.path, "frames")
+        self.audio_path = os.path.join(self.path, "audio")
+
+    def exists(self):
+        return os.path.isfile(os.path.join(self.path, "meta.json"))
+
+    def meta(self):
+        with open(os.path.join(self.path, "meta.json")) as f:
+            return json.load(f)
+
+    def __write_json(self, name, data):
+        tmp = os.path.join(self.path, f".{name}.{uuid.uuid4().hex}")
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, os.path.join(self.path, name))
+
+    def create(self, kind, context):
+        os.makedirs(self.frames_path)
+        os.makedirs(self.audio_path)
+        self.__write_json(
+            "meta.json", {"kind": kind, "context": context, "created": time.time()}
+        )
+
+    def touch(self):
+        os.utime(os.path.join(self.path, "meta.json"))
+
+    def age(self):
+        return time.time() - os.path.getmtime(os.path.join(self.path, "meta.json"))
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    # Frames
+
+    def frame_names(self):
+        return sorted(os.listdir(self.frames_path))
+
+    def add_frames(self, frames, max_frames):
+        # Frames are decoded as they arrive. When the buffer is full every other
+        # frame is dropped, so it keeps covering the whole performance at a
+        # lower rate instead of only its last seconds.
+        for frame in frames:
+            data = base64.b64decode(frame.split(",", 1)[-1])
+            name = f"{time.time_ns():020d}-{uuid.uuid4().hex[:6]}.jpg"
+            with open(os.path.join(self.frames_path, name), "wb") as f:
+                f.write(data)
+        names = self.frame_names()
+        while len(names) > max_frames:
+            for name in names[1::2]:
+                try:
+                    os.remove(os.path.join(self.frames_path, name))
+                except FileNotFoundError:
+                    pass
+            names = names[::2]
+        return len(names)
+
+    def frames(self):
+        frames = []
+        for name in self.frame_names():
+            with open(os.path.join(self.frames_path, name), "rb") as f:
+                frames.append(
+                    "data:image/jpeg;base64," + base64.b64encode(f.read()).decode()
+                )
+        return frames
+
+    # Audio
+
+    def chunk_count(self):
+        return len(os.listdir(self.audio_path))
+
+    def add_audio(self, seq, data, max_bytes):
+        # Chunks are numbered by the client, retries of the same chunk overwrite
+        size = sum(
+            os.path.getsize(os.path.join(self.audio_path, name))
+            for name in os.listdir(self.audio_path)
+        )
+        if size + len(data) > max_bytes:
+            raise LiveSessionError("Audio limit of the live session reached")
+        if seq == 0:
+            # Header of the recording: everything before its first cluster
+            # (all of chunk 0 if it holds no audio yet)
+            cluster = data.find(WEBM_CLUSTER)
+            header = os.path.join(self.path, "header.webm")
+            with open(header + ".tmp", "wb") as f:
+                f.write(data[:cluster] if cluster >= 0 else data)
+            os.replace(header + ".tmp", header)
+        path = os.path.join(self.audio_path, f"{seq:06d}.webm")
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def contiguous_chunks(self):
+        # Number of chunks received without a gap, only those can be decoded
+        n = 0
+        while os.path.exists(os.path.join(self.audio_path, f"{n:06d}.webm")):
+            n += 1
+        return n
+
+    def audio(self, start, end):
+        # Bytes of chunks [start, end). MediaRecorder only writes the webm header
+        # in the first chunk, so later windows get it prepended to be decodable
+        # (the header alone, the rest of chunk 0 is audio of the first window).
+        data = bytearray()
+        if start > 0:
+            with open(os.path.join(self.path, "header.webm"), "rb") as f:
+                data += f.read()
+        for i in range(start, end):
+            with open(os.path.join(self.audio_path, f"{i:06d}.webm"), "rb") as f:
+                data += f.read()
+        return bytes(data)
+
+    def segments(self):
+        try:
+            with open(os.path.join(self.path, "segments.json")) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {"segments": [], "failed": False}
+
+    def save_segments(self, segments):
+        self.__write_json("segments.json", segments)
+
+    def lock(self, timeout=None):
+        # Exclusive lock on the transcription state, held across workers (see
+        # file_lock). Yields None when not had within `timeout` seconds.
+        return file_lock(os.path.join(self.path, "transcribe.lock"), timeout)
+
+
+class LiveSessions:
+    # Live improv sessions, transcribing the audio in segments while the
+    # performance is still running so only the tail is left when it stops
+    def __init__(
+        self,
+        folder,
+        transcribe,
+        max_frames=60,
+        max_audio_bytes=25 * 1024 * 1024,
+        segment_chunks=5,
+        ttl=900,
+        workers=4,
+        logger=None,
+    ):
+        self.folder = folder
+        self.transcribe = transcribe  # (audio bytes, background) -> text
+        self.max_frames = max_frames
+        self.max_audio_bytes = max_audio_bytes
+        self.segment_chunks = segment_chunks
+        self.ttl = ttl
+        self.logger = logger
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="live")
+        os.makedirs(folder, exist_ok=True)
+
+    def __expire(self):
+        for name in os.listdir(self.folder):
+            session = LiveSession(self.folder, name)
+            try:
+                if session.age() > self.ttl:
+                    session.remove()
+            except FileNotFoundError:
+                pass
+
+    def start(self, kind, context):
+        if kind not in LIVE_KINDS:
+            raise LiveSessionError(f"Unknown live session kind: {kind}")
+        self.__expire()
+        session = LiveSession(self.folder, uuid.uuid4().hex)
+        session.create(kind, context)
+        return session
+
+    def get(self, session_id):
+        session = LiveSession(self.folder, os.path.basename(session_id))
+        if not session.exists():
+            raise LiveSessionError(f"Unknown live session: {session_id}")
+        return session
+
+    def add_frames(self, session_id, frames):
+        session = self.get(session_id)
+        session.touch()
+        return session.add_frames(frames, self.max_frames)
+
+    def add_audio(self, session_id, seq, data):
+        session = self.get(session_id)
+        session.touch()
+        session.add_audio(seq, data, self.max_audio_bytes)
+        ready = session.contiguous_chunks()
+        done = self.__covered(session.segments())
+        if ready - done >= self.segment_chunks:
+            self.executor.submit(self.__transcribe_pending, session, True)
+        return ready
+
+    @staticmethod
+    def __covered(segments):
+        return segments["segments"][-1]["end"] if segments["segments"] else 0
+
+    def __transcribe_pending(self, session, background):
+        # Transcribe the chunks received since the last segment. Speculative
+        # runs skip when another one is already at it, the final one waits
+        # for it within the request deadline.
+        deadline = None if background else current_deadline()
+        timeout = 0 if background else deadline and deadline.timeout()
+        with session.lock(timeout) as lock:
+            if lock is None:
+                if background:
+                    return
+                raise DeadlineExceeded("Timed out waiting for the live transcription")
+            self.__transcribe_locked(session, background)
+
+    def __transcribe_locked(self, session, background):
+        try:
+            segments = session.segments()
+            if segments["failed"]:
+                return
+            start, end = self.__covered(segments), session.contiguous_chunks()
+            if end <= start:
+                return
+            try:
+                text = self.transcribe(session.audio(start, end), background)
+            except Exception as e:
+                # Mostly a window not starting on a webm cluster, the final
+                # pass then transcribes the whole recording at once
+                if self.logger:
+                    self.logger.warning("Live segment %s-%s failed: %s", start, end, e)
+                segments["failed"] = True
+                text = None
+            if text is not None:
+                segments["segments"].append({"start": start, "end": end, "text": text})
+            session.save_segments(segments)
+        except FileNotFoundError:
+            pass  # Session was removed meanwhile
+
+    def finish(self, session_id, chunks=None):
+        # Wait for the running segment, transcribe the tail and return the
+        # session meta, the transcript dict and the buffered frames
+        session = self.get(session_id)
+        ready = session.contiguous_chunks()
+        if chunks is not None and ready < chunks:
+            raise LiveSessionError(f"Missing audio chunks ({ready} of {chunks})")
+        self.__transcribe_pending(session, False)
+        segments = session.segments()
+        if segments["failed"]:
+            text = self.transcribe(session.audio(0, ready), False)
+        else:
+            text = " ".join(s["text"].strip() for s in segments["segments"])
+        meta = session.meta()
+        frames = session.frames()
+        session.remove()
+        return meta, {"text": text}, frames
+
+    def cancel(self, session_id):
+        self.get(session_id).remove()
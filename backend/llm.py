@@ -1,48 +1,170 @@
+import io
 import json
 import os
 from dotenv import load_dotenv
-import requests
 import sys
 import random
-import cv2
+import threading
+import time
 import base64
-import numpy as np
 import tempfile
 
-from langcodes import Language
-
-from openai import OpenAI
-
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lazy import lazy_module
 from utils import logger_setup
 from config import *
+from keypoints import KeypointStore, KEYPOINT_FIELDS, normalize_entity
+from motion import analyze_motion, describe_motion
+from mosaic import pack_frames
+from metrics import CallMetrics, assign_variant, set_variant, count_images
+from media import MediaStore, frames_id, params_key
+from phash import PerceptualCache, data_url_phash
+from respcache import ResponseCache, DiskTier, fingerprint
+from semcache import SemanticCache, dedupe
+from jsonstream import StreamedField
+from deadline import current_deadline, DeadlineExceeded, within
+from breaker import Breakers, CircuitOpen
+from router import ModelRouter
+from budgets import TokenBudgets
+from ratelimit import (
+    create_limiter,
+    estimate_tokens,
+    RateLimitTimeout,
+    PRIORITY_INTERACTIVE,
+)
+
+# Heavy libraries, imported on first use (see create_app() in app.py)
+requests = lazy_module("requests")
+cv2 = lazy_module("cv2")
+np = lazy_module("numpy")
+langcodes = lazy_module("langcodes")
+openai = lazy_module("openai")
 
 DEBUG = LLM_DEBUG
 
 load_dotenv()
 LOGGER = os.environ.get("LOGGER", "False").lower() in ("true", "1", "t")
+LIMITER = os.environ.get("LIMITER", "True").lower() in ("true", "1", "t")
 
 if LOGGER:
-    logger = logger_setup("llm", os.path.join(LOG_FOLDER, "llm.log"), debug=DEBUG)
+    logger = logger_setup(
+        "llm",
+        os.path.join(LOG_FOLDER, "llm.log"),
+        debug=DEBUG,
+        max_bytes=LOG_MAX_BYTES,
+        backups=LOG_BACKUPS,
+        queue_size=LOG_QUEUE_SIZE,
+        field_limit=LOG_FIELD_LIMIT,
+        message_limit=LOG_MESSAGE_LIMIT,
+    )
 else:
     logger = None
 
 
 class Storyteller:
+    # One instance serves every request thread (gthread) or greenlet (gevent)
+    # of a worker: it keeps no per-request state (deadlines and A/B variants
+    # are context variables), the OpenAI client is thread-safe, and the
+    # stores, caches, metrics and limiter each guard their state with a lock.
     def __init__(self, key, org) -> None:
-        self.llm = OpenAI(api_key=key, organization=org)
+        # No SDK retries: the limiter handles 429s (and their Retry-After) and
+        # the fallbacks other failures, retries would also each get the whole
+        # remaining deadline
+        self.llm = openai.OpenAI(api_key=key, organization=org, max_retries=0)
         self.gpt4 = MODEL_GPT4
         self.gpt4mini = MODEL_GPT4MINI
         self.vision = MODEL_VISION
         self.image_gen = MODEL_IMAGE_GEN
         self.stt = MODEL_STT
         self.tts = MODEL_TTS
+        self.base_url = str(self.llm.base_url).rstrip("/")
+        self.keypoints = KeypointStore(
+            KEYPOINT_FOLDER, KEYPOINT_STORE_SIZE, KEYPOINT_TTL
+        )
+        self.metrics = CallMetrics(METRICS_WINDOW)
+        self.media = MediaStore(MEDIA_FOLDER, MEDIA_TTL)
+        self.characters = PerceptualCache(
+            CHARACTER_CACHE_FILE,
+            CHARACTER_CACHE_DISTANCE,
+            CHARACTER_CACHE_AUDIT,
+            ttl=CHARACTER_CACHE_TTL,
+            max_entries=CHARACTER_CACHE_MAX_ENTRIES,
+            max_bytes=CHARACTER_CACHE_MAX_MB * 1024 * 1024,
+        )
+        self.responses = ResponseCache(
+            RESPONSE_CACHE,
+            (
+                DiskTier(RESPONSE_CACHE_FOLDER, RESPONSE_CACHE_DISK_MB * 1024 * 1024)
+                if RESPONSE_CACHE_FOLDER
+                else None
+            ),
+        )
+        self.similar = SemanticCache(
+            SEMANTIC_CACHE_FILE,
+            SEMANTIC_CACHE,
+            max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+            max_bytes=SEMANTIC_CACHE_MAX_MB * 1024 * 1024,
+        )
+        self.limiter = create_limiter(
+            LIMITER_MODELS if LIMITER else {},
+            LIMITER_BACKEND if LIMITER else "local",
+            LIMITER_FOLDER,
+            max_concurrency=LIMITER_MAX_CONCURRENCY if LIMITER else float("inf"),
+            reserve=LIMITER_BACKGROUND_RESERVE,
+            queue_timeout=LIMITER_QUEUE_TIMEOUT,
+        )
+        # Upstream health per model and endpoint: calls to an unhealthy one
+        # fail at once (CircuitOpen) and go to the next model of their route
+        self.breakers = Breakers(
+            {"chat": self.__probe_chat, "vision": self.__probe_chat},
+            ignore=(RateLimitTimeout, DeadlineExceeded),
+            window=BREAKER_WINDOW,
+            min_calls=BREAKER_MIN_CALLS,
+            error_rate=BREAKER_ERROR_RATE,
+            slow_call=BREAKER_SLOW_CALL,
+            slow_rate=BREAKER_SLOW_RATE,
+            cooldown=BREAKER_COOLDOWN,
+            max_cooldown=BREAKER_MAX_COOLDOWN,
+        )
+        # Output token budgets per method, learned from the response sizes
+        self.budgets = TokenBudgets(
+            BUDGET_FILE,
+            BUDGET_INITIAL,
+            default=BUDGET_LIMIT,
+            limit=BUDGET_LIMIT,
+            floor=BUDGET_FLOOR,
+            quantile=BUDGET_QUANTILE,
+            headroom=BUDGET_HEADROOM,
+            window=BUDGET_WINDOW,
+            min_samples=BUDGET_MIN_SAMPLES,
+        )
+        # Models per method, picked from their live latency and errors
+        self.router = ModelRouter(
+            ROUTES,
+            MODEL_FALLBACKS,
+            MODEL_PRICES,
+            self.metrics,
+            lambda model, endpoint: self.breakers.get(model, endpoint).retry_in()
+            is None,
+            ROUTES_FILE,
+            reload=ROUTES_RELOAD,
+            window=ROUTER_WINDOW,
+            min_calls=ROUTER_MIN_CALLS,
+            max_error_rate=ROUTER_MAX_ERROR_RATE,
+            logger=logger,
+        )
 
         if logger:
-            logger.info(f"LLM storyteller initialized.")
+            logger.info("LLM storyteller initialized.")
         if logger:
             logger.debug(
-                f"Modes: {self.gpt4}, {self.gpt4mini}, {self.vision}, {self.image_gen}, {self.stt}, {self.tts}"
+                "Modes: %s, %s, %s, %s, %s, %s",
+                self.gpt4,
+                self.gpt4mini,
+                self.vision,
+                self.image_gen,
+                self.stt,
+                self.tts,
             )
 
     def hello_world(self):
@@ -50,7 +172,7 @@ class Storyteller:
             {"role": "system", "content": "You are a helpful chatbot."},
             {"role": "user", "content": "Hello, who are you?"},
         ]
-        return self.send_gpt_hq_request(messages)
+        return self.send_gpt_hq_request(messages, method="hello_world")
 
     def __get_json_data(self, datastr):
         try:
@@ -65,7 +187,69 @@ class Storyteller:
                 logger.error(e)
         finally:
             if logger:
-                logger.debug(f"Data string: '{datastr}'")
+                logger.debug("Data string: '%s'", datastr)
+
+    def __motion_content(self, frames):
+        # Video part of an improv prompt. Besides the raw frames (MOTION_MODE
+        # "frames"), it can be a local motion timeline with only the peak
+        # motion frames ("peaks") or with no image at all ("text"). Frames are
+        # packed into numbered mosaics for a MOSAIC_RATIO share of the calls.
+        frames = frames or []
+        image = lambda frame, detail="low": {
+            "type": "image_url",
+            "image_url": {"url": f"{frame}", "detail": detail},
+        }
+        content, images, selection = [], frames, None
+        intro = "These are video frames in order."
+        # Frames stored in the media store keep their timeline and mosaics
+        media_id = frames_id(frames) if frames else None
+        if MOTION_MODE != "frames" and len(frames) > 1:
+            try:
+                timeline = self.media.derive(
+                    media_id,
+                    "motion-" + params_key(MOTION_FRAME_INTERVAL, MOTION_PEAK_FRAMES),
+                    lambda: analyze_motion(
+                        frames,
+                        interval=MOTION_FRAME_INTERVAL,
+                        peaks=MOTION_PEAK_FRAMES,
+                    ),
+                )
+                content = [
+                    "This is a timeline of the motion in the video, measured from its frames:\n"
+                    + describe_motion(timeline)
+                ]
+                images = []
+                if MOTION_MODE == "peaks":
+                    images = [frames[i] for i in timeline["peaks"]]
+                    selection = timeline["peaks"]
+                    intro = "These are the frames with the most motion, in order."
+            except Exception as e:
+                if logger:
+                    logger.warning("Motion analysis failed, sending all frames: %s", e)
+        if not images:
+            # An empty content array is rejected upstream
+            return content or ["No video frames were recorded."]
+
+        if assign_variant(MOSAIC_RATIO, "mosaic", "frames") == "mosaic":
+            try:
+                mosaics = self.media.derive(
+                    media_id,
+                    "mosaic-" + params_key(selection, MOSAIC_GRID, MOSAIC_TILE),
+                    lambda: pack_frames(images, MOSAIC_GRID, MOSAIC_TILE),
+                )
+                cols, rows = MOSAIC_GRID
+                return [
+                    *content,
+                    f"{intro} They are packed into grid images of {cols}x{rows} frames, "
+                    "each numbered in its top-left corner. Read every grid left to right, "
+                    "top to bottom.",
+                    *(image(mosaic, MOSAIC_DETAIL) for mosaic in mosaics),
+                ]
+            except Exception as e:
+                set_variant("frames")
+                if logger:
+                    logger.warning("Frame packing failed, sending single frames: %s", e)
+        return [*content, intro, *map(image, images)]
 
     def __improve_prompt(
         self,
@@ -108,10 +292,10 @@ Example JSON output:
                 ],
             },
         ]
-        data = self.send_gpt_lq_request(messages)
+        data = self.send_gpt_lq_request(messages, method="improve_prompt")
         data = self.__get_json_data(data)
         if logger:
-            logger.debug(f"Improved prompt: {data}")
+            logger.debug("Improved prompt: %s", data)
         return data
 
     # -- Unimplemented Functions --
@@ -163,6 +347,7 @@ You a great storyteller.
 4. Give a short visual description of a key moment in the story part.
     - Describe the environment.
     - Do not name the main character.
+    - Also write the key moment as "image_prompt": one detailed paragraph for an image generation model. Keep it safe and respectful, and do not mention any names.
 5. Categorize the sentiment of the new part. Choose from: 'happy', 'sad', 'neutral', 'shocking'.
 6. Return as a JSON object.
     - No styling and all in ascii characters.
@@ -173,6 +358,7 @@ Example JSON object:
 {
     "text": "Once upon a time there was a cat named Johnny who loved to eat tuna. One day when Johnny was playing with his toys, he heard a noise coming from the kitchen. He went to investigate and found that someone had stolen his tuna!",
     "keymoment": "A tuna-can filled with tuna that is overflowing to the floor in a kitchen.",
+    "image_prompt": "A bright kitchen floor covered in tuna spilling from an overturned can, toys scattered nearby, warm afternoon light.",
     "sentiment": "sad",
     "who": ["Johnny"],
     "where": "kitchen",
@@ -193,7 +379,7 @@ Example JSON object:
                 ],
             },
         ]
-        data = self.send_gpt_hq_request(messages)
+        data = self.send_gpt_hq_request(messages, method="initialize_story")
         return self.__get_json_data(data)
 
     def analyze_story_parts(self, context):
@@ -265,9 +451,95 @@ Here is an example JSON object:
                 ],
             },
         ]
-        data = self.send_gpt_lq_request(messages)
+        data = self.send_gpt_lq_request(messages, method="analyze_story_parts")
         return self.__get_json_data(data)
 
+    def update_keypoints(self, story_id, part):
+        # Merge the who/where/objects of a new part into the story index
+        if not story_id or not part:
+            return None
+        with self.keypoints.update(story_id) as index:
+            row = index.add_part(part)
+            resolve = KEYPOINT_LLM_RESOLVE and index.is_ambiguous()
+            if resolve:
+                table, ambiguities = index.table(), index.ambiguities()
+        if resolve:
+            # The LLM is asked outside of the story lock, then its answer merged
+            merges = self.resolve_keypoints(table, ambiguities)
+            with self.keypoints.update(story_id) as index:
+                for field, name, target in merges:
+                    index.merge(field, name, target)
+                index.settle()
+                row = index.row(row[0] - 1)
+        if logger:
+            logger.debug("Keypoints updated for story %s: %s", story_id, row)
+        return row
+
+    def get_keypoints(self, story_id, client=None):
+        # Compact who/where/objects view of the story so far, or `client` (the
+        # last keypoint row the client has) when the index is unknown or
+        # misses some of the client's parts
+        index = self.keypoints.get(story_id)
+        parts = client[0] if isinstance(client, list) and client else None
+        if not isinstance(parts, int):
+            parts = 0
+        if index is None or not len(index) or len(index) < parts:
+            return client
+        return index.summary()
+
+    def resolve_keypoints(self, table, ambiguities):
+        # Only called when the local alias resolution is ambiguous, returns
+        # the (field, name, target) merges to apply
+        messages = [
+            {
+                "role": "system",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": """
+You are a helpful assistant. Help me keep track of the entities in a story.
+1. Understand the input object, example:
+    {
+        "table": {"head": ["Story Part", "Who", "Where", "Objects"], "body": [[1, "Johnny the cat", "kitchen", "tuna"], [2, "Johnny, the cat", "kitchen", "tuna can"]]},
+        "ambiguous": {"who": {"the cat": ["Johnny the cat", "the black cat"]}}
+    }
+2. For each ambiguous name, decide which known entity it refers to.
+3. If it is a new entity, use null.
+4. Return as a JSON object.
+    - No styling and all in ascii characters.
+    - Use double quotes for keys and values.
+
+Example JSON object:
+{
+    "who": {"the cat": "Johnny the cat"},
+}
+""",
+                    }
+                ],
+            },
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": str({"table": table, "ambiguous": ambiguities}),
+                    },
+                ],
+            },
+        ]
+        merges = []
+        try:
+            data = self.send_gpt_lq_request(messages, method="resolve_keypoints")
+            data = self.__get_json_data(data) or {}
+            for field in KEYPOINT_FIELDS:
+                for name, target in (data.get(field) or {}).items():
+                    if target:
+                        merges.append((field, name, target))
+        except Exception as e:
+            if logger:
+                logger.error("Could not resolve keypoints: %s", e)
+        return merges
+
     def terminate_story(self, context, complexity):
         endings = [
             "Ends in a plot twist.",
@@ -291,6 +563,7 @@ You a great storyteller.
 3. Give a short visual description of a key moment in the story part.
     - Describe the environment.
     - Do not name the main character.
+    - Also write the key moment as "image_prompt": one detailed paragraph for an image generation model. Keep it safe and respectful, and do not mention any names.
 4. Categorize the sentiment of the new part. Choose from: 'happy', 'sad', 'neutral', 'shocking'.
 5. Return as a JSON object.
     - No styling and all in ascii characters.
@@ -300,7 +573,8 @@ Example JSON object:
 {
     "part": {
         "text": "He went to investigate and found that someone had stolen his tuna!",
-        "keymoment": "A can of tune filled with tuna that is overflowing to the floor in a kitchen."
+        "keymoment": "A can of tune filled with tuna that is overflowing to the floor in a kitchen.",
+        "image_prompt": "A bright kitchen floor covered in tuna spilling from an overturned can, toys scattered nearby, warm afternoon light.",
         "sentiment": "sad",
         "who": ["Johnny"],
         "where": "kitchen",
@@ -322,11 +596,81 @@ Example JSON object:
                 ],
             },
         ]
-        data = self.send_gpt_hq_request(messages)
+        data = self.send_gpt_hq_request(messages, method="terminate_story")
         return self.__get_json_data(data)
 
+    def __list_plan(self, n):
+        # Items asked per completion and number of completions for a list of
+        # n items: all in one completion, or one per sample (LIST_GEN_MODE)
+        if LIST_GEN_MODE == "samples" and n > 1:
+            return 1, n + LIST_GEN_EXTRA
+        return n, 1
+
+    def __send_list_request(
+        self, messages, n, samples, hq=True, temperature=1.0, method=None
+    ):
+        # {"list": items} of a list generator. Parallel samples are merged and
+        # near-duplicate items dropped, keeping at most n.
+        if samples == 1:
+            send = self.send_gpt_hq_request if hq else self.send_gpt_lq_request
+            data = send(messages, temperature=temperature, method=method)
+            return self.__get_json_data(data)
+
+        items = []
+        for content in self.send_gpt_samples_request(
+            messages, samples, hq, temperature, method
+        ):
+            data = self.__get_json_data(content)
+            if data and isinstance(data.get("list"), list):
+                items.extend(i for i in data["list"] if isinstance(i, dict))
+        items = dedupe(items, LIST_DEDUPE_SIMILARITY)
+        if logger:
+            logger.debug(
+                "%s: %s distinct items from %s samples", method, len(items), samples
+            )
+        return {"list": items[:n]}
+
+    def __similar(self, method, text, n, generate, scope=""):
+        # Result generated earlier for a near-identical input (SEMANTIC_CACHE),
+        # otherwise generate() and keep its result for the next ones. When
+        # generate() fails, the closest pooled result is served instead.
+        # Inputs of different `scope`s never match.
+        if not self.similar.enabled(method):
+            return generate()
+        namespace = f"{n}:{scope}" if scope else str(n)
+        match = self.similar.lookup(method, text, namespace)
+        if match is not None:
+            similarity, key = match
+            result = self.similar.choose(method, key)
+            if result is not None:
+                if logger:
+                    logger.debug("Semantic cache hit for %s (%.2f)", method, similarity)
+                return result
+        try:
+            result = generate()
+        except Exception as e:
+            # Upstream down: an earlier result for a similar input beats none
+            result = self.similar.nearest(method, text, namespace)
+            if result is None:
+                raise e
+            if logger:
+                logger.warning("Serving a pooled result for %s: %s", method, e)
+            return result
+        if result and result.get("list"):
+            self.similar.put(method, text, result, namespace, match and match[1])
+        return result
+
     def generate_actions(self, context, complexity, n=2):
+        return self.__similar(
+            "generate_actions",
+            str(context),
+            n,
+            lambda: self.__generate_actions(context, n),
+        )
+
+    def __generate_actions(self, context, n):
         # Generate choices based on a given context
+        count, samples = self.__list_plan(n * 2)
         messages = [
             {
                 "role": "system",
@@ -359,7 +703,7 @@ Here is an example JSON object:
     ]
 }
                         """
-                        % (n * 2),
+                        % (count),
                     }
                 ],
             },
@@ -373,11 +717,103 @@ Here is an example JSON object:
                 ],
             },
         ]
-        data = self.send_gpt_hq_request(messages)
-        return self.__get_json_data(data)
+        return self.__send_list_request(
+            messages, n * 2, samples, method="generate_actions"
+        )
 
-    def generate_story_part(self, context, complexity):
-        # Generate a story part based on the given context
+    def generate_turn(self, context, complexity, n=2, deadline=None):
+        # Story part, next actions and keypoint fields of an adventure turn in
+        # a single streamed completion (instead of generate_story_part then
+        # generate_actions). Yields ("text", delta) while the part text
+        # arrives, then ("result", data) with the whole parsed object.
+        setting, length = self.__part_setting()
+        messages = [
+            {
+                "role": "system",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": """
+You a great storyteller.
+1. Understand the input object, example:
+    {
+        "premise": "Johnny needs to find out who stole his tuna.",
+        "story": "Once upon a time there was a cat named Johnny who loved to eat tuna. One day when Johnny was playing with his toys, he heard a noise coming from the kitchen.",
+        "action": "Investigate",
+    }
+2. Understand the story so far.
+3. Continue the story based on the main character performing the given action.
+4. The next story part should be:
+    - %s
+    - Not more than %d sentences.
+5. Generate a short visual description of a key moment in the new part:
+    - Describe the environment.
+    - Do not name the main character.
+    - Also write the key moment as "image_prompt": one detailed paragraph for an image generation model. Keep it safe and respectful, and do not mention any names.
+6. Categorize the sentiment of the new part. Choose from: 'happy', 'sad', 'neutral', 'shocking'.
+7. List who is in the new part, where it takes place and the relevant objects.
+8. Generate %d unique actions the main character may perform after the new part.
+    - Each action should advance the story somehow.
+    - Title, few words describing the action.
+    - Description, very short paragraph with more details.
+9. Return as a JSON object, with the "part" first and its "text" as the first field.
+    - No styling and all in ascii characters.
+    - Use double quotes for keys and values.
+
+Example JSON object:
+{
+    "part": {
+        "text": "He went to investigate and found that someone had stolen his tuna!",
+        "keymoment": "A can of tune filled with tuna that is overflowing to the floor in a kitchen.",
+        "image_prompt": "A bright kitchen floor covered in tuna spilling from an overturned can, toys scattered nearby, warm afternoon light.",
+        "sentiment": "sad",
+        "who": ["Johnny"],
+        "where": "kitchen",
+        "objects": ["tuna"]
+    },
+    "actions": [
+        {
+            "title": "Follow the trail",
+            "desc": "Johnny follows the tuna trail leading out of the kitchen."
+        },
+        {
+            "title": "Ask for help",
+            "desc": "Johnny goes to wake up the dog to help him find the thief."
+        }
+    ]
+}
+"""
+                        % (setting, length, n * 2),
+                    }
+                ],
+            },
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": str(context),
+                    },
+                ],
+            },
+        ]
+
+        if logger:
+            logger.debug("Chosen setting: %s", setting)
+        text = StreamedField("text")
+        for chunk in self.send_gpt_stream_request(
+            messages, method="generate_turn", deadline=deadline
+        ):
+            delta = text.feed(chunk)
+            if delta:
+                yield "text", delta
+        data = self.__get_json_data(text.buffer)
+        if not data or not isinstance(data.get("part"), dict):
+            raise ValueError("Could not parse the story turn")
+        yield "result", data
+
+    def __part_setting(self):
+        # Random twist and length (in sentences) of the next story part
         length = random.choice([1, 1, 1, 2, 2, 3, 4])
 
         settings = [
@@ -394,6 +830,11 @@ Here is an example JSON object:
         # Randomly select a setting from the list
         setting = random.choice(settings)
         # convergence = random.choice([setting, "Direct the story towards the premise."])
+        return setting, length
+
+    def generate_story_part(self, context, complexity):
+        # Generate a story part based on the given context
+        setting, length = self.__part_setting()
         messages = [
             {
                 "role": "system",
@@ -416,6 +857,7 @@ You a great storyteller.
 5. Generate a short visual description of a key moment in the new part:
     - Describe the environment.
     - Do not name the main character.
+    - Also write the key moment as "image_prompt": one detailed paragraph for an image generation model. Keep it safe and respectful, and do not mention any names.
 6. Categorize the sentiment of the new part. Choose from: 'happy', 'sad', 'neutral', 'shocking'.
 7. Return as a JSON object.
     - No styling and all in ascii characters.
@@ -425,7 +867,8 @@ Example JSON object:
 {
     "part": {
         "text": "He went to investigate and found that someone had stolen his tuna!",
-        "keymoment": "A can of tune filled with tuna that is overflowing to the floor in a kitchen."
+        "keymoment": "A can of tune filled with tuna that is overflowing to the floor in a kitchen.",
+        "image_prompt": "A bright kitchen floor covered in tuna spilling from an overturned can, toys scattered nearby, warm afternoon light.",
         "sentiment": "sad",
         "who": ["Johnny"],
         "where": "kitchen",
@@ -449,14 +892,39 @@ Example JSON object:
         ]
 
         if logger:
-            logger.debug(f"Chosen setting: {setting}")
+            logger.debug("Chosen setting: %s", setting)
         if logger:
-            logger.debug(f"New part message: {messages}")
-        data = self.send_gpt_hq_request(messages)
+            logger.debug("New part message: %s", messages)
+        data = self.send_gpt_hq_request(messages, method="generate_story_part")
         return self.__get_json_data(data)
 
     def generate_premise(self, character, complexity, n=2):
+        # Premises name the protagonist: only characters of the same name
+        # share them, matched on the values of their other fields
+        text, scope = str(character), ""
+        if isinstance(character, dict):
+            text = "\n".join(
+                ", ".join(map(str, v)) if isinstance(v, list) else str(v)
+                for k, v in character.items()
+                if k not in ("shortname", "fullname")
+            )
+            scope = json.dumps(
+                [
+                    normalize_entity(character.get("shortname", "")),
+                    normalize_entity(character.get("fullname", "")),
+                ]
+            )
+        return self.__similar(
+            "generate_premise",
+            text,
+            n,
+            lambda: self.__generate_premise(character, n),
+            scope,
+        )
+
+    def __generate_premise(self, character, n):
         # Generate a premise based on the given character
+        count, samples = self.__list_plan(n)
         messages = [
             {
                 "role": "system",
@@ -484,7 +952,7 @@ Example JSON object:
     ]
 }
 """
-                        % (n),
+                        % (count),
                     }
                 ],
             },
@@ -498,11 +966,20 @@ Example JSON object:
                 ],
             },
         ]
-        data = self.send_gpt_lq_request(messages)
-        return self.__get_json_data(data)
+        return self.__send_list_request(
+            messages, n, samples, hq=False, method="generate_premise"
+        )
 
     def generate_init_hints(self, complexity, n=2):
+        # No input besides n: every call lands on the same entry, whose pool
+        # of results the variety policy rotates and renews
+        return self.__similar(
+            "generate_init_hints", "", n, lambda: self.__generate_init_hints(n)
+        )
+
+    def __generate_init_hints(self, n):
         # Generate hints to start an improv story
+        count, samples = self.__list_plan(n)
         messages = [
             {
                 "role": "system",
@@ -511,7 +988,7 @@ Example JSON object:
                         "type": "text",
                         "text": f"""
 You are a helpful assistant fluent in English. help me generate some prompts to start an improvisation performance.
-1. Generate {n} elements, each composed of 3 fields, the first answering the question 'Who?', the second 'Where?' and the third 'What happened?'
+1. Generate {count} elements, each composed of 3 fields, the first answering the question 'Who?', the second 'Where?' and the third 'What happened?'
 2. The answer to 'Who?' should be a character that can be used as a protagonist. (examples: a clown, a turtle, the Pope)
 3. The answer to 'Where?' should be a location where the story takes place.
 4. The answer to 'What happened?' should be a short event that can be used as the starting point of the story.
@@ -535,12 +1012,66 @@ Example JSON object:
                 ],
             },
         ]
-        data = self.send_gpt_hq_request(
-            messages, temperature=1.3
+        return self.__send_list_request(
+            messages, n, samples, temperature=1.3, method="generate_init_hints"
         )  # TODO: change temperature?
-        return self.__get_json_data(data)
 
-    def generate_character(self, drawing_url, complexity):
+    def generate_character(self, drawing_url, complexity, detail="auto"):
+        # Same drawing (or a re-photo of it) within CHARACTER_CACHE_DISTANCE bits
+        # of perceptual hash returns the character generated the first time
+        try:
+            key = data_url_phash(drawing_url)
+        except Exception as e:
+            if logger:
+                logger.warning("Cannot hash drawing: %s", e)
+            return self.__generate_character(drawing_url, detail)
+
+        cached = self.characters.get(key)
+        if cached is not None:
+            distance, result = cached
+            if logger:
+                logger.debug("Character cache hit (distance %s)", distance)
+            if self.characters.should_audit():
+                threading.Thread(
+                    target=self.__audit_character,
+                    args=(drawing_url, detail, distance, result),
+                    daemon=True,
+                ).start()
+            return result
+
+        result = self.__generate_character(drawing_url, detail)
+        if result and result.get("character"):
+            self.characters.put(key, result)
+        return result
+
+    def __audit_character(self, drawing_url, detail, distance, cached):
+        # False-match check of a cache hit: same character name or most drawn
+        # items in common with a fresh generation
+        try:
+            fresh = self.__generate_character(drawing_url, detail, "audit_character")
+            if not fresh:
+                return
+            names = [
+                (r.get("character") or {}).get("fullname", "").strip().lower()
+                for r in (cached, fresh)
+            ]
+            items = [
+                {
+                    i.get("name", "").lower()
+                    for i in (r.get("image") or {}).get("items", [])
+                }
+                for r in (cached, fresh)
+            ]
+            overlap = len(items[0] & items[1]) / max(len(items[0] | items[1]), 1)
+            same = names[0] == names[1] or overlap >= 0.5
+            self.characters.audit(distance, cached, fresh, same)
+            if logger and not same:
+                logger.warning("Character cache false match at distance %s", distance)
+        except Exception as e:
+            if logger:
+                logger.error("Character cache audit failed: %s", e)
+
+    def __generate_character(self, drawing_url, detail, method="generate_character"):
         messages = [
             {
                 "role": "system",
@@ -591,34 +1122,46 @@ Here is an example JSON object:
                 "content": [
                     {
                         "type": "image_url",
-                        "image_url": {"url": drawing_url},
+                        "image_url": {"url": drawing_url, "detail": detail},
                     },
                 ],
             },
         ]
-        data = self.send_vision_request(messages)
+        data = self.send_vision_request(messages, method=method)
         return self.__get_json_data(data)
 
     def generate_story_image(self, story_part):
-        content = story_part["content"]
-        style = story_part["style"]
-
-        prompt = f"""
-{content}.
+        # The story generators return an image-ready "image_prompt" next to
+        # the "keymoment" description. Either one is completed locally with
+        # the style; the LLM rewrite is only left for parts that have neither.
+        content = story_part.get("image_prompt") or story_part.get("content")
+        style = story_part.get("style")
+
+        if content:
+            prompt = IMAGE_PROMPT_TEMPLATE.format(
+                scene=content.strip().rstrip("."),
+                style=style or "children's book illustration",
+            )
+        else:
+            prompt = f"""
+{story_part.get("text")}.
 In the style of: {style}.
 """
-        prompt = self.__improve_prompt(
-            prompt, "image generation model to generate drawings"
-        )
-        prompt = prompt["new_prompt"]
+            prompt = self.__improve_prompt(
+                prompt, "image generation model to generate drawings"
+            )
+            prompt = prompt["new_prompt"]
 
-        result = self.send_image_request(prompt)
+        result = self.send_image_request(prompt, method="generate_story_image")
         return {"prompt": prompt, "image_url": result}
 
     def generate_character_improv(self, transcript, motion, hints=[], end=False):
         if logger:
             logger.debug(
-                f"Generating character from improv: {transcript}, {motion}, {hints}."
+                "Generating character from improv: %s, %s, %s.",
+                transcript,
+                motion,
+                hints,
             )
 
         sys_msg = """
@@ -657,6 +1200,7 @@ Explanation of the output format:
         'fears': what they fear,
         'personality': 3 main traits of his personality,
         'backstory': a short backstory about the character using 200 characters,
+        'appearance': what the character looks like, as a prompt for an image generation model, safe and without names,
     }
 }
 
@@ -670,6 +1214,7 @@ Here is an example JSON object:
         'fears': ['being hungry', 'being alone'],
         'personality': ['friendly', 'gluttonous', 'playful'],
         'backstory': 'Johnny the cat loves tuna. He is always hungry and looking for food. He is a very friendly cat and loves to play with his toys.',
+        'appearance': 'A chubby orange tabby cat with big green eyes and a red collar, sitting next to a toy mouse.',
     }
 }
 """
@@ -693,7 +1238,7 @@ Here is an example JSON object:
                 ],
             },
         ]
-        data = self.send_gpt_hq_request(messages)
+        data = self.send_gpt_hq_request(messages, method="generate_character_improv")
         return self.__get_json_data(data)
 
     def generate_premise_improv(
@@ -702,7 +1247,7 @@ Here is an example JSON object:
         # Generate a story part based on the imrprov result
         improv = {"dialogue": transcript, "motion": motion}
         if logger:
-            logger.debug(f"Improv in generate_premise_improv(): {improv}")
+            logger.debug("Improv in generate_premise_improv(): %s", improv)
 
         messages = [
             {
@@ -762,24 +1307,31 @@ Example JSON object:
                 ],
             },
         ]
-        data = self.send_gpt_hq_request(messages)
+        data = self.send_gpt_hq_request(messages, method="generate_premise_improv")
         return self.__get_json_data(data)
 
     def generate_character_image_improv(self, character):
-
-        prompt = f"""
+        appearance = isinstance(character, dict) and character.get("appearance")
+        if appearance:
+            prompt = IMAGE_PROMPT_TEMPLATE.format(
+                scene=appearance.strip().rstrip("."), style="realistic"
+            )
+        else:
+            prompt = f"""
 Generate an image using the description of the character: {character}.
 Use a realistic style.
 """
-        prompt = self.__improve_prompt(
-            prompt, "image generation model to generate drawings"
-        )
-        if logger:
-            logger.debug(f"Improved prompt: {prompt}")
+            prompt = self.__improve_prompt(
+                prompt, "image generation model to generate drawings"
+            )
+            if logger:
+                logger.debug("Improved prompt: %s", prompt)
 
-        prompt = prompt["new_prompt"]
+            prompt = prompt["new_prompt"]
 
-        result = self.send_image_request(prompt)
+        result = self.send_image_request(
+            prompt, method="generate_character_image_improv"
+        )
         return {"prompt": prompt, "image_url": result}
 
     def generate_character_premise_improv(
@@ -789,7 +1341,7 @@ Use a realistic style.
         ctx = {"hints": hints, "end": end}
         if logger:
             logger.debug(
-                f"Improv in generate_character_premise_improv(): {improv}, {ctx}"
+                "Improv in generate_character_premise_improv(): %s, %s", improv, ctx
             )
 
         sys_msg = """
@@ -833,6 +1385,7 @@ Explanation of the output format:
         'fears': what they fear,
         'personality': 3 main traits of his personality,
         'backstory': a short backstory about the character using 200 characters,
+        'appearance': what the character looks like, as a prompt for an image generation model, safe and without names,
     }
     'premise': {
         'title': a short title for the premise,
@@ -850,6 +1403,7 @@ Here is an example JSON object:
         'fears': ['being hungry', 'being alone'],
         'personality': ['friendly', 'gluttonous', 'playful'],
         'backstory': 'Johnny the cat loves tuna. He is always hungry and looking for food. He is a very friendly cat and loves to play with his toys.',
+        'appearance': 'A chubby orange tabby cat with big green eyes and a red collar, sitting next to a toy mouse.',
     }
     'premise': {
         'title': 'Rescue Mission',
@@ -881,19 +1435,12 @@ Analyze the following improvisational performance with reference to the audio tr
             },
             {
                 "role": "user",
-                "content": [
-                    "These are video frames in order.",
-                    *map(
-                        lambda frame: {
-                            "type": "image_url",
-                            "image_url": {"url": f"{frame}", "detail": "low"},
-                        },
-                        frames,
-                    ),
-                ],
+                "content": self.__motion_content(frames),
             },
         ]
-        data = self.send_gpt_hq_request(messages)
+        data = self.send_gpt_hq_request(
+            messages, method="generate_character_premise_improv"
+        )
         return self.__get_json_data(data)
 
     def generate_story_improv(
@@ -903,7 +1450,7 @@ Analyze the following improvisational performance with reference to the audio tr
         ctx = {"story": story, "hints": hints, "end": end}
         if logger:
             logger.debug(
-                f"Improv in generate_character_premise_improv(): {improv}, {ctx}"
+                "Improv in generate_character_premise_improv(): %s, %s", improv, ctx
             )
 
         length = random.choice([1, 1, 1, 2, 2, 3, 4])
@@ -958,6 +1505,7 @@ Explanation of the output format:
 {
     "text": Narration of the new story part,
     "keymoment": Key moment in the story part,
+    "image_prompt": Key moment as a detailed prompt for an image generation model, safe and without names,
     "sentiment": Sentiment of the story part,
     "who": Characters (one or more) present in the story part,
     "where": Location where the story takes place,
@@ -967,7 +1515,8 @@ Explanation of the output format:
 Here is an example JSON object:
 {
     "text": "He looked around to investigate as if searching for something and found that someone had stolen his tuna!",
-    "keymoment": "A can of tune filled with tuna that is overflowing to the floor in a kitchen."
+    "keymoment": "A can of tune filled with tuna that is overflowing to the floor in a kitchen.",
+    "image_prompt": "A bright kitchen floor covered in tuna spilling from an overturned can, toys scattered nearby, warm afternoon light.",
     "sentiment": "sad",
     "who": ["Johnny"],
     "where": "kitchen",
@@ -998,19 +1547,10 @@ Analyze the following improvisational performance with reference to the audio tr
             },
             {
                 "role": "user",
-                "content": [
-                    "These are video frames in order.",
-                    *map(
-                        lambda frame: {
-                            "type": "image_url",
-                            "image_url": {"url": f"{frame}", "detail": "low"},
-                        },
-                        frames,
-                    ),
-                ],
+                "content": self.__motion_content(frames),
             },
         ]
-        data = self.send_gpt_hq_request(messages)
+        data = self.send_gpt_hq_request(messages, method="generate_story_improv")
         return self.__get_json_data(data)
 
     def generate_ending_improv(
@@ -1020,7 +1560,7 @@ Analyze the following improvisational performance with reference to the audio tr
         ctx = {"story": story, "hints": hints, "end": end}
         if logger:
             logger.debug(
-                f"Improv in generate_character_premise_improv(): {improv}, {ctx}"
+                "Improv in generate_character_premise_improv(): %s, %s", improv, ctx
             )
 
         sys_msg = f"""
@@ -1070,6 +1610,7 @@ Explanation of the output format:
 {
     "text": Narration of the ending,
     "keymoment": Key moment in the ending,
+    "image_prompt": Key moment as a detailed prompt for an image generation model, safe and without names,
     "sentiment": Sentiment of the ending,
     "who": Characters (one or more) present in the ending,
     "where": Location where the story takes place,
@@ -1080,6 +1621,7 @@ Here is an example JSON object:
 {
     "text": "Johnny found his tuna in the fridge, safe and sound, and decided to share it with his girlfriend Tina.",
     "keymoment": "A can of tuna in the fridge, untouched and ready to be eaten.",
+    "image_prompt": "An open fridge glowing in a dark kitchen, a full can of tuna on the middle shelf, cozy and calm night atmosphere.",
     "sentiment": "happy",
     "who": ["Johnny", "Tina"],
     "where": "kitchen",
@@ -1110,19 +1652,10 @@ Analyze the following improvisational performance with reference to the audio tr
             },
             {
                 "role": "user",
-                "content": [
-                    "These are video frames in order.",
-                    *map(
-                        lambda frame: {
-                            "type": "image_url",
-                            "image_url": {"url": f"{frame}", "detail": "low"},
-                        },
-                        frames,
-                    ),
-                ],
+                "content": self.__motion_content(frames),
             },
         ]
-        data = self.send_gpt_hq_request(messages)
+        data = self.send_gpt_hq_request(messages, method="generate_ending_improv")
         return self.__get_json_data(data)
 
     def generate_ending_exercise_improv(
@@ -1132,7 +1665,7 @@ Analyze the following improvisational performance with reference to the audio tr
         ctx = {"hints": hints, "end": end}
         if logger:
             logger.debug(
-                f"Improv in generate_character_premise_improv(): {improv}, {ctx}"
+                "Improv in generate_character_premise_improv(): %s, %s", improv, ctx
             )
 
         sys_msg = f"""
@@ -1176,6 +1709,7 @@ Explanation of the output format:
 {
     "text": Narration of the ending,
     "keymoment": Key moment in the ending,
+    "image_prompt": Key moment as a detailed prompt for an image generation model, safe and without names,
     "sentiment": Sentiment of the ending,
     "who": Characters (one or more) present in the ending,
     "where": Location where the story takes place,
@@ -1186,6 +1720,7 @@ Here is an example JSON object:
 {
     "text": "Johnny found his tuna in the fridge, safe and sound, and decided to share it with his girlfriend Tina.",
     "keymoment": "A can of tuna in the fridge, untouched and ready to be eaten.",
+    "image_prompt": "An open fridge glowing in a dark kitchen, a full can of tuna on the middle shelf, cozy and calm night atmosphere.",
     "sentiment": "happy",
     "who": ["Johnny", "Tina"],
     "where": "kitchen",
@@ -1216,24 +1751,17 @@ Analyze the following improvisational performance with reference to the audio tr
             },
             {
                 "role": "user",
-                "content": [
-                    "These are video frames in order.",
-                    *map(
-                        lambda frame: {
-                            "type": "image_url",
-                            "image_url": {"url": f"{frame}", "detail": "low"},
-                        },
-                        frames,
-                    ),
-                ],
+                "content": self.__motion_content(frames),
             },
         ]
-        data = self.send_gpt_hq_request(messages)
+        data = self.send_gpt_hq_request(
+            messages, method="generate_ending_exercise_improv"
+        )
         return self.__get_json_data(data)
 
     def translate_text(self, text, source_language="en", target_language="en"):
-        source = Language.get(source_language)
-        target = Language.get(target_language)
+        source = langcodes.Language.get(source_language)
+        target = langcodes.Language.get(target_language)
         # Translate the given text to the target language using LLM
         messages = [
             {
@@ -1267,18 +1795,18 @@ Example JSON object:
             },
         ]
 
-        response = self.send_gpt_lq_request(messages)
+        response = self.send_gpt_lq_request(messages, method="translate_text")
         response = self.__get_json_data(response)
         data = response["translation"]
         if logger:
-            logger.debug(f"Translated text: {data}")
+            logger.debug("Translated text: %s", data)
         return data
 
     def translate_keypoints(self, kp, source_language="en", target_language="en"):
         if logger:
-            logger.debug(f"Keypoints in translate_keypoints: {kp}")
-        source = Language.get(source_language)
-        target = Language.get(target_language)
+            logger.debug("Keypoints in translate_keypoints: %s", kp)
+        source = langcodes.Language.get(source_language)
+        target = langcodes.Language.get(target_language)
         # Translate the given text to the target language using LLM
         messages = [
             {
@@ -1313,16 +1841,16 @@ Example JSON object:
             },
         ]
 
-        response = self.send_gpt_lq_request(messages)
+        response = self.send_gpt_lq_request(messages, method="translate_keypoints")
         response = self.__get_json_data(response)
         if logger:
-            logger.debug(f"Translated keypoints: {response}")
+            logger.debug("Translated keypoints: %s", response)
         return response
 
     def process_motion(self, frames, story):
         if logger:
-            logger.debug(f"Processing motion...")
-            logger.debug(f"Story: {story}")
+            logger.debug("Processing motion...")
+            logger.debug("Story: %s", story)
 
         messages = [
             {
@@ -1359,41 +1887,44 @@ Example:
             },
             {
                 "role": "user",
-                "content": [
-                    "These are video frames in order.",
-                    *map(
-                        lambda frame: {
-                            "type": "image_url",
-                            "image_url": {"url": f"{frame}", "detail": "low"},
-                        },
-                        frames,
-                    ),
-                ],
+                "content": self.__motion_content(frames),
             },
         ]
 
-        data = self.send_gpt_hq_request(messages)
+        data = self.send_gpt_hq_request(messages, method="process_motion")
         return self.__get_json_data(data)
 
-    def speech_to_text(self, audio_file):
+    def speech_to_text(self, audio_file, deadline=None, method="speech_to_text"):
+        deadline = deadline or current_deadline()
         if logger:
-            logger.debug(f"Audio file: {audio_file}")
-        transcript = self.llm.audio.transcriptions.create(
-            model=self.stt,
-            file=audio_file,
-            language="en",
-            prompt="""
+            logger.debug("Audio file: %s", audio_file)
+        with self.__limit(self.stt, method=method, deadline=deadline):
+            transcript = self.__client(deadline).audio.transcriptions.create(
+                model=self.stt,
+                file=audio_file,
+                language="en",
+                prompt="""
 The following is a recording of an improv performance.
 The language is conversational, with some abrupt changes in tone or topic.
 Please prioritize capturing the essence of the dialogue, including pauses, interruptions and reactions.""",
-            response_format="json",
-        )
+                response_format="json",
+            )
         return transcript
 
+    def transcribe_media(self, media_id, deadline=None):
+        # Transcript of audio in the media store, transcribed once per take
+        def transcribe():
+            audio_file = io.BytesIO(self.media.audio(media_id))
+            audio_file.name = "audio.webm"
+            result = self.speech_to_text(audio_file, deadline)
+            return result.to_dict() if hasattr(result, "to_dict") else result.__dict__
+
+        return self.media.derive(media_id, "transcript", transcribe)
+
     def process_improv_noctx(self, end, frames, hints=[], transcript="Hello"):
         if logger:
             logger.debug(
-                f"Transcript: {transcript}, Hints: {hints}. Processing motion..."
+                "Transcript: %s, Hints: %s. Processing motion...", transcript, hints
             )
 
         sys_msg = """
@@ -1456,27 +1987,18 @@ Analyze the following improvisational performance with reference to the audio tr
             },
             {
                 "role": "user",
-                "content": [
-                    "These are video frames in order.",
-                    *map(
-                        lambda frame: {
-                            "type": "image_url",
-                            "image_url": {"url": f"{frame}", "detail": "low"},
-                        },
-                        frames,
-                    ),
-                ],
+                "content": self.__motion_content(frames),
             },
         ]
 
         if logger:
-            logger.debug(f"Messages: {sys_msg}")
-        data = self.send_gpt_hq_request(messages)
+            logger.debug("Messages: %s", sys_msg)
+        data = self.send_gpt_hq_request(messages, method="process_improv_noctx")
         return self.__get_json_data(data)
 
     def process_improv_ctx(self, end, frames, story, hints=[], transcript="Hello"):
         if logger:
-            logger.debug(f"Transcript: {transcript}. Processing improv...")
+            logger.debug("Transcript: %s. Processing improv...", transcript)
 
         sys_msg = """
 You are a performance choreographer specializing in improvisation. 
@@ -1543,22 +2065,13 @@ Example:
             },
             {
                 "role": "user",
-                "content": [
-                    "These are video frames in order.",
-                    *map(
-                        lambda frame: {
-                            "type": "image_url",
-                            "image_url": {"url": f"{frame}", "detail": "low"},
-                        },
-                        frames,
-                    ),
-                ],
+                "content": self.__motion_content(frames),
             },
         ]
 
         if logger:
-            logger.debug(f"Messages: {sys_msg}, story: {story}")
-        data = self.send_gpt_hq_request(messages)
+            logger.debug("Messages: %s, story: %s", sys_msg, story)
+        data = self.send_gpt_hq_request(messages, method="process_improv_ctx")
         return self.__get_json_data(data)
 
     def generate_part_improv(
@@ -1566,13 +2079,20 @@ Example:
     ):  # TODO: change randomizer, complexity?
         # Generate a story part based on the motion labeling result
         if logger:
-            logger.debug(f"Context in generate_part_improv(): {context}")
+            logger.debug("Context in generate_part_improv(): %s", context)
         premise = context.get("premise")
         story = context.get("story")
-        keypoint = context.get("keypoint")
-        who = keypoint[1]
-        where = keypoint[2]
-        objects = keypoint[3]
+        keypoint = self.get_keypoints(context.get("story_id"), context.get("keypoint"))
+        if isinstance(keypoint, dict):
+            who = keypoint["who"]
+            where = keypoint["where"]
+            objects = keypoint["objects"]
+        else:
+            # Fall back to the last row of the client-side keypoints table
+            keypoint = context.get("keypoint") or [None, None, None, None]
+            who = keypoint[1]
+            where = keypoint[2]
+            objects = keypoint[3]
         improv = context.get("improv").get("data")
         action = improv.get("action")
         desc = improv.get("description")
@@ -1591,9 +2111,9 @@ Example:
             "objects": objects,
         }
         if logger:
-            logger.debug(f"Ctx in generate_part_improv(): {ctx}")
+            logger.debug("Ctx in generate_part_improv(): %s", ctx)
             logger.debug(
-                f"Keypoint in generate_part_improv(): {who}\n{where}\n{objects}"
+                "Keypoint in generate_part_improv(): %s\n%s\n%s", who, where, objects
             )
 
         length = random.choice([1, 1, 1, 2, 2, 3, 4])
@@ -1659,6 +2179,7 @@ For example:
 5. Generate a short visual description of a key moment in the new part:
     - Describe the environment.
     - Do not name the main character.
+    - Also write the key moment as "image_prompt": one detailed paragraph for an image generation model. Keep it safe and respectful, and do not mention any names.
 6. Categorize the sentiment of the new part. Choose from: 'happy', 'sad', 'neutral', 'shocking'.
 7. Return as a JSON object.
     - No styling and all in ascii characters.
@@ -1668,7 +2189,8 @@ Example JSON object:
 {
     "part": {
         "text": "He looked around to investigate as if searching for something and found that someone had stolen his tuna!",
-        "keymoment": "A can of tune filled with tuna that is overflowing to the floor in a kitchen."
+        "keymoment": "A can of tune filled with tuna that is overflowing to the floor in a kitchen.",
+        "image_prompt": "A bright kitchen floor covered in tuna spilling from an overturned can, toys scattered nearby, warm afternoon light.",
         "sentiment": "sad",
         "who": ["Johnny"],
         "where": "kitchen",
@@ -1693,7 +2215,7 @@ Example JSON object:
 
         # if logger:
         #     logger.debug(f"Chosen setting: {setting}")
-        data = self.send_gpt_hq_request(messages)
+        data = self.send_gpt_hq_request(messages, method="generate_part_improv")
         return self.__get_json_data(data)
 
     def generate_story_to_end(self, limit=500):  # TODO: character limit ok?
@@ -1711,6 +2233,7 @@ You a great storyteller.
     - Event: Describe an unusual or intriguing situation that the character encounters.
 2. Develop the story so that it sets up a decision point or situation the character must respond to, without concluding the story.
 3. Generate a visual description of a key moment in this part, capture the atmosphere and scene details.
+    - Also write the key moment as "image_prompt": one detailed paragraph for an image generation model. Keep it safe and respectful, and do not mention any names.
 4. Categorize the sentiment of the new part using one of the following: 'happy', 'sad', 'neutral', 'shocking'.
 5. Return as a JSON object.
     - Ensure the "text" field is under %s characters.
@@ -1721,6 +2244,7 @@ Example JSON object:
 {
     "text": "The young girl, Anna Maria, stood alone in the clearing, clutching the mysterious letter she found in her grandmother's attic.",
     "keymoment": "A quiet clearing surrounded by tall, ancient trees, where faint sunlight filters through, casting shadows on the letter she holds.",
+    "image_prompt": "A quiet forest clearing among tall ancient trees, thin rays of sunlight falling on an open letter held in small hands, soft shadows.",
     "sentiment": "neutral",
 }
 """
@@ -1738,11 +2262,12 @@ Example JSON object:
                 ],
             },
         ]
-        data = self.send_gpt_hq_request(messages)
+        data = self.send_gpt_hq_request(messages, method="generate_story_to_end")
         return self.__get_json_data(data)
 
     def generate_end_hints(self, complexity, n=2):
         # Generate hints to end an improv story
+        count, samples = self.__list_plan(n)
         messages = [
             {
                 "role": "system",
@@ -1751,7 +2276,7 @@ Example JSON object:
                         "type": "text",
                         "text": f"""
 You are a helpful assistant fluent in English. Help me generate some possible endings for a story.
-1. Generate {n} elements, each include 4 possible endings to inspire how the story might conclude, using these categories:
+1. Generate {count} elements, each include 4 possible endings to inspire how the story might conclude, using these categories:
     - happy: A joyful or fulfilling resolution.
     - sad: A melancholy or emotional conclusion.
     - absurd: A surreal or comically unexpected turn of events.
@@ -1780,8 +2305,9 @@ Example JSON object:
 
         # if logger:
         #     logger.debug(f"Messsages: {messages}")
-        data = self.send_gpt_hq_request(messages, temperature=1.2)
-        return self.__get_json_data(data)
+        return self.__send_list_request(
+            messages, n, samples, temperature=1.2, method="generate_end_hints"
+        )
 
     def terminate_story_improv(self, story, improv):
         messages = [
@@ -1799,6 +2325,7 @@ You are a skilled storyteller.
     - Be true to the user's intentions, don't introduce anything else.
 3. Include a short visual description of a key moment in the conclusion.
     - Capture the atmosphere and environment in a vivid scene.
+    - Also write the key moment as "image_prompt": one detailed paragraph for an image generation model. Keep it safe and respectful, and do not mention any names.
 4. Categorize the sentiment of this part using one of the following: 'happy', 'sad', 'neutral', or 'shocking'.
 5. Return the response as a JSON object with the following fields:
     - No styling, and use ASCII characters only.
@@ -1809,6 +2336,7 @@ Example JSON object:
     "part": {
         "text": "The character finally reached the town, carrying the weight of their journey, ready to start anew.",
         "keymoment": "The sun rises over the quiet town, casting a hopeful light on the character's face as they arrive.",
+        "image_prompt": "Sunrise over a quiet little town, long golden light on the rooftops and on a traveler arriving at the main road, hopeful mood.",
         "sentiment": "happy",
         "who": ["character"],
         "where": "town",
@@ -1831,7 +2359,7 @@ Example JSON object:
             },
         ]
         data = self.send_gpt_hq_request(
-            messages, temperature=0.5
+            messages, temperature=0.5, method="terminate_story_improv"
         )  # TODO: change temperature?
         return self.__get_json_data(data)
 
@@ -1881,12 +2409,149 @@ Example JSON object:
                 ],
             },
         ]
-        data = self.send_gpt_hq_request(messages)
+        data = self.send_gpt_hq_request(messages, method="generate_questions")
         return self.__get_json_data(data)
 
     # -- LLM Request Functions --
 
-    def send_vision_request(self, request):
+    def __limit(self, model, request=None, max_tokens=0, method=None, deadline=None):
+        # Wait for rate limiter capacity before sending a request upstream,
+        # but never past the deadline of the HTTP request we are serving
+        if deadline:
+            deadline.check()
+        priority = LIMITER_PRIORITY.get(method, PRIORITY_INTERACTIVE)
+        tokens = estimate_tokens(request, max_tokens) if request else 0
+        expires = deadline.expires if deadline else None
+        return self.limiter.limit(model, tokens, priority, expires)
+
+    def __client(self, deadline=None):
+        # OpenAI client whose timeout is bounded by the remaining budget
+        if deadline:
+            deadline.check()
+            return self.llm.with_options(timeout=deadline.timeout())
+        return self.llm
+
+    def __route(self, method, model, request, endpoint="chat"):
+        # Models to try for a call of the method, best first (ROUTES)
+        return self.router.route(method, model, estimate_tokens(request), endpoint)
+
+    def __probe_chat(self, model):
+        # Cheapest chat call, to tell whether a model's breaker may close
+        with self.__limit(model, method="breaker_probe"):
+            self.llm.with_options(
+                timeout=BREAKER_PROBE_TIMEOUT
+            ).chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": "ping"}],
+                max_tokens=1,
+            )
+
+    def __cached(self, method, send, model, request, is_json=False, **params):
+        # Serve the response from the exact-match cache if `method` is listed
+        # in RESPONSE_CACHE, keyed by a canonical hash of the whole request
+        if not self.responses.enabled(method):
+            return send()
+        key = fingerprint(model, request, is_json=is_json, **params)
+        content = self.responses.get(method, key)
+        if content is not None:
+            if logger:
+                logger.debug("Response cache hit for %s", method)
+            return content
+        content = send()
+        if content is not None and (
+            not is_json or self.__get_json_data(content) is not None
+        ):
+            self.responses.put(method, key, content)
+        return content
+
+    def send_vision_request(self, request, method=None, deadline=None):
+        return self.__cached(
+            method,
+            lambda: self.__send_vision_request(request, method, deadline),
+            self.vision,
+            request,
+        )
+
+    def send_gpt_hq_request(
+        self,
+        request,
+        is_json=True,
+        temperature=1.0,
+        presence_penalty=0.0,
+        method=None,
+        deadline=None,
+    ):
+        return self.__cached(
+            method,
+            lambda: self.__send_routed_request(
+                self.gpt4,
+                request,
+                is_json,
+                temperature,
+                presence_penalty,
+                method,
+                deadline,
+            ),
+            self.gpt4,
+            request,
+            is_json,
+            temperature=temperature,
+            presence_penalty=presence_penalty,
+        )
+
+    def send_gpt_lq_request(
+        self,
+        request,
+        is_json=True,
+        temperature=1.0,
+        presence_penalty=0.0,
+        method=None,
+        deadline=None,
+    ):
+        return self.__cached(
+            method,
+            lambda: self.__send_routed_request(
+                self.gpt4mini,
+                request,
+                is_json,
+                temperature,
+                presence_penalty,
+                method,
+                deadline,
+            ),
+            self.gpt4mini,
+            request,
+            is_json,
+            temperature=temperature,
+            presence_penalty=presence_penalty,
+        )
+
+    def __send_vision_request(self, request, method=None, deadline=None):
+        # Like the chat requests, tries the models of the method's route
+        deadline = deadline or current_deadline()
+        models = self.__route(method, self.vision, request, "vision")
+        for model in models:
+            try:
+                return self.__budgeted(
+                    method,
+                    1,
+                    deadline,
+                    lambda max_tokens: self.__send_vision_call(
+                        model, request, method, deadline, max_tokens
+                    ),
+                )
+            except (RateLimitTimeout, DeadlineExceeded) as e:
+                if logger:
+                    logger.error(e)
+                raise e
+            except Exception as e:
+                if model == models[-1]:
+                    raise e
+                if deadline:
+                    deadline.check(DEADLINE_MIN_FALLBACK)
+
+    def __send_vision_call(self, model, request, method, deadline, max_tokens):
+        response = None
         try:
             headers = {
                 "Content-Type": "application/json",
@@ -1894,113 +2559,325 @@ Example JSON object:
                 "OpenAI-Organization": f"{self.llm.organization}",
             }
             payload = {
-                "model": self.vision,
+                "model": model,
                 "messages": request,
-                "max_tokens": 4096,
+                "max_tokens": max_tokens,
             }
-            response = requests.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers=headers,
-                json=payload,
-            )
+            breaker = self.breakers.get(model, "vision")
+            breaker.allow()
+            with self.__limit(model, request, max_tokens, method, deadline) as lease:
+                start = time.time()
+                try:
+                    response = requests.post(
+                        f"{self.base_url}/chat/completions",
+                        headers=headers,
+                        json=payload,
+                        stream=True,
+                        timeout=deadline.timeout() if deadline else None,
+                    )
+                    with response:
+                        body = b"".join(
+                            within(response.iter_content(chunk_size=1024), deadline)
+                        )
+                except Exception as e:
+                    breaker.record(time.time() - start, e)
+                    raise
+                breaker.record(
+                    time.time() - start, None if response.ok else response.status_code
+                )
+                if response.status_code == 429:
+                    self.limiter.penalize(
+                        model, float(response.headers.get("retry-after", 1))
+                    )
+                jresponse = json.loads(body)
+                lease.used = jresponse.get("usage", {}).get("total_tokens")
+                self.metrics.record(
+                    method,
+                    model,
+                    time.time() - start,
+                    jresponse.get("usage"),
+                    count_images(request),
+                    None if response.ok else response.status_code,
+                )
             if logger:
                 logger.debug(
-                    f"Successfuly sent 'vision' LLM request with model={self.vision}"
+                    "Successfuly sent 'vision' LLM request with model=%s", model
                 )
-                logger.debug(f"Response = {response.json()}")
+                logger.debug("Response = %s", jresponse)
 
-            jresponse = response.json()
-            return jresponse["choices"][0]["message"]["content"]
+            choice = jresponse["choices"][0]
+            return (
+                choice["message"]["content"],
+                jresponse.get("usage", {}).get("completion_tokens"),
+                [choice.get("finish_reason")],
+            )
         except Exception as e:
             if logger:
                 logger.error(str(e) + str(response))
             raise e
 
-    def send_gpt_hq_request(
-        self, request, is_json=True, temperature=1.0, presence_penalty=0.0
-    ):
-        try:
-            response = self.llm.chat.completions.create(
-                model=self.gpt4,
-                messages=request,
-                response_format={"type": "json_object"} if is_json else None,
-                max_tokens=4096,
-                temperature=temperature,
-                presence_penalty=presence_penalty,
+    def __budgeted(self, method, n, deadline, send):
+        # send(max_tokens) -> (result, completion tokens, finish reasons) with
+        # the method's output budget (TokenBudgets). When every completion
+        # was cut at the budget it is sent again with twice the room, up to
+        # BUDGET_LIMIT. The sizes of complete responses tune the budget.
+        max_tokens = self.budgets.budget(method)
+        while True:
+            result, tokens, reasons = send(max_tokens)
+            if not reasons or not all(reason == "length" for reason in reasons):
+                if tokens is not None and "length" not in reasons:
+                    self.budgets.observe(method, tokens / n)
+                return result
+            retry = max_tokens < self.budgets.limit and (
+                not deadline or deadline.remaining() >= DEADLINE_MIN_FALLBACK
             )
+            self.budgets.truncated(method, retry)
+            if not retry:
+                return result
             if logger:
-                logger.debug(
-                    f"Successfuly sent 'chat' LLM request with model={self.gpt4}"
+                logger.warning(
+                    "%s cut at max_tokens=%s, sending it again", method, max_tokens
                 )
+            max_tokens = min(max_tokens * 2, self.budgets.limit)
 
-            jresponse = json.loads(response.model_dump_json())
+    def __send_chat_request(
+        self,
+        model,
+        request,
+        is_json,
+        temperature,
+        presence_penalty,
+        method,
+        deadline,
+        n=1,
+    ):
+        def send(max_tokens):
+            response = self.__send_chat_call(
+                model,
+                request,
+                is_json,
+                temperature,
+                presence_penalty,
+                method,
+                deadline,
+                n,
+                max_tokens,
+            )
+            return (
+                response,
+                response.usage.completion_tokens if response.usage else None,
+                [choice.finish_reason for choice in response.choices],
+            )
 
-            return jresponse["choices"][0]["message"]["content"]
-        except Exception as e:
-            if logger:
-                logger.error(e)
-            raise e
-        finally:
-            if logger:
-                logger.debug("Using a model with a higher limit of tokens per minute.")
+        return self.__budgeted(method, n, deadline, send)
+
+    def __send_chat_call(
+        self,
+        model,
+        request,
+        is_json,
+        temperature,
+        presence_penalty,
+        method,
+        deadline,
+        n,
+        max_tokens,
+    ):
+        breaker = self.breakers.get(model, "chat")
+        breaker.allow()
+        with self.__limit(model, request, max_tokens * n, method, deadline) as lease:
+            start = time.time()
             try:
-                response = self.llm.chat.completions.create(
-                    model=self.gpt4mini,
+                response = self.__client(deadline).chat.completions.create(
+                    model=model,
                     messages=request,
                     response_format={"type": "json_object"} if is_json else None,
-                    max_tokens=4096,
+                    max_tokens=max_tokens,
                     temperature=temperature,
                     presence_penalty=presence_penalty,
+                    n=n,
+                )
+            except Exception as e:
+                breaker.record(time.time() - start, e)
+                self.metrics.record(
+                    method,
+                    model,
+                    time.time() - start,
+                    images=count_images(request),
+                    error=type(e).__name__,
+                )
+                raise
+            breaker.record(time.time() - start)
+            if response.usage:
+                lease.used = response.usage.total_tokens
+            self.metrics.record(
+                method,
+                model,
+                time.time() - start,
+                response.usage.model_dump() if response.usage else None,
+                count_images(request),
+            )
+        return response
+
+    def __send_routed_request(
+        self, model, request, is_json, temperature, presence_penalty, method, deadline
+    ):
+        # Content of the first model of the method's route that answers,
+        # `model` being the default route (send_gpt_hq/lq_request)
+        deadline = deadline or current_deadline()
+        models = self.__route(method, model, request)
+        for model in models:
+            try:
+                response = self.__send_chat_request(
+                    model,
+                    request,
+                    is_json,
+                    temperature,
+                    presence_penalty,
+                    method,
+                    deadline,
                 )
                 if logger:
                     logger.debug(
-                        f"Successfuly sent 'chat' LLM request with model={self.gpt4}"
+                        "Successfuly sent 'chat' LLM request with model=%s", model
                     )
-
-                jresponse = json.loads(response.model_dump_json())
-
-                return jresponse["choices"][0]["message"]["content"]
-            except Exception as e:
+                return response.choices[0].message.content
+            except (RateLimitTimeout, DeadlineExceeded) as e:
                 if logger:
                     logger.error(e)
                 raise e
+            except Exception as e:
+                if logger:
+                    logger.error(e)
+                if model == models[-1]:
+                    raise e
+                if logger:
+                    logger.debug("Falling back from model=%s", model)
+                if deadline:
+                    # Only start the next model if it can still finish in time
+                    deadline.check(DEADLINE_MIN_FALLBACK)
 
-    def send_gpt_lq_request(
-        self, request, is_json=True, temperature=1.0, presence_penalty=0.0
+    def send_gpt_samples_request(
+        self, request, n, hq=True, temperature=1.0, method=None, deadline=None
     ):
-        try:
-            response = self.llm.chat.completions.create(
-                model=self.gpt4mini,
-                messages=request,
-                response_format={"type": "json_object"} if is_json else None,
-                max_tokens=4096,
-                temperature=temperature,
-                presence_penalty=presence_penalty,
-            )
-            if logger:
-                logger.debug(
-                    f"Successfuly sent 'fast chat' LLM request with model={self.gpt4mini}"
+        # n independent JSON completions of the same request in a single call
+        # (API `n`), as a list of contents. Tries the models of the method's
+        # route like send_gpt_hq_request.
+        deadline = deadline or current_deadline()
+        models = self.__route(method, self.gpt4 if hq else self.gpt4mini, request)
+        for model in models:
+            try:
+                response = self.__send_chat_request(
+                    model, request, True, temperature, 0.0, method, deadline, n
                 )
+                if logger:
+                    logger.debug(
+                        "Successfuly sent 'chat' LLM request with model=%s n=%s",
+                        model,
+                        n,
+                    )
+                return [choice.message.content for choice in response.choices]
+            except (RateLimitTimeout, DeadlineExceeded) as e:
+                if logger:
+                    logger.error(e)
+                raise e
+            except Exception as e:
+                if logger:
+                    logger.error(e)
+                if model == models[-1]:
+                    raise e
+                if deadline:
+                    deadline.check(DEADLINE_MIN_FALLBACK)
 
-            jresponse = json.loads(response.model_dump_json())
-
-            return jresponse["choices"][0]["message"]["content"]
-        except Exception as e:
-            if logger:
-                logger.error(e)
-            raise e
+    def send_gpt_stream_request(
+        self, request, temperature=1.0, method=None, deadline=None
+    ):
+        # Streamed JSON chat completion, yields the content as it arrives.
+        # Like send_gpt_hq_request it tries the models of the method's route,
+        # as long as nothing was streamed yet.
+        deadline = deadline or current_deadline()
+        models = self.__route(method, self.gpt4, request)
+        for model in models:
+            streamed = False
+            try:
+                for delta in self.__stream_chat_request(
+                    model, request, temperature, method, deadline
+                ):
+                    streamed = True
+                    yield delta
+                if logger:
+                    logger.debug(
+                        "Successfuly sent 'stream chat' LLM request with model=%s",
+                        model,
+                    )
+                return
+            except (RateLimitTimeout, DeadlineExceeded) as e:
+                if logger:
+                    logger.error(e)
+                raise e
+            except Exception as e:
+                if logger:
+                    logger.error(e)
+                if streamed or model == models[-1]:
+                    raise e
+                if deadline:
+                    deadline.check(DEADLINE_MIN_FALLBACK)
+
+    def __stream_chat_request(self, model, request, temperature, method, deadline):
+        breaker = self.breakers.get(model, "chat")
+        breaker.allow()
+        # Full budget: a stream cut short could not be sent again
+        with self.__limit(model, request, BUDGET_LIMIT, method, deadline):
+            start = time.time()
+            try:
+                stream = self.__client(deadline).chat.completions.create(
+                    model=model,
+                    messages=request,
+                    response_format={"type": "json_object"},
+                    max_tokens=BUDGET_LIMIT,
+                    temperature=temperature,
+                    stream=True,
+                )
+                for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            except Exception as e:
+                breaker.record(time.time() - start, e)
+                self.metrics.record(
+                    method,
+                    model,
+                    time.time() - start,
+                    images=count_images(request),
+                    error=type(e).__name__,
+                )
+                raise
+            breaker.record(time.time() - start)
+            # Streamed completions carry no usage with this client version
+            self.metrics.record(
+                method, model, time.time() - start, images=count_images(request)
+            )
 
-    def send_image_request(self, request):
+    def send_image_request(self, request, method=None, deadline=None):
+        deadline = deadline or current_deadline()
         try:
-            response = self.llm.images.generate(
-                model=self.image_gen,
-                prompt=request,
-                size=IMAGE_GEN_RESOLUTION,
-                n=1,
-            )
+            breaker = self.breakers.get(self.image_gen, "images")
+            breaker.allow()
+            with self.__limit(self.image_gen, method=method, deadline=deadline):
+                start = time.time()
+                try:
+                    response = self.__client(deadline).images.generate(
+                        model=self.image_gen,
+                        prompt=request,
+                        size=IMAGE_GEN_RESOLUTION,
+                        n=1,
+                    )
+                except Exception as e:
+                    breaker.record(time.time() - start, e)
+                    raise
+                breaker.record(time.time() - start)
             if logger:
                 logger.debug(
-                    f"Successfuly sent 'image' LLM request with model={self.image_gen}"
+                    "Successfuly sent 'image' LLM request with model=%s", self.image_gen
                 )
 
             image_url = response.data[0].url
@@ -2010,9 +2887,9 @@ Example JSON object:
                 logger.error(e)
             raise e
 
-    def send_tts_request(self, text, os="undetermined"):
+    def send_tts_request(self, text, os="undetermined", deadline=None):
         # Based on this answer: https://github.com/openai/openai-python/issues/864#issuecomment-1872681672
-        url = "https://api.openai.com/v1/audio/speech"
+        url = f"{self.base_url}/audio/speech"
         headers = {
             "Authorization": f"Bearer {self.llm.api_key}",
             "OpenAI-Organization": f"{self.llm.organization}",
@@ -2024,18 +2901,43 @@ Example JSON object:
             "response_format": "mp3" if os == "ios" else "opus",
         }
 
-        with requests.post(url, headers=headers, json=data, stream=True) as response:
-            if response.status_code == 200:
+        # Streamed after the view returned, so the deadline is passed explicitly
+        breaker = self.breakers.get(self.tts, "speech")
+        breaker.allow()
+        with self.__limit(self.tts, method="send_tts_request", deadline=deadline):
+            start = time.time()
+            try:
+                response = requests.post(
+                    url,
+                    headers=headers,
+                    json=data,
+                    stream=True,
+                    timeout=deadline.timeout() if deadline else None,
+                )
+            except Exception as e:
+                breaker.record(time.time() - start, e)
+                raise
+            breaker.record(
+                time.time() - start, None if response.ok else response.status_code
+            )
+            with response:
+                if response.status_code == 429:
+                    self.limiter.penalize(
+                        self.tts, float(response.headers.get("retry-after", 1))
+                    )
+                # Fail the stream rather than end it empty, which would look
+                # like a successful (and replayable) response
+                response.raise_for_status()
                 if logger:
                     logger.debug(
-                        f"Successfuly sent 'speech' LLM request with model={self.tts}"
+                        "Successfuly sent 'speech' LLM request with model=%s",
+                        self.tts,
                     )
-                for chunk in response.iter_content(chunk_size=4096):
-                    yield chunk
+                yield from within(response.iter_content(chunk_size=4096), deadline)
 
     def send_stt_request(self, input, translate=False):
         # TODO: Maybe move to file-in-memory approach without saving/opening the file
-        with open(input, "rb") as audio_file:
+        with open(input, "rb") as audio_file, self.__limit(self.stt):
             if translate:
                 transcript = self.llm.audio.translations.create(
                     model=self.stt,
@@ -2044,7 +2946,8 @@ Example JSON object:
                 )
                 if logger:
                     logger.debug(
-                        f"Successfuly sent 'voice (translate)' LLM request with model={self.stt}"
+                        "Successfuly sent 'voice (translate)' LLM request with model=%s",
+                        self.stt,
                     )
                 return transcript.model_dump_json(indent=4)
             else:
@@ -2059,7 +2962,8 @@ Example JSON object:
                 print("Transcribed")
                 if logger:
                     logger.debug(
-                        f"Successfuly sent 'voice (transcribe)' LLM request with model={self.stt}"
+                        "Successfuly sent 'voice (transcribe)' LLM request with model=%s",
+                        self.stt,
                     )
                 print("Dumping JSON")
                 return transcript.model_dump_json(indent=4)
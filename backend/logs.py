@@ -0,0 +1,209 @@
+import atexit
+import copy
+import fcntl
+import json
+import logging
+import os
+import queue
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+SECRET_KEYS = {
+    "api_key",
+    "apikey",
+    "authorization",
+    "password",
+    "secret",
+    "access_token",
+    "refresh_token",
+}
+
+
+def redact(value, limit=1000, items=50, depth=0):
+    # Copy of a log argument that is cheap to keep and to render: data URLs,
+    # bytes and arrays are summarized, long strings truncated, containers
+    # cut to `items` entries and secrets masked
+    if isinstance(value, str):
+        if value.startswith("data:") and ";base64," in value[:100]:
+            return f"<{value[5 : value.index(';')]} data URL, {len(value)} chars>"
+        if len(value) > limit:
+            return f"{value[:limit]}... <{len(value) - limit} more chars>"
+        return value
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f"<{len(value)} bytes>"
+    if hasattr(value, "shape") and hasattr(value, "dtype"):
+        return f"<array {tuple(value.shape)} {value.dtype}>"
+    if isinstance(value, (dict, list, tuple)) and depth >= 8:
+        return f"<{type(value).__name__} of {len(value)}>"
+    if isinstance(value, dict):
+        out = {}
+        for i, (key, item) in enumerate(value.items()):
+            if i == items:
+                out["..."] = f"<{len(value) - items} more keys>"
+                break
+            if isinstance(key, str) and key.lower() in SECRET_KEYS:
+                out[key] = "<redacted>"
+            else:
+                out[key] = redact(item, limit, items, depth + 1)
+        return out
+    if isinstance(value, (list, tuple)):
+        out = [redact(item, limit, items, depth + 1) for item in value[:items]]
+        if len(value) > items:
+            out.append(f"<{len(value) - items} more items>")
+        return out if isinstance(value, list) else tuple(out)
+    return value
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line, the rendered message capped to `limit` chars
+    def __init__(self, limit=10000):
+        super().__init__()
+        self.limit = limit
+
+    def format(self, record):
+        message = record.getMessage()
+        if len(message) > self.limit:
+            message = (
+                f"{message[:self.limit]}... <{len(message) - self.limit} more chars>"
+            )
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": message,
+            "pid": record.process,
+            "thread": record.threadName,
+        }
+        if getattr(record, "dropped", 0):
+            entry["dropped"] = record.dropped
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RedactingQueueHandler(QueueHandler):
+    # Runs on the logging thread: only redacts the arguments and enqueues
+    # the record, the message is rendered by the listener thread. Records
+    # are dropped (and counted on the next one) when the queue is full.
+    # on_fork() is called before the first record of a forked process.
+    def __init__(self, records, limit=1000, on_fork=None):
+        super().__init__(records)
+        self.limit = limit
+        self.dropped = 0
+        self.pid = os.getpid()
+        self.on_fork = on_fork
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        if isinstance(record.args, (tuple, dict)):
+            record.args = redact(record.args, self.limit)
+        if not isinstance(record.msg, str):
+            record.msg = redact(record.msg, self.limit)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            if self.on_fork:
+                self.on_fork()
+        record.dropped = self.dropped
+        try:
+            self.queue.put_nowait(record)
+            self.dropped = 0
+        except queue.Full:
+            self.dropped += 1
+
+
+class SharedRotatingFileHandler(RotatingFileHandler):
+    # Size-rotated log file shared by the gunicorn workers: rollover happens
+    # under a file lock, and a worker reopens the file after another one
+    # rotated it
+    def __init__(self, filename, max_bytes, backups):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups)
+        self.lock_file = open(f"{filename}.lock", "a")
+
+    def reopen(self):
+        # Own file descriptions after a fork, the flock would be shared
+        self.lock_file.close()
+        self.lock_file = open(f"{self.baseFilename}.lock", "a")
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = self._open()
+
+    def __reopen_if_rotated(self):
+        if self.stream is None:
+            return
+        try:
+            current = os.stat(self.baseFilename).st_ino
+        except FileNotFoundError:
+            current = None
+        if current != os.fstat(self.stream.fileno()).st_ino:
+            self.stream.close()
+            self.stream = self._open()
+
+    def emit(self, record):
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            try:
+                self.__reopen_if_rotated()
+                if self.shouldRollover(record):
+                    self.doRollover()
+                logging.FileHandler.emit(self, record)
+            finally:
+                fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        except Exception:
+            self.handleError(record)
+
+
+def queue_logging(
+    logger,
+    location,
+    max_bytes=20 * 1024 * 1024,
+    backups=5,
+    queue_size=10000,
+    field_limit=1000,
+    message_limit=10000,
+):
+    # Attach a bounded queue to the logger, drained by a background thread
+    # that writes JSON lines to a rotated file. The thread does not survive
+    # a fork (gunicorn --preload): the child starts its own with its first
+    # record, so that children that only exec (subprocess) start nothing.
+    handler = SharedRotatingFileHandler(location, max_bytes, backups)
+    handler.setFormatter(JsonFormatter(message_limit))
+    listeners = []
+
+    def start():
+        queue_handler.queue = queue.Queue(queue_size)
+        listener = QueueListener(
+            queue_handler.queue, handler, respect_handler_level=True
+        )
+        listener.start()
+        listeners[:] = [listener]
+
+    def restart():
+        handler.reopen()
+        start()
+
+    def drop_queued():
+        # Records still queued are the parent's to write: under gevent its
+        # listener survives the fork (as a greenlet) and would write them
+        # twice. Nothing here may yield to other greenlets.
+        queue_handler.queue.queue.clear()
+
+    queue_handler = RedactingQueueHandler(None, field_limit, on_fork=restart)
+    start()
+    # Holding the handler lock, no record is half written (buffered) when
+    # forking, so the child has nothing to flush when it reopens the file.
+    # The lock itself is reset in the child by logging's own fork hook.
+    os.register_at_fork(
+        before=handler.acquire,
+        after_in_parent=handler.release,
+        after_in_child=drop_queued,
+    )
+    # Flush the queue at exit, unless the listener was already stopped
+    atexit.register(lambda: listeners[0]._thread and listeners[0].stop())
+    logger.addHandler(queue_handler)
+    return listeners
@@ -0,0 +1,203 @@
+import base64
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from coalesce import file_lock
+from deadline import current_deadline
+
+MEDIA_KINDS = ("audio", "frames")
+
+
+class MediaNotFound(Exception):
+    # Unknown or expired media id
+    pass
+
+
+def decode_data_url(url):
+    # "data:<mime>;base64,<data>" or bare base64 -> bytes
+    return base64.b64decode(url.split(",", 1)[-1])
+
+
+def audio_id(data):
+    return "audio-" + hashlib.sha256(data).hexdigest()[:32]
+
+
+def frames_id(frames):
+    # Frames may be data URLs or bytes; the id only depends on their content
+    digest = hashlib.sha256()
+    for frame in frames:
+        data = frame if isinstance(frame, bytes) else decode_data_url(frame)
+        digest.update(hashlib.sha256(data).digest())
+    return "frames-" + digest.hexdigest()[:32]
+
+
+def params_key(*params):
+    # Short stable key for the parameters an artifact was derived with
+    raw = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()[:16]
+
+
+class MediaStore:
+    # Content-addressed store for the media of an improv take, plus what was
+    # derived from it (transcript, motion timeline, mosaics, vision results).
+    # Entries live on disk so every gunicorn worker sees them:
+    #
+    #   <folder>/<id>/meta.json      kind, size, created
+    #   <folder>/<id>/audio.webm     or frames/000.jpg, frames/001.jpg, ...
+    #   <folder>/<id>/<name>.json    derived artifacts
+    #
+    # Entries not used for `ttl` seconds are evicted.
+    def __init__(self, folder, ttl=3600, sweep_interval=60):
+        self.folder = folder
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.swept = 0
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def __path(self, media_id, *parts):
+        media_id = os.path.basename(media_id or "")
+        if not media_id.startswith(MEDIA_KINDS):
+            raise MediaNotFound(f"Invalid media id: {media_id}")
+        return os.path.join(self.folder, media_id, *parts)
+
+    def __sweep(self):
+        now = time.time()
+        with self.lock:
+            if now - self.swept < self.sweep_interval:
+                return
+            self.swept = now
+        for name in os.listdir(self.folder):
+            meta = os.path.join(self.folder, name, "meta.json")
+            try:
+                if now - os.path.getmtime(meta) > self.ttl:
+                    shutil.rmtree(os.path.join(self.folder, name), ignore_errors=True)
+            except FileNotFoundError:
+                pass
+
+    def __create(self, media_id, kind, write):
+        # Write into a temporary folder and rename it in place, so readers never
+        # see a half written entry. Returns True if the content was new.
+        if self.exists(media_id):
+            os.utime(self.__path(media_id, "meta.json"))
+            return False
+        self.__sweep()
+        tmp = os.path.join(self.folder, f".{media_id}.{uuid.uuid4().hex}")
+        os.makedirs(tmp)
+        try:
+            size = write(tmp)
+            with open(os.path.join(tmp, "meta.json"), "w") as f:
+                json.dump({"kind": kind, "size": size, "created": time.time()}, f)
+            os.rename(tmp, self.__path(media_id))
+        except OSError:
+            # Another worker stored the same content first
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not self.exists(media_id):
+                raise
+            return False
+        return True
+
+    def put_audio(self, data):
+        media_id = audio_id(data)
+
+        def write(path):
+            with open(os.path.join(path, "audio.webm"), "wb") as f:
+                f.write(data)
+            return len(data)
+
+        return media_id, self.__create(media_id, "audio", write)
+
+    def put_frames(self, frames):
+        frames = [f if isinstance(f, bytes) else decode_data_url(f) for f in frames]
+        media_id = frames_id(frames)
+
+        def write(path):
+            os.makedirs(os.path.join(path, "frames"))
+            for i, data in enumerate(frames):
+                with open(os.path.join(path, "frames", f"{i:03d}.jpg"), "wb") as f:
+                    f.write(data)
+            return sum(len(data) for data in frames)
+
+        return media_id, self.__create(media_id, "frames", write)
+
+    def exists(self, media_id):
+        try:
+            return os.path.isfile(self.__path(media_id, "meta.json"))
+        except MediaNotFound:
+            return False
+
+    def meta(self, media_id):
+        try:
+            with open(self.__path(media_id, "meta.json")) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            raise MediaNotFound(f"Unknown media id: {media_id}")
+        os.utime(self.__path(media_id, "meta.json"))
+        meta["artifacts"] = sorted(
+            name[: -len(".json")]
+            for name in os.listdir(self.__path(media_id))
+            if name.endswith(".json") and name != "meta.json"
+        )
+        return meta
+
+    def audio(self, media_id):
+        try:
+            with open(self.__path(media_id, "audio.webm"), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            raise MediaNotFound(f"Unknown audio id: {media_id}")
+        os.utime(self.__path(media_id, "meta.json"))
+        return data
+
+    def frames(self, media_id):
+        # Frames as JPEG data URLs, the format the improv prompts take
+        try:
+            names = sorted(os.listdir(self.__path(media_id, "frames")))
+        except FileNotFoundError:
+            raise MediaNotFound(f"Unknown frames id: {media_id}")
+        frames = []
+        for name in names:
+            with open(self.__path(media_id, "frames", name), "rb") as f:
+                frames.append(
+                    "data:image/jpeg;base64," + base64.b64encode(f.read()).decode()
+                )
+        os.utime(self.__path(media_id, "meta.json"))
+        return frames
+
+    def artifact(self, media_id, name):
+        try:
+            with open(self.__path(media_id, f"{name}.json")) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError, MediaNotFound):
+            return None
+
+    def derive(self, media_id, name, fn):
+        # Artifact `name` of the media, computed by fn() only once across all
+        # workers. Media that is not stored is not cached, fn() just runs.
+        # Waiting for another worker's fn() is bounded by the request
+        # deadline, past it the caller computes the artifact itself.
+        cached = self.artifact(media_id, name)
+        if cached is not None or not self.exists(media_id):
+            return cached if cached is not None else fn()
+        deadline = current_deadline()
+        timeout = deadline.timeout() if deadline else None
+        with file_lock(self.__path(media_id, f".{name}.lock"), timeout) as lock:
+            if lock is not None:
+                cached = self.artifact(media_id, name)
+                if cached is not None:
+                    return cached
+            value = fn()
+            if value is not None:
+                tmp = self.__path(media_id, f".{name}.{uuid.uuid4().hex}")
+                try:
+                    with open(tmp, "w") as f:
+                        json.dump(value, f, default=str)
+                    os.replace(tmp, self.__path(media_id, f"{name}.json"))
+                except FileNotFoundError:
+                    pass  # Evicted meanwhile
+            return value
@@ -0,0 +1,122 @@
+import contextvars
+import random
+import threading
+import time
+from collections import deque
+
+_variant = contextvars.ContextVar("variant", default=None)
+
+
+def set_variant(variant):
+    # Tag the next upstream call recorded in this context
+    _variant.set(variant)
+
+
+def assign_variant(ratio, variant, control="control"):
+    # Pick the variant for a fraction `ratio` of calls, the control otherwise
+    choice = variant if random.random() < ratio else control
+    set_variant(choice)
+    return choice
+
+
+def count_images(messages):
+    images = 0
+    for message in messages or []:
+        content = message.get("content") if isinstance(message, dict) else None
+        if isinstance(content, list):
+            images += sum(
+                1
+                for part in content
+                if isinstance(part, dict) and part.get("type") == "image_url"
+            )
+    return images
+
+
+class CallMetrics:
+    # Recent upstream calls of this process, summarized per method and variant.
+    # With several gunicorn workers each one reports its own share.
+    def __init__(self, window=1000):
+        self.calls = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def record(self, method, model, latency, usage=None, images=0, error=None):
+        variant = _variant.get()
+        if error is None:
+            # A failed call keeps the tag for its retry or fallback
+            _variant.set(None)
+        usage = usage or {}
+        with self.lock:
+            self.calls.append(
+                {
+                    "time": time.time(),
+                    "method": method or "unknown",
+                    "variant": variant,
+                    "model": model,
+                    "latency": latency,
+                    "prompt_tokens": usage.get("prompt_tokens"),
+                    "completion_tokens": usage.get("completion_tokens"),
+                    "images": images,
+                    "error": error,
+                }
+            )
+
+    def recent(self, model, method=None, window=300):
+        # Outcomes of the calls to `model` (for `method`, if given) of the
+        # last `window` seconds, or None if there were none
+        since = time.time() - window
+        with self.lock:
+            calls = [
+                c
+                for c in self.calls
+                if c["model"] == model
+                and c["time"] >= since
+                and (method is None or c["method"] == method)
+            ]
+        if not calls:
+            return None
+        latencies = sorted(c["latency"] for c in calls if not c["error"])
+        completion = [
+            c["completion_tokens"] for c in calls if c["completion_tokens"] is not None
+        ]
+        return {
+            "calls": len(calls),
+            "error_rate": sum(1 for c in calls if c["error"]) / len(calls),
+            "latency_p95": (
+                latencies[int(len(latencies) * 0.95)] if latencies else None
+            ),
+            "completion_tokens_mean": (
+                sum(completion) / len(completion) if completion else None
+            ),
+        }
+
+    def summary(self):
+        with self.lock:
+            calls = list(self.calls)
+        groups = {}
+        for call in calls:
+            key = call["method"]
+            if call["variant"]:
+                key += f"[{call['variant']}]"
+            groups.setdefault(key, []).append(call)
+
+        summary = {}
+        for key, group in sorted(groups.items()):
+            latencies = sorted(c["latency"] for c in group)
+            prompt = [c["prompt_tokens"] for c in group if c["prompt_tokens"] is not None]
+            completion = [
+                c["completion_tokens"] for c in group if c["completion_tokens"] is not None
+            ]
+            summary[key] = {
+                "calls": len(group),
+                "errors": sum(1 for c in group if c["error"]),
+                "latency_p50_ms": latencies[len(latencies) // 2] * 1000,
+                "latency_p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+                "prompt_tokens_mean": sum(prompt) / len(prompt) if prompt else None,
+                "completion_tokens_mean": (
+                    sum(completion) / len(completion) if completion else None
+                ),
+                "images_mean": sum(c["images"] for c in group) / len(group),
+                "models": sorted({c["model"] for c in group}),
+            }
+        return {"since": self.started, "window": self.calls.maxlen, "calls": summary}
@@ -0,0 +1,105 @@
+import base64
+
+from lazy import lazy_module
+
+cv2 = lazy_module("cv2")
+np = lazy_module("numpy")
+
+
+# cv2 flag names, looked up when used so that importing stays cheap
+REDUCED_FLAGS = (
+    ("IMREAD_REDUCED_COLOR_4", 4),
+    ("IMREAD_REDUCED_COLOR_2", 2),
+    ("IMREAD_COLOR", 1),
+)
+
+
+def _decode(frame, tile, flag=None):
+    # Decode at the smallest JPEG scale that still covers the tile. Frames of
+    # one take share their size, so the scale found for the first is reused.
+    if isinstance(frame, np.ndarray):
+        return frame, flag
+    data = np.frombuffer(base64.b64decode(frame.split(",", 1)[-1]), np.uint8)
+    if flag is not None:
+        return cv2.imdecode(data, flag), flag
+    for name, _ in REDUCED_FLAGS:
+        flag = getattr(cv2, name)
+        image = cv2.imdecode(data, flag)
+        if image is None:
+            return None, None
+        if image.shape[1] >= tile[0] and image.shape[0] >= tile[1]:
+            break
+    return image, flag
+
+
+def _fit(image, out):
+    # Letterbox the image into the tile `out`, keeping its aspect ratio.
+    # Exact halvings with INTER_AREA then one INTER_LINEAR step is as sharp as
+    # a single INTER_AREA resize at a fraction of its cost.
+    th, tw = out.shape[:2]
+    h, w = image.shape[:2]
+    scale = min(tw / w, th / h)
+    nw, nh = max(int(w * scale), 1), max(int(h * scale), 1)
+    while image.shape[1] // 2 >= nw and image.shape[0] // 2 >= nh:
+        image = cv2.resize(
+            image,
+            (image.shape[1] // 2, image.shape[0] // 2),
+            interpolation=cv2.INTER_AREA,
+        )
+    y, x = (th - nh) // 2, (tw - nw) // 2
+    out[y : y + nh, x : x + nw] = cv2.resize(
+        image, (nw, nh), interpolation=cv2.INTER_LINEAR
+    )
+
+
+def pack_frames(frames, grid=(2, 2), tile=(256, 192), labels=True, quality=80):
+    """
+    Tile frames (data URLs, base64 JPEGs or BGR arrays) in temporal order into grid
+    images of grid[0] columns x grid[1] rows, each cell `tile` (w, h) pixels.
+    Frame numbers, starting at 1, are drawn in the corner of every cell.
+    Returns the mosaics as JPEG data URLs; frames that fail to decode are
+    skipped but keep their number.
+    """
+    cols, rows = grid
+    tw, th = tile
+    cells = cols * rows
+    stack = np.zeros((-(-len(frames) // cells) * cells, th, tw, 3), np.uint8)
+    numbers, flag = [], None
+    for i, frame in enumerate(frames):
+        image, flag = _decode(frame, tile, flag)
+        if image is not None:
+            _fit(image, stack[len(numbers)])
+            numbers.append(i + 1)
+    if not numbers:
+        return []
+
+    stack = stack[: -(-len(numbers) // cells) * cells]
+    # (n, th, tw, 3) -> (sheets, rows * th, cols * tw, 3) in row-major order
+    sheets = (
+        stack.reshape(-1, rows, cols, th, tw, 3)
+        .transpose(0, 1, 3, 2, 4, 5)
+        .reshape(-1, rows * th, cols * tw, 3)
+    )
+
+    mosaics = []
+    scale = th / 240
+    for s, sheet in enumerate(sheets):
+        sheet = np.ascontiguousarray(sheet)
+        if labels:
+            for k, number in enumerate(numbers[s * cells : (s + 1) * cells]):
+                x, y = (k % cols) * tw, (k // cols) * th
+                org = (x + int(6 * scale) + 2, y + int(28 * scale) + 4)
+                for color, width in (((0, 0, 0), 4), ((255, 255, 255), 1)):
+                    cv2.putText(
+                        sheet,
+                        str(number),
+                        org,
+                        cv2.FONT_HERSHEY_SIMPLEX,
+                        max(scale, 0.4),
+                        color,
+                        width,
+                        cv2.LINE_AA,
+                    )
+        _, buffer = cv2.imencode(".jpg", sheet, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        mosaics.append("data:image/jpeg;base64," + base64.b64encode(buffer).decode())
+    return mosaics
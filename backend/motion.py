@@ -0,0 +1,185 @@
+import base64
+
+from lazy import lazy_module
+
+cv2 = lazy_module("cv2")
+np = lazy_module("numpy")
+
+REGION_NAMES = [
+    ["top-left", "top", "top-right"],
+    ["left", "center", "right"],
+    ["bottom-left", "bottom", "bottom-right"],
+]
+
+
+def decode_frame(frame, width=160):
+    # Data URL or base64 JPEG -> small blurred grayscale image
+    data = base64.b64decode(frame.split(",", 1)[-1])
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_2)
+    if image is None:
+        return None
+    return _prepare(image, width)
+
+
+def _prepare(image, width):
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    h, w = image.shape
+    if w > width:
+        image = cv2.resize(
+            image, (width, max(h * width // w, 1)), interpolation=cv2.INTER_AREA
+        )
+    return cv2.GaussianBlur(image, (5, 5), 0)
+
+
+def read_video(path, width=160, step=1):
+    # Every `step`-th frame of a video file, prepared like decode_frame
+    video = cv2.VideoCapture(path)
+    fps = video.get(cv2.CAP_PROP_FPS) or 30.0
+    frames, i = [], 0
+    while video.grab():
+        if i % step == 0:
+            ok, frame = video.retrieve()
+            if not ok:
+                break
+            frames.append(_prepare(frame, width))
+        i += 1
+    video.release()
+    return frames, step / fps
+
+
+def _segments(labels, energy, centroids, regions, interval):
+    # Merge consecutive transitions with the same label into segments
+    segments = []
+    start = 0
+    for i in range(1, len(labels) + 1):
+        if i < len(labels) and labels[i] == labels[start]:
+            continue
+        segment = {
+            "type": labels[start],
+            "start": round(start * interval, 2),
+            "end": round(i * interval, 2),
+            "energy": round(float(energy[start:i].mean()), 3),
+        }
+        if labels[start] != "still":
+            cells = regions[start:i].sum(axis=0)
+            segment["region"] = REGION_NAMES[cells.argmax() // 3][cells.argmax() % 3]
+            moving = [c for c in centroids[start:i] if c is not None]
+            if len(moving) > 1:
+                dx = moving[-1][0] - moving[0][0]
+                dy = moving[-1][1] - moving[0][1]
+                if max(abs(dx), abs(dy)) > 0.1:
+                    if abs(dx) >= abs(dy):
+                        segment["direction"] = "right" if dx > 0 else "left"
+                    else:
+                        segment["direction"] = "down" if dy > 0 else "up"
+        segments.append(segment)
+        start = i
+    return segments
+
+
+def analyze_motion(
+    frames,
+    interval=0.3,
+    width=160,
+    threshold=15,
+    still=0.01,
+    burst=2.0,
+    peaks=4,
+):
+    """
+    Motion timeline of a sequence of frames (data URLs, base64 JPEGs or
+    already prepared grayscale arrays), `interval` seconds apart.
+
+    Each transition between two frames gets the fraction of pixels that
+    changed by more than `threshold` (its energy), overall and per cell of a
+    3x3 grid. Transitions under `still` are still, those over `burst` times
+    the median moving energy are bursts. Returns a dict with the per-frame
+    energy, the merged segments, the busiest regions and the indices of the
+    `peaks` frames with the most motion.
+    """
+    images = [f if isinstance(f, np.ndarray) else decode_frame(f, width) for f in frames]
+    index = [i for i, image in enumerate(images) if image is not None]
+    images = [images[i] for i in index]
+    if len(images) < 2:
+        return {
+            "frames": len(frames),
+            "duration": round(len(frames) * interval, 2),
+            "energy": [],
+            "segments": [],
+            "regions": [],
+            "peaks": index[:peaks],
+        }
+
+    h, w = images[0].shape
+    ys, xs = np.mgrid[0:h, 0:w]
+    rows = np.array_split(np.arange(h), 3)
+    cols = np.array_split(np.arange(w), 3)
+    energy = np.zeros(len(images) - 1)
+    regions = np.zeros((len(images) - 1, 9))
+    centroids = []
+    for i in range(1, len(images)):
+        if images[i].shape != (h, w):
+            images[i] = cv2.resize(images[i], (w, h))
+        mask = cv2.absdiff(images[i], images[i - 1]) > threshold
+        energy[i - 1] = mask.mean()
+        for r, rr in enumerate(rows):
+            band = mask[rr[0] : rr[-1] + 1]
+            for c, cc in enumerate(cols):
+                regions[i - 1, r * 3 + c] = band[:, cc[0] : cc[-1] + 1].mean()
+        n = mask.sum()
+        centroids.append(
+            (xs[mask].sum() / n / w, ys[mask].sum() / n / h) if n else None
+        )
+
+    moving = energy[energy >= still]
+    level = np.median(moving) if len(moving) else 0.0
+    labels = [
+        "still" if e < still else "burst" if e > burst * level else "moving"
+        for e in energy
+    ]
+
+    # Peak frames: highest energy first, at least two frames apart
+    chosen = []
+    for i in np.argsort(-energy):
+        if energy[i] < still or len(chosen) >= peaks:
+            break
+        if all(abs(i - j) > 1 for j in chosen):
+            chosen.append(int(i))
+    if not chosen:
+        chosen = [len(energy) // 2]
+
+    totals = regions.sum(axis=0)
+    busiest = [
+        REGION_NAMES[i // 3][i % 3]
+        for i in np.argsort(-totals)[:3]
+        if totals[i] > 0 and totals[i] >= totals.max() / 2
+    ]
+    return {
+        "frames": len(frames),
+        "duration": round(len(frames) * interval, 2),
+        "energy": [round(float(e), 3) for e in energy],
+        "segments": _segments(labels, energy, centroids, regions, interval),
+        "regions": busiest,
+        # A transition's motion shows in its later frame
+        "peaks": sorted(index[i + 1] for i in chosen),
+    }
+
+
+def describe_motion(timeline):
+    # Compact text version of the timeline for prompts
+    if not timeline["segments"]:
+        return "No motion data."
+    lines = [
+        f"{timeline['duration']}s performance, motion mostly in the "
+        f"{', '.join(timeline['regions']) or 'center'} of the frame."
+    ]
+    for s in timeline["segments"]:
+        line = f"{s['start']:.1f}-{s['end']:.1f}s {s['type']}"
+        if s["type"] != "still":
+            line += f" (energy {s['energy']:.2f}, {s['region']}"
+            if s.get("direction"):
+                line += f", moving {s['direction']}"
+            line += ")"
+        lines.append(line)
+    return "\n".join(lines)
@@ -0,0 +1,216 @@
+import base64
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from collections import deque
+
+from coalesce import file_lock
+from lazy import lazy_module
+
+cv2 = lazy_module("cv2")
+np = lazy_module("numpy")
+
+
+def image_phash(image):
+    # 64-bit DCT perceptual hash of a BGR or grayscale image, as an int
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(image, (32, 32), interpolation=cv2.INTER_AREA)
+    low = cv2.dct(small.astype(np.float32))[:8, :8].ravel()
+    bits = low > np.median(low[1:])  # The DC term would skew the median
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def data_url_phash(url):
+    data = base64.b64decode(url.split(",", 1)[-1])
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise ValueError("Cannot decode image")
+    return image_phash(image)
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    # Metric tree over hashes: a lookup within distance d only visits children
+    # whose edge distance is within d of the query's distance to their parent
+    def __init__(self):
+        self.root = None  # [hash, value, {distance: child}]
+        self.size = 0
+
+    def add(self, key, value):
+        self.size += 1
+        if self.root is None:
+            self.root = [key, value, {}]
+            return
+        node = self.root
+        while True:
+            d = hamming(key, node[0])
+            if d == 0:
+                node[1] = value
+                self.size -= 1
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [key, value, {}]
+                return
+            node = child
+
+    def nearest(self, key, max_distance):
+        # (distance, hash, value) of the closest entry within max_distance
+        best = None
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            d = hamming(key, node[0])
+            if d <= max_distance and (best is None or d < best[0]):
+                best = (d, node[0], node[1])
+            radius = best[0] if best else max_distance
+            for edge, child in node[2].items():
+                if d - radius <= edge <= d + radius:
+                    stack.append(child)
+        return best
+
+
+class PerceptualCache:
+    # Results keyed by the perceptual hash of an image, matched within a
+    # Hamming distance so re-photos of the same drawing hit. Entries are
+    # appended to a JSON lines file that every worker follows, and a sample
+    # of the hits is audited against a fresh result. Entries older than
+    # `ttl` are misses. Like SemanticCache, the file is rewritten without
+    # them, keeping the most recently stored ones (three quarters of
+    # `max_entries`), once it holds more than `max_entries` entries or has
+    # doubled since it was last rewritten and passed `max_bytes`.
+    def __init__(
+        self,
+        path,
+        max_distance=6,
+        audit_rate=0.0,
+        audit_log=20,
+        ttl=7 * 24 * 3600,
+        max_entries=5000,
+        max_bytes=20 * 1024 * 1024,
+    ):
+        self.path = path
+        self.max_distance = max_distance
+        self.audit_rate = audit_rate
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.tree = BKTree()
+        self.entries = {}  # Hash -> (time, value), the latest stored
+        self.inode = None
+        self.offset = 0
+        self.compacted = 0  # Size of the file when it was last loaded whole
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.audits = 0
+        self.mismatches = 0
+        self.audit_log = deque(maxlen=audit_log)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.__follow()
+
+    def __follow(self):
+        # Load the entries other workers appended since the last read, all of
+        # them again if the file was compacted (replaced) in the meantime
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != self.inode:
+                self.inode, self.compacted = stat.st_ino, stat.st_size
+                self.tree, self.entries, self.offset = BKTree(), {}, 0
+            if stat.st_size <= self.offset:
+                return
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # Partially written, read it next time
+                self.offset += len(line)
+                try:
+                    entry = json.loads(line)
+                    key = int(entry["hash"], 16)
+                    self.tree.add(key, entry["value"])
+                    self.entries[key] = (entry.get("time", 0), entry["value"])
+                except (ValueError, KeyError):
+                    continue
+
+    def __oversized(self):
+        return len(self.entries) > self.max_entries or (
+            self.offset > self.max_bytes and self.offset > 2 * self.compacted
+        )
+
+    def __compact(self):
+        with file_lock(f"{self.path}.lock"):
+            self.__follow()
+            if not self.__oversized():
+                return  # Another worker compacted it
+            oldest = time.time() - self.ttl
+            kept = sorted(
+                (item for item in self.entries.items() if item[1][0] >= oldest),
+                key=lambda item: item[1][0],
+            )
+            # Room for new entries, so the next compaction is not the next put
+            kept = kept[-(self.max_entries - self.max_entries // 4) :]
+            tmp = f"{self.path}.{uuid.uuid4().hex}"
+            with open(tmp, "w") as f:
+                for key, (stamp, value) in kept:
+                    line = {"hash": f"{key:016x}", "value": value, "time": stamp}
+                    f.write(json.dumps(line) + "\n")
+            os.replace(tmp, self.path)
+            self.__follow()
+
+    def get(self, key):
+        # (distance, value) of the closest cached result, or None
+        with self.lock:
+            self.__follow()
+            self.lookups += 1
+            best = self.tree.nearest(key, self.max_distance)
+            if best is None or self.entries[best[1]][0] < time.time() - self.ttl:
+                return None
+            self.hits += 1
+            return best[0], best[2]
+
+    def put(self, key, value):
+        line = json.dumps({"hash": f"{key:016x}", "value": value, "time": time.time()})
+        with self.lock:
+            self.__follow()
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+            self.__follow()
+            if self.__oversized():
+                self.__compact()
+
+    def should_audit(self):
+        return random.random() < self.audit_rate
+
+    def audit(self, distance, cached, fresh, same):
+        # Record whether a hit matched a fresh result for the same image
+        with self.lock:
+            self.audits += 1
+            if not same:
+                self.mismatches += 1
+            self.audit_log.append(
+                {"distance": distance, "same": same, "cached": cached, "fresh": fresh}
+            )
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": self.tree.size,
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": self.hits / self.lookups if self.lookups else None,
+                "max_distance": self.max_distance,
+                "audits": self.audits,
+                "false_matches": self.mismatches,
+                "recent_audits": list(self.audit_log),
+            }
@@ -0,0 +1,235 @@
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows, fall back to a per-process limiter
+    fcntl = None
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BACKGROUND = "background"
+
+# Rough vision token cost per image part (https://platform.openai.com/docs/guides/vision)
+IMAGE_TOKENS_LOW = 85
+IMAGE_TOKENS_HIGH = 765
+
+
+class RateLimitTimeout(Exception):
+    # Raised when a request could not get capacity before its deadline
+    pass
+
+
+def is_rate_limit_error(e):
+    # True for upstream 429s and local queue timeouts, which must not be retried
+    if isinstance(e, RateLimitTimeout):
+        return True
+    return getattr(e, "status_code", None) == 429
+
+
+def estimate_tokens(messages, max_tokens=0):
+    # Cheap upper bound of the tokens a chat request will consume (~4 chars/token)
+    chars, images = 0, 0
+    for message in messages or []:
+        content = message.get("content") if isinstance(message, dict) else message
+        parts = content if isinstance(content, list) else [content]
+        for part in parts:
+            if isinstance(part, dict) and part.get("type") == "image_url":
+                detail = (part.get("image_url") or {}).get("detail", "auto")
+                images += IMAGE_TOKENS_LOW if detail == "low" else IMAGE_TOKENS_HIGH
+            elif isinstance(part, dict):
+                chars += len(str(part.get("text", "")))
+            elif part is not None:
+                chars += len(str(part))
+    return chars // 4 + images + max_tokens
+
+
+class LocalBackend:
+    # Limiter state shared by the threads of a single process
+    def __init__(self):
+        self.state = {}
+        self.lock = threading.Lock()
+
+    def update(self, fn):
+        with self.lock:
+            return fn(self.state)
+
+
+class FileBackend:
+    # Limiter state shared by all processes on the host (e.g. gunicorn workers),
+    # kept in a small JSON file guarded by an exclusive flock
+    def __init__(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        self.path = os.path.join(folder, "limiter.json")
+        self.lock = threading.Lock()
+
+    def update(self, fn):
+        with self.lock, open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                raw = f.read()
+                try:
+                    state = json.loads(raw) if raw else {}
+                except ValueError:
+                    state = {}
+                result = fn(state)
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+                return result
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class Lease:
+    def __init__(self, lease_id, model, tokens):
+        self.id = lease_id
+        self.model = model
+        self.tokens = tokens
+        self.used = None  # Actual tokens, refunded to the bucket on release
+
+
+class RateLimiter:
+    # Per-model requests-per-minute and tokens-per-minute buckets, plus a global
+    # cap on in-flight requests. Background calls may not use the last `reserve`
+    # fraction of a bucket, so interactive calls keep flowing under load.
+    def __init__(
+        self,
+        limits,
+        backend=None,
+        max_concurrency=32,
+        reserve=0.2,
+        queue_timeout=30,
+        lease_timeout=300,
+    ):
+        self.limits = limits
+        self.backend = backend or LocalBackend()
+        self.max_concurrency = max_concurrency
+        self.reserve = reserve
+        self.queue_timeout = queue_timeout
+        self.lease_timeout = lease_timeout
+
+    def __take(self, state, lease, priority, now):
+        inflight = state.setdefault("inflight", {})
+        for lid in [lid for lid, exp in inflight.items() if exp < now]:
+            # Leases of crashed workers expire
+            del inflight[lid]
+
+        floor = self.reserve if priority == PRIORITY_BACKGROUND else 0.0
+        wait = 0.0
+        if len(inflight) >= self.max_concurrency * (1 - floor):
+            wait = 0.1
+
+        limit = self.limits.get(lease.model)
+        if limit:
+            buckets = state.setdefault("buckets", {})
+            bucket = buckets.get(lease.model)
+            if bucket is None:
+                bucket = {
+                    "req": limit["rpm"],
+                    "tok": limit["tpm"],
+                    "ts": now,
+                    "until": 0,
+                }
+                buckets[lease.model] = bucket
+            elapsed = max(now - bucket["ts"], 0)
+            bucket["req"] = min(
+                limit["rpm"], bucket["req"] + elapsed * limit["rpm"] / 60
+            )
+            bucket["tok"] = min(
+                limit["tpm"], bucket["tok"] + elapsed * limit["tpm"] / 60
+            )
+            bucket["ts"] = now
+
+            # A single oversized request must still be able to pass
+            tokens = min(lease.tokens, limit["tpm"] * (1 - floor))
+            need_req = 1 + floor * limit["rpm"] - bucket["req"]
+            need_tok = tokens + floor * limit["tpm"] - bucket["tok"]
+            wait = max(
+                wait,
+                bucket["until"] - now,
+                need_req * 60 / limit["rpm"],
+                need_tok * 60 / limit["tpm"],
+            )
+            if wait <= 0:
+                bucket["req"] -= 1
+                bucket["tok"] -= tokens
+                lease.tokens = tokens
+
+        if wait <= 0:
+            inflight[lease.id] = now + self.lease_timeout
+        return wait
+
+    def __release(self, state, lease, now):
+        state.setdefault("inflight", {}).pop(lease.id, None)
+        bucket = state.get("buckets", {}).get(lease.model)
+        limit = self.limits.get(lease.model)
+        if bucket and limit and lease.used is not None:
+            refund = max(lease.tokens - lease.used, 0)
+            bucket["tok"] = min(limit["tpm"], bucket["tok"] + refund)
+
+    def __penalize(self, state, model, until):
+        bucket = state.get("buckets", {}).get(model)
+        if bucket:
+            bucket["until"] = max(bucket.get("until", 0), until)
+            bucket["req"] = min(bucket["req"], 0)
+
+    def acquire(self, model, tokens=0, priority=PRIORITY_INTERACTIVE, deadline=None):
+        # Block until there is capacity for the request, or raise RateLimitTimeout
+        lease = Lease(uuid.uuid4().hex, model, tokens)
+        if deadline is None:
+            deadline = time.time() + self.queue_timeout
+        while True:
+            now = time.time()
+            wait = self.backend.update(lambda st: self.__take(st, lease, priority, now))
+            if wait <= 0:
+                return lease
+            if now + wait > deadline:
+                raise RateLimitTimeout(
+                    f"No capacity for model={model} (priority={priority}) before deadline"
+                )
+            # Jitter avoids synchronized wake-ups across workers
+            time.sleep(min(wait, 1.0) * random.uniform(0.8, 1.2))
+
+    def release(self, lease):
+        now = time.time()
+        self.backend.update(lambda st: self.__release(st, lease, now))
+
+    def penalize(self, model, retry_after=1.0):
+        # Upstream answered 429: stop sending to this model for a while
+        until = time.time() + retry_after
+        self.backend.update(lambda st: self.__penalize(st, model, until))
+
+    @contextmanager
+    def limit(self, model, tokens=0, priority=PRIORITY_INTERACTIVE, deadline=None):
+        lease = self.acquire(model, tokens, priority, deadline)
+        try:
+            yield lease
+        except Exception as e:
+            if getattr(e, "status_code", None) == 429:
+                self.penalize(model, retry_after_seconds(e))
+            raise
+        finally:
+            self.release(lease)
+
+
+def retry_after_seconds(e, default=1.0):
+    # Read the Retry-After header of an upstream 429, if any
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after", default))
+    except (TypeError, ValueError):
+        return default
+
+
+def create_limiter(limits, backend, folder, **kwargs):
+    if backend == "file" and fcntl is not None:
+        return RateLimiter(limits, FileBackend(folder), **kwargs)
+    return RateLimiter(limits, LocalBackend(), **kwargs)
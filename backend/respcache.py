@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+from cachetools import TTLCache
+
+_spaces = re.compile(r"\s+")
+
+
+def _normalize(value):
+    # Whitespace and indentation of prompt text does not change the request
+    if isinstance(value, str):
+        return _spaces.sub(" ", value).strip()
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def fingerprint(model, messages, **params):
+    # Canonical hash of everything that determines an upstream response
+    raw = json.dumps(
+        {"model": model, "messages": _normalize(messages), "params": params},
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class _MethodCache(TTLCache):
+    # TTLCache that counts the entries evicted to stay within maxsize
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize, ttl)
+        self.evictions = 0
+
+    def popitem(self):
+        self.evictions += 1
+        return super().popitem()
+
+
+class DiskTier:
+    # Shared second tier: one JSON file per response, expiring by TTL. A
+    # file's mtime is set to its expiry, so sweeps remove the expired ones
+    # without reading them, then the soonest to expire while the folder is
+    # past max_bytes. Temporary files of writes in progress are left alone
+    # for `grace` seconds.
+    def __init__(self, folder, max_bytes, sweep_interval=300, grace=60):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self.grace = grace
+        self.swept = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def __path(self, key):
+        return os.path.join(self.folder, f"{key}.json")
+
+    def get(self, key):
+        try:
+            with open(self.__path(key)) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if entry["expires"] < time.time():
+            return None
+        return entry["value"]
+
+    def put(self, key, value, ttl):
+        tmp = self.__path(f".{key}.{uuid.uuid4().hex}")
+        expires = time.time() + ttl
+        with open(tmp, "w") as f:
+            json.dump({"expires": expires, "value": value}, f)
+        os.utime(tmp, (expires, expires))
+        os.replace(tmp, self.__path(key))
+        if time.time() - self.swept > self.sweep_interval:
+            self.swept = time.time()
+            self.sweep()
+
+    def sweep(self):
+        now = time.time()
+        entries, total = [], 0
+        for entry in os.scandir(self.folder):
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                if entry.name.startswith("."):
+                    # Temporary file, removed once its writer is surely gone
+                    if now - stat.st_mtime > self.grace:
+                        os.remove(entry.path)
+                    continue
+                if stat.st_mtime < now:
+                    os.remove(entry.path)  # Expired
+                    continue
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+
+
+class ResponseCache:
+    # Exact-match cache of upstream responses for the methods listed in
+    # `policies` ({method: {"ttl": seconds, "maxsize": entries}}): an
+    # in-process LRU per method, then the optional disk tier
+    def __init__(self, policies, disk=None):
+        self.policies = policies
+        self.disk = disk
+        self.lock = threading.Lock()
+        self.caches = {
+            method: _MethodCache(policy.get("maxsize", 256), policy.get("ttl", 3600))
+            for method, policy in policies.items()
+        }
+        self.counts = {method: {} for method in policies}
+
+    def enabled(self, method):
+        return method in self.caches
+
+    def __count(self, method, event):
+        counts = self.counts[method]
+        counts[event] = counts.get(event, 0) + 1
+
+    def get(self, method, key):
+        if not self.enabled(method):
+            return None
+        with self.lock:
+            value = self.caches[method].get(key)
+            if value is not None:
+                self.__count(method, "hits")
+                return value
+        value = self.disk.get(key) if self.disk else None
+        with self.lock:
+            if value is None:
+                self.__count(method, "misses")
+                return None
+            self.__count(method, "disk_hits")
+            self.caches[method][key] = value
+        return value
+
+    def put(self, method, key, value):
+        if not self.enabled(method) or value is None:
+            return
+        with self.lock:
+            self.caches[method][key] = value
+            self.__count(method, "stores")
+        if self.disk:
+            try:
+                self.disk.put(key, value, self.policies[method].get("ttl", 3600))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            for method, cache in self.caches.items():
+                counts = dict(self.counts[method])
+                lookups = sum(counts.get(k, 0) for k in ("hits", "disk_hits", "misses"))
+                stats[method] = {
+                    **counts,
+                    "size": len(cache),
+                    "maxsize": cache.maxsize,
+                    "ttl": cache.ttl,
+                    "evictions": cache.evictions,
+                    "hit_rate": (
+                        (counts.get("hits", 0) + counts.get("disk_hits", 0)) / lookups
+                        if lookups
+                        else None
+                    ),
+                }
+            return stats
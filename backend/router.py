@@ -0,0 +1,160 @@
+import json
+import os
+import threading
+import time
+
+
+class ModelRouter:
+    # Models to try for a Storyteller method, best first. A route (ROUTES)
+    # gives the preferred model, its acceptable alternates, a latency SLO
+    # (p95 seconds) and a cost ceiling (USD per call). Methods without one
+    # use the model asked by the caller and its MODEL_FALLBACKS.
+    #
+    # Models over the cost ceiling are left out, unless none is under it.
+    # The others keep the route's order while their recent p95 meets the
+    # SLO and their error rate stays low; the ones that do not go after
+    # them, fastest first, and models whose circuit breaker is open last.
+    # Stats come from the last `window` seconds of calls, so a demoted
+    # model gets its turn again once they have aged out.
+    #
+    # The routes in `path` (JSON, same shape as ROUTES) override the
+    # configured ones, and are reloaded when the file changes.
+    def __init__(
+        self,
+        routes,
+        fallbacks,
+        prices,
+        metrics,
+        healthy,
+        path=None,
+        reload=5,
+        window=300,
+        min_calls=5,
+        max_error_rate=0.2,
+        logger=None,
+    ):
+        self.configured = routes
+        self.fallbacks = fallbacks
+        self.prices = prices
+        self.metrics = metrics
+        self.healthy = healthy  # (model, endpoint) -> bool
+        self.path = path
+        self.reload = reload
+        self.window = window
+        self.min_calls = min_calls
+        self.max_error_rate = max_error_rate
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.routes = dict(routes)
+        self.mtime = None
+        self.checked = 0.0
+        self.loaded = time.time()
+        self.chosen = {}  # Method -> models of its last routing
+
+    def __refresh(self):
+        # Reload the routes file if it changed, at most every `reload` seconds
+        now = time.time()
+        if not self.path or now - self.checked < self.reload:
+            return
+        self.checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        routes = dict(self.configured)
+        if mtime is not None:
+            try:
+                with open(self.path) as f:
+                    overrides = json.load(f)
+                for method, route in overrides.items():
+                    if not route.get("models"):
+                        raise ValueError(f"Route of {method} has no models")
+                routes.update(overrides)
+            except (OSError, ValueError, AttributeError) as e:
+                if self.logger:
+                    self.logger.error("Keeping the current routes: %s", e)
+                return
+        self.routes = routes
+        self.loaded = now
+        if self.logger:
+            self.logger.info("Model routes loaded from %s", self.path)
+
+    def __default(self, model):
+        models = [model]
+        while (
+            self.fallbacks.get(models[-1]) and self.fallbacks[models[-1]] not in models
+        ):
+            models.append(self.fallbacks[models[-1]])
+        return models
+
+    def __stats(self, model, method):
+        # Stats of the method on this model, or of the model overall while
+        # the method made too few calls to it
+        stats = self.metrics.recent(model, method, self.window)
+        if stats is None or stats["calls"] < self.min_calls:
+            stats = self.metrics.recent(model, None, self.window)
+        if stats is None or stats["calls"] < self.min_calls:
+            return None
+        return stats
+
+    def __cost(self, model, method, tokens):
+        # Estimated USD of a call: `tokens` prompt tokens, and as many
+        # completion tokens as the method's recent calls
+        price = self.prices.get(model)
+        if not price:
+            return None
+        recent = self.metrics.recent(model, method, self.window) or {}
+        completion = recent.get("completion_tokens_mean") or 0
+        return (tokens * price[0] + completion * price[1]) / 1e6
+
+    def route(self, method, model, tokens=0, endpoint="chat"):
+        # Models to try in order for a call of `method`, `model` being the
+        # one the caller would use without a route
+        with self.lock:
+            self.__refresh()
+            route = self.routes.get(method)
+        if not route:
+            return self.__default(model)
+
+        models = list(route["models"])
+        ceiling = route.get("max_cost")
+        if ceiling is not None:
+            costs = {m: self.__cost(m, method, tokens) for m in models}
+            affordable = [m for m in models if (costs[m] or 0) <= ceiling]
+            models = affordable or [min(models, key=lambda m: costs[m] or 0)]
+
+        slo = route.get("slo")
+
+        def rank(item):
+            position, model = item
+            if not self.healthy(model, endpoint):
+                return (3, position)
+            stats = self.__stats(model, method)
+            if stats is None:
+                return (0, position)
+            if stats["error_rate"] >= self.max_error_rate:
+                return (2, position)
+            p95 = stats["latency_p95"]
+            if slo is not None and p95 is not None and p95 > slo:
+                return (1, p95)
+            return (0, position)
+
+        models = [m for _, m in sorted(enumerate(models), key=rank)]
+        with self.lock:
+            self.chosen[method] = models
+        return models
+
+    def stats(self):
+        with self.lock:
+            self.__refresh()
+            return {
+                "file": self.path if self.mtime is not None else None,
+                "loaded": self.loaded,
+                "routes": {
+                    method: {**route, "last": self.chosen.get(method)}
+                    for method, route in self.routes.items()
+                },
+            }
@@ -0,0 +1,330 @@
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+
+from coalesce import file_lock
+from lazy import lazy_module
+
+np = lazy_module("numpy")
+
+_spaces = re.compile(r"\s+")
+
+
+class MinHasher:
+    # MinHash signatures of the byte 4-grams of a text: the share of equal
+    # slots between two signatures estimates the Jaccard similarity of their
+    # 4-gram sets. Seeded, so every worker computes the same signatures.
+    def __init__(self, num_perm=64, seed=1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.a = rng.integers(0, 2**64, num_perm, dtype=np.uint64) | np.uint64(1)
+        self.b = rng.integers(0, 2**64, num_perm, dtype=np.uint64)
+
+    def shingles(self, text):
+        # Distinct 4-grams, spread over 64 bits by the MurmurHash3 finalizer
+        data = _spaces.sub(" ", text.lower()).strip().encode()
+        data = np.frombuffer(data.ljust(4), np.uint8).astype(np.uint64)
+        x = np.unique(data[:-3] << 24 | data[1:-2] << 16 | data[2:-1] << 8 | data[3:])
+        x ^= x >> np.uint64(33)
+        x *= np.uint64(0xFF51AFD7ED558CCD)
+        x ^= x >> np.uint64(33)
+        x *= np.uint64(0xC4CEB9FE1A85EC53)
+        x ^= x >> np.uint64(33)
+        return x
+
+    def signature(self, text):
+        # Multiply-shift hash of every 4-gram per permutation, minimum per row
+        grams = self.shingles(text)
+        hashed = (self.a[:, None] * grams[None, :] + self.b[:, None]) >> np.uint64(32)
+        return hashed.min(axis=1).astype(np.uint32)
+
+
+def dedupe(items, threshold=0.7, hasher=None):
+    # Items (dicts) without the ones whose values are nearly the same text as
+    # an item kept before them
+    hasher = hasher or MinHasher()
+    kept, sigs = [], []
+    for item in items:
+        text = " ".join(str(v) for v in item.values())
+        sig = hasher.signature(text)
+        if any((sig == other).mean() >= threshold for other in sigs):
+            continue
+        kept.append(item)
+        sigs.append(sig)
+    return kept
+
+
+class SemanticCache:
+    # Results of generation methods served again for near-identical inputs.
+    # Inputs are indexed by MinHash with LSH banding, so a lookup only scores
+    # the entries sharing a band with the query, whatever the cache size.
+    # Each entry keeps a small pool of results, rotated between hits and
+    # renewed on a share of them (see SEMANTIC_CACHE for the policies).
+    # Like PerceptualCache, entries are appended to a JSON lines file that
+    # every worker follows. Once it holds more than `max_entries` entries,
+    # or has doubled since it was last rewritten and passed `max_bytes`, it
+    # is rewritten without the expired results, keeping the most recently
+    # stored entries (three quarters of `max_entries`), and every worker
+    # reloads it.
+    def __init__(
+        self,
+        path,
+        policies,
+        num_perm=64,
+        bands=16,
+        max_entries=5000,
+        max_bytes=20 * 1024 * 1024,
+    ):
+        assert num_perm % bands == 0
+        self.path = path
+        self.policies = policies
+        self.hasher = MinHasher(num_perm)
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.inode = None
+        self.compacted = 0  # Size of the file when it was last loaded whole
+        self.__reset()
+        self.lock = threading.Lock()
+        self.counts = {method: {} for method in policies}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.__follow()
+
+    def __reset(self):
+        self.sigs = np.empty((1024, self.num_perm), np.uint32)
+        self.entries = (
+            []
+        )  # {"key", "method", "ns", "variants": [[time, value]], "next"}
+        self.index = {}  # Entry key -> position in entries and sigs
+        self.buckets = {}  # (method, namespace, band, band bytes) -> positions
+        self.offset = 0
+
+    def enabled(self, method):
+        return method in self.policies
+
+    def __count(self, method, event):
+        counts = self.counts[method]
+        counts[event] = counts.get(event, 0) + 1
+
+    def __bands(self, method, namespace, sig):
+        for band in range(self.bands):
+            chunk = sig[band * self.rows : (band + 1) * self.rows].tobytes()
+            yield (method, namespace, band, chunk)
+
+    def __add(self, key, method, namespace, sig, value, stamp):
+        # Add a result to the pool of its entry, creating the entry if needed
+        position = self.index.get(key)
+        if position is None:
+            position = len(self.entries)
+            if position == len(self.sigs):
+                self.sigs = np.concatenate([self.sigs, np.empty_like(self.sigs)])
+            self.sigs[position] = sig
+            self.index[key] = position
+            self.entries.append(
+                {
+                    "key": key,
+                    "method": method,
+                    "ns": namespace,
+                    "variants": [],
+                    "next": 0,
+                }
+            )
+            for bucket in self.__bands(method, namespace, sig):
+                self.buckets.setdefault(bucket, []).append(position)
+        variants = self.entries[position]["variants"]
+        variants.append([stamp, value])
+        del variants[: -self.policies.get(method, {}).get("variants", 1)]
+
+    def __follow(self):
+        # Load the entries other workers appended since the last read, all of
+        # them again if the file was compacted (replaced) in the meantime
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != self.inode:
+                self.inode, self.compacted = stat.st_ino, stat.st_size
+                self.__reset()
+            if stat.st_size <= self.offset:
+                return
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # Partially written, read it next time
+                self.offset += len(line)
+                try:
+                    entry = json.loads(line)
+                    sig = np.frombuffer(bytes.fromhex(entry["sig"]), np.uint32)
+                    self.__add(
+                        entry["key"],
+                        entry["method"],
+                        entry["ns"],
+                        sig,
+                        entry["value"],
+                        entry["time"],
+                    )
+                except (ValueError, KeyError):
+                    continue
+
+    def __compact(self):
+        with file_lock(f"{self.path}.lock"):
+            self.__follow()
+            if not self.__oversized():
+                return  # Another worker compacted it
+            now = time.time()
+            kept = []
+            for position, entry in enumerate(self.entries):
+                policy = self.policies.get(entry["method"])
+                if policy is None:
+                    continue
+                oldest = now - policy.get("ttl", 86400)
+                variants = [v for v in entry["variants"] if v[0] >= oldest]
+                if variants:
+                    kept.append((variants[-1][0], position, variants))
+            # Room for new entries, so the next compaction is not the next put
+            keep = self.max_entries - self.max_entries // 4
+            kept = sorted(kept, key=lambda k: k[0])[-keep:]
+            tmp = f"{self.path}.{uuid.uuid4().hex}"
+            with open(tmp, "w") as f:
+                for _, position, variants in sorted(kept, key=lambda k: k[1]):
+                    entry = self.entries[position]
+                    sig = self.sigs[position].tobytes().hex()
+                    for stamp, value in variants:
+                        line = {
+                            "key": entry["key"],
+                            "method": entry["method"],
+                            "ns": entry["ns"],
+                            "sig": sig,
+                            "value": value,
+                            "time": stamp,
+                        }
+                        f.write(json.dumps(line) + "\n")
+            os.replace(tmp, self.path)
+            self.__follow()
+
+    def __oversized(self):
+        return len(self.entries) > self.max_entries or (
+            self.offset > self.max_bytes and self.offset > 2 * self.compacted
+        )
+
+    def __key(self, method, namespace, text):
+        raw = json.dumps([method, namespace, _spaces.sub(" ", text).strip()])
+        return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+    def lookup(self, method, text, namespace=""):
+        # Closest entry as (similarity, entry key), or None below the threshold
+        if not self.enabled(method):
+            return None
+        policy = self.policies[method]
+        sig = self.hasher.signature(text)
+        with self.lock:
+            self.__follow()
+            candidates = set()
+            for bucket in self.__bands(method, namespace, sig):
+                candidates.update(self.buckets.get(bucket, ()))
+            best = None
+            if candidates:
+                positions = np.fromiter(candidates, np.int64, len(candidates))
+                scores = (self.sigs[positions] == sig).mean(axis=1)
+                i = int(scores.argmax())
+                if scores[i] >= policy.get("threshold", 0.9):
+                    best = (float(scores[i]), self.entries[positions[i]]["key"])
+            self.__count(method, "hits" if best else "misses")
+            return best
+
+    def nearest(self, method, text, namespace=""):
+        # Result of the closest entry sharing a band with `text`, whatever its
+        # similarity and age, or None: served when a result cannot be
+        # generated (upstream outage)
+        if not self.enabled(method):
+            return None
+        sig = self.hasher.signature(text)
+        with self.lock:
+            self.__follow()
+            candidates = set()
+            for bucket in self.__bands(method, namespace, sig):
+                candidates.update(self.buckets.get(bucket, ()))
+            if not candidates:
+                return None
+            positions = np.fromiter(candidates, np.int64, len(candidates))
+            scores = (self.sigs[positions] == sig).mean(axis=1)
+            entry = self.entries[positions[int(scores.argmax())]]
+            self.__count(method, "degraded")
+            entry["next"] += 1
+            variants = entry["variants"]
+            return variants[entry["next"] % len(variants)][1]
+
+    def choose(self, method, key):
+        # A result of the entry to serve, or None when it should be generated
+        # again: the pool has expired, or this hit was picked for a refresh
+        policy = self.policies[method]
+        with self.lock:
+            position = self.index.get(key)
+            if position is None:
+                self.__count(method, "expired")  # Compacted away since the lookup
+                return None
+            entry = self.entries[position]
+            oldest = time.time() - policy.get("ttl", 86400)
+            variants = [v for v in entry["variants"] if v[0] >= oldest]
+            if not variants:
+                self.__count(method, "expired")
+                return None
+            if random.random() < policy.get("refresh", 0.0):
+                self.__count(method, "refreshes")
+                return None
+            entry["next"] += 1
+            return variants[entry["next"] % len(variants)][1]
+
+    def put(self, method, text, value, namespace="", key=None):
+        # Store a result under the entry `key` (a lookup match), or under a
+        # new entry for `text`
+        if not self.enabled(method) or value is None:
+            return
+        sig = self.hasher.signature(text)
+        with self.lock:
+            self.__follow()
+            if key in self.index:
+                sig = self.sigs[self.index[key]]
+            else:
+                key = self.__key(method, namespace, text)
+            line = json.dumps(
+                {
+                    "key": key,
+                    "method": method,
+                    "ns": namespace,
+                    "sig": sig.tobytes().hex(),
+                    "value": value,
+                    "time": time.time(),
+                }
+            )
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+            self.__follow()
+            if self.__oversized():
+                self.__compact()
+            self.__count(method, "stores")
+
+    def stats(self):
+        with self.lock:
+            stats = {"entries": len(self.entries)}
+            for method, counts in self.counts.items():
+                lookups = counts.get("hits", 0) + counts.get("misses", 0)
+                stats[method] = {
+                    **counts,
+                    **{
+                        k: v
+                        for k, v in self.policies[method].items()
+                        if k in ("threshold", "refresh", "variants")
+                    },
+                    "hit_rate": counts.get("hits", 0) / lookups if lookups else None,
+                }
+            return stats
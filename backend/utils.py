@@ -1,9 +1,12 @@
 import base64
 import os
-from PIL import Image
 from io import BytesIO
 import logging
-import cv2
+from lazy import lazy_module
+from logs import queue_logging
+
+Image = lazy_module("PIL.Image")
+cv2 = lazy_module("cv2")
 
 
 def base64_encode_file(image_path):
@@ -25,17 +28,14 @@ def save_base64_image(base64_string, save_path):
     image = Image.open(BytesIO(image_data))
     image.save(save_path)
 
-def logger_setup(name, location, debug=False):
+def logger_setup(name, location, debug=False, **options):
+    # JSON lines written by a background thread to a rotated file, see
+    # logs.queue_logging for the options
     os.makedirs(os.path.dirname(location), exist_ok=True)
 
     logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG if debug else logging.INFO)
-    formatter = logging.Formatter(
-        fmt="%(asctime)s [%(levelname)s]: %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
-    )
-    handler = logging.StreamHandler(stream=open(location, "w"))
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    queue_logging(logger, location, **options)
     return logger
 
 
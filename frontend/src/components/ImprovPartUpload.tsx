@@ -85,6 +85,7 @@ const ImprovPartUploadModal = ({
           story: story,
           premise: useAdventureStore.getState().premise?.desc,
           keypoint: getLastKeyPoint(),
+          story_id: useAdventureStore.getState().story?.id,
         })
         .then((res) => res.data.data);
     },
@@ -121,6 +122,7 @@ const ImprovPartUploadModal = ({
           story: story,
           premise: useAdventureStore.getState().premise?.desc,
           keypoint: getLastKeyPoint(),
+          story_id: useAdventureStore.getState().story?.id,
           exercise: false,
         })
         .then((res) => res.data.data);
@@ -96,6 +96,7 @@ const StoryPart = ({
           "/story/image",
           {
             content: part.keymoment,
+            image_prompt: part.image_prompt,
             style: useAdventureStore.getState().image?.style,
           },
           { signal }
@@ -120,7 +121,10 @@ const StoryPart = ({
       console.log("StoryPart - Generating new story part: ", context);
       scrollIntoView();
       return instance
-        .post("/story/part", createCallContext({ ...context }))
+        .post("/story/part", {
+          ...createCallContext({ ...context }),
+          story_id: useAdventureStore.getState().story?.id,
+        })
         .then((res) => res.data.data);
     },
     onSuccess: (data) => {
@@ -132,7 +136,10 @@ const StoryPart = ({
     mutationKey: ["story-end"],
     mutationFn: (context: { story: string }) => {
       return instance
-        .post("/story/end", createCallContext(context))
+        .post("/story/end", {
+          ...createCallContext(context),
+          story_id: useAdventureStore.getState().story?.id,
+        })
         .then((res) => res.data.data);
     },
     onSuccess: (data) => {
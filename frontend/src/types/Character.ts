@@ -6,4 +6,5 @@ export type TCharacter = {
   dislikes?: string[];
   fears?: string[];
   personality?: string[];
+  appearance?: string;
 };
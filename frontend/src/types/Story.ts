@@ -27,6 +27,7 @@ export type TStoryPart = {
   text: string;
   sentiment?: "happy" | "sad" | "neutral" | "shocking";
   keymoment?: string;
+  image_prompt?: string;
   actions?: TAction[];
   image?: string;
   analytics?: TAnalytics;